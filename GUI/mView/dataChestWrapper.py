@@ -349,10 +349,12 @@ class dataChestWrapper:
                     custUnits = self.device.getUnit(nickname)
                 if custUnits is None:
                     custUnits = ''
-                self.dataSet.addParameter(
-                    "y_label", self.device.getFrame().getYLabel(), overwrite = True)
                 # print "setting units:", custUnits
-                self.dataSet.addParameter("custom_units", custUnits, overwrite = True)
+                # Unchanged labels are skipped by dataChest, so this
+                # does not rewrite the file on every sample.
+                self.dataSet.setParameters(
+                    {"y_label": self.device.getFrame().getYLabel(),
+                     "custom_units": custUnits}, overwrite = True)
                 for y, param in enumerate(self.device.getParameters()):
                     # Channels that should be logged
 
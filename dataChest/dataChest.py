@@ -21,6 +21,10 @@ import string
 import re
 import ast
 import pickle
+import threading
+import bisect
+import collections
+import copy
 
 VAR_NAME_INDEX = 0
 VAR_SHAPE_INDEX = 1
@@ -52,6 +56,26 @@ VALID_PARAMETER_TYPES = ["int", "long", "float", "complex", "bool",
                          "float16", "float32", "float64",
                          "complex64", "complex128", "ndarray"]
 
+VALID_COMPRESSION_FILTERS = [None, "gzip", "lzf"]
+
+#chunkBytes is the target chunk size; expectedRows caps it for short sets
+STORAGE_PROFILES = {
+    "uncompressed": {"compression": None, "compressionLevel": None,
+                     "shuffle": False, "chunkBytes": 256*1024,
+                     "expectedRows": None},
+    "fast": {"compression": "lzf", "shuffle": True},
+    "archive": {"compression": "gzip", "compressionLevel": 4,
+                "shuffle": True, "chunkBytes": 1024*1024}
+}
+
+METADATA_CACHE_SIZE = 16 #recently read files whose metadata is kept
+
+DEFAULT_BUFFER_ROWS = 1000 #rows held by enableWriteBuffer() before a commit
+DEFAULT_FLUSH_INTERVAL = 1.0 #seconds between background commits
+BUFFER_BACKPRESSURE_FACTOR = 4 #multiple of maxRows that forces inline commits
+
+VALID_RETURN_FORMATS = ["list", "dict", "structured"]
+
 TYPE_CASTING_OBJECTS = [int, long, float, complex, bool, list,
                             str, unicode, tuple, dict, np.bool_, np.int8, np.int16,
                             np.int32, np.int64, np.uint8, np.uint16,
@@ -60,7 +84,17 @@ TYPE_CASTING_OBJECTS = [int, long, float, complex, bool, list,
 
 class dataChest(dateStamp):
 
+  #parsed metadata of recently read files, shared by every instance in the
+  #process; no file handles are kept, so no idle file stays locked
+  metadataCache = collections.OrderedDict()
+  metadataCacheLock = threading.Lock()
+
   def __init__(self, path, setWorkingDirectoryToRoot = False): #add for ability to set root path 
+    self.dirIndex = {}
+    self.uniqueNameCounters = {}
+    self.fileMode = None
+    self.openMtime = None
+    self._resetParameterCache()
     self.cwdPath = os.environ["DATA_ROOT"] #Make sure this exists
     if "\\" in self.cwdPath:
       self.cwdPath = self.cwdPath.replace("\\", "/")
@@ -75,11 +109,22 @@ class dataChest(dateStamp):
     self.varDict["dependents"] ={}
     self.numIndepWrites = 0
     self.numDepWrites = 0
+    self.validatedColumns = None
+    self.storageProfile = None
+    self.writeBuffer = None
+    self.bufferedRows = 0
+    self.maxBufferRows = DEFAULT_BUFFER_ROWS
+    self.flushInterval = DEFAULT_FLUSH_INTERVAL
+    self.bufferLock = threading.Lock()
+    self.fileLock = threading.RLock()
+    self.flushEvent = threading.Event()
+    self.flusherThread = None
+    self.writerException = None
 
   def _initializeRoot(self, path):
     if isinstance(path, str):
       if len(path)>0:
-        directories = [x.lower() for x in self.ls()[1]]
+        directories = self._getDirIndex()["lowerFolders"]
         if path.lower() not in directories:
           self.mkdir(path)
         self.cd(path)
@@ -89,7 +134,7 @@ class dataChest(dateStamp):
     elif isinstance(path, list):
       if len(path)>=1:
         for ii in range(0, len(path)):
-          directories = [x.lower() for x in self.ls()[1]]
+          directories = self._getDirIndex()["lowerFolders"]
           if len(path[ii]) > 0:
             if path[ii].lower() not in directories:
               self.mkdir(path[ii])
@@ -107,11 +152,12 @@ class dataChest(dateStamp):
   def mkdir(self, directoryToMake):
     """Makes a new directory within the current working directory."""
     directoryToMake= directoryToMake.replace("\\", "/")
-    dirContents = [x.lower() for x in self.ls()[1]]
+    dirContents = self._getDirIndex()["lowerFolders"]
     if self._formatFilename(directoryToMake, " /+-.") == directoryToMake:
       if directoryToMake.lower() not in dirContents:
         if not os.path.isdir(self.cwdPath+"/"+directoryToMake):
             os.mkdir(self.cwdPath+"/"+directoryToMake) #Try except this even though safe guarded
+        self.dirIndex.pop(self.cwdPath, None)
       else:
         raise OSError(
           "Directory already exists.\r\n\t"
@@ -127,6 +173,19 @@ class dataChest(dateStamp):
 
   def ls(self):
     """Lists the contents of the current working directory."""
+    dirIndex = self._getDirIndex()
+    return [list(dirIndex["files"]), list(dirIndex["folders"])]
+
+  def _getDirIndex(self):
+    """Returns the cached listing of the cwd, relisting it if its mtime moved.
+
+    The index holds the sorted "files" and "folders" lists plus the
+    "fileSet" and "lowerFolders" sets used for membership tests.
+    """
+    mtime = os.stat(self.cwdPath).st_mtime
+    dirIndex = self.dirIndex.get(self.cwdPath)
+    if dirIndex is not None and dirIndex["mtime"] == mtime:
+      return dirIndex
     cwdContents = os.listdir(self.cwdPath)
     filesList = []
     foldersList = []
@@ -139,7 +198,23 @@ class dataChest(dateStamp):
           foldersList.append(item)
     filesList = sorted(filesList) #alphabetize for readibility
     foldersList = sorted(foldersList)
-    return [filesList, foldersList]
+    dirIndex = {
+      "mtime": mtime,
+      "files": filesList,
+      "folders": foldersList,
+      "fileSet": set(filesList),
+      "lowerFolders": set([x.lower() for x in foldersList])
+      }
+    self.dirIndex[self.cwdPath] = dirIndex
+    return dirIndex
+
+  def _addFileToDirIndex(self, filename):
+    """Records a file we just created without relisting the cwd."""
+    dirIndex = self.dirIndex.get(self.cwdPath)
+    if dirIndex is not None:
+      bisect.insort(dirIndex["files"], filename)
+      dirIndex["fileSet"].add(filename)
+      dirIndex["mtime"] = os.stat(self.cwdPath).st_mtime
 
   def pwd(self):
     currentWorkingDirectory = self.cwdPath
@@ -172,8 +247,7 @@ class dataChest(dateStamp):
         
     if len(path)>0:
       for ii in range(0, len(path)):
-        cwdContents = self.ls()
-        dirContents = [x.lower() for x in self.ls()[1]]
+        dirContents = self._getDirIndex()["lowerFolders"]
         
         if path[ii].lower() in dirContents:
           self.cwdPath = self.cwdPath+"/"+path[ii]
@@ -195,31 +269,43 @@ class dataChest(dateStamp):
       raise Warning("Calling cd() on an empty list has no meaning.")
     
   def createDataset(self, datasetName, indepVarsList,
-                    depVarsList, dateStamp = None):
-    "Creates a new dataset within the current working directory."""
-    self.currentHDF5Filename = None
-    self.readOnlyFlag = False
-    self.dataCategory = None #treat self.dataCategory consistently
+                    depVarsList, dateStamp = None,
+                    storageProfile = None, expectedRows = None):
+    """Creates a new dataset within the current working directory.
+
+    storageProfile selects chunking and compression, either by name
+    from STORAGE_PROFILES or as a dict overriding some of its keys.
+    expectedRows caps the chunk size for short datasets. Without
+    either, datasets keep the historical fixed chunk shapes.
+    """
+    #the flusher thread must not commit rows while the file is swapped
+    with self.fileLock:
+      self.flush()
+      self.storageProfile = self._getStorageProfile(storageProfile,
+                                                    expectedRows)
+      self._releaseCurrentFile()
+      self.readOnlyFlag = False
+      self.dataCategory = None #treat self.dataCategory consistently
     
-    if datasetName != self._formatFilename(datasetName, " =+-."):
-      raise self.exception
-    elif not self._isVarsListValid("independents", indepVarsList): 
-      raise self.exception
-    elif not self._isVarsListValid("dependents", depVarsList):
-      raise self.exception
-    elif self._getVariableNames(indepVarsList+depVarsList)==[]:
-      raise self.exception
-    elif dateStamp is not None:
-      RE = re.compile(r'^[a-z]{3}[0-9]{4}[a-z]{3}$')
-      if not bool(RE.search(dateStamp)):
-        raise IOError("Invalid dateStamp provided.")
+      if datasetName != self._formatFilename(datasetName, " =+-."):
+        raise self.exception
+      elif not self._isVarsListValid("independents", indepVarsList): 
+        raise self.exception
+      elif not self._isVarsListValid("dependents", depVarsList):
+        raise self.exception
+      elif self._getVariableNames(indepVarsList+depVarsList)==[]:
+        raise self.exception
+      elif dateStamp is not None:
+        RE = re.compile(r'^[a-z]{3}[0-9]{4}[a-z]{3}$')
+        if not bool(RE.search(dateStamp)):
+          raise IOError("Invalid dateStamp provided.")
     
-    filename = self._generateUniqueFilename(datasetName, dateStamp)
-    if len(filename)>0:
-      self.dataCategory = self._categorizeDataset(self.varDict)
-      self._initDataset(self.varDict, filename)
-    else:
-      raise RuntimeError("Unable to create a unique filename.")
+      filename = self._generateUniqueFilename(datasetName, dateStamp)
+      if len(filename)>0:
+        self.dataCategory = self._categorizeDataset(self.varDict)
+        self._initDataset(self.varDict, filename)
+      else:
+        raise RuntimeError("Unable to create a unique filename.")
 
   def getDatasetName(self):
     if self.currentHDF5Filename is not None:
@@ -253,63 +339,25 @@ class dataChest(dateStamp):
         + "using addData()."
         )
     elif self.currentHDF5Filename is not None:
+      self._raiseWriterException()
       if self._isDataValid(data):
-        numIndeps = len(self.varDict["independents"]["names"])
-        numDeps = len(self.varDict["dependents"]["names"])
         numRows = len(data)
-        indepShapes = self.varDict["independents"]["shapes"]
-        depShapes = self.varDict["dependents"]["shapes"]
-        if self.dataCategory == "Arbitrary Type 1":
-          for colNum in range(0, numIndeps+numDeps):
-            column = [data[ii][colNum] for ii in range(0, len(data))]
-            column = np.asarray(column)
-            if colNum<numIndeps:
-              varGrp = "independents"
-              varName = self.varDict[varGrp]["names"][colNum]
-              flatLen = len(column)
-              self._addToDataset(self.file[varGrp][varName],
-                                 column,
-                                 flatLen,
-                                 self.numIndepWrites)
-            else:
-              varGrp = "dependents"
-              varName = self.varDict[varGrp]["names"][colNum-numIndeps]
-              flatLen = len(column)
-              self._addToDataset(self.file[varGrp][varName],
-                                 column,
-                                 flatLen,
-                                 self.numDepWrites)
-          self.numIndepWrites = self.numIndepWrites+flatLen
-          self.numDepWrites = self.numDepWrites+flatLen
+        #columnar bulk append: stack every column before touching the
+        #file, then one resize and one slice write per variable
+        shapes = self._getAllShapes()
+        columns = []
+        for colNum in range(0, len(shapes)):
+          flatLen = self._flatShape(shapes[colNum])[0]
+          if self.validatedColumns is not None:
+            column = self.validatedColumns[colNum]
+          else:
+            column = self._stackColumn(data, colNum, flatLen)
+          columns.append(np.reshape(column, (numRows*flatLen,)))
+        if self.writeBuffer is not None:
+          self._bufferColumns(columns, numRows)
         else:
-          for rowIndex in range(0, numRows):
-            for colNum in range(0, len(data[rowIndex])):
-              if colNum<numIndeps:
-                varGrp = "independents"
-                varName = self.varDict[varGrp]["names"][colNum]
-                varData = np.asarray(data[rowIndex][colNum])
-                varShapes = self.varDict[varGrp]["shapes"]
-                flatLen = self._flatShape(varShapes[colNum])[0]
-                self._addToDataset(self.file[varGrp][varName],
-                                   varData,
-                                   flatLen,
-                                   self.numIndepWrites)
-              else:
-                varGrp = "dependents"
-                varName = self.varDict[varGrp]["names"][colNum-numIndeps]
-                varData = np.asarray(data[rowIndex][colNum])
-                varShapes = self.varDict[varGrp]["shapes"]
-                flatLen = self._flatShape(varShapes[colNum-numIndeps])[0]
-                self._addToDataset(self.file[varGrp][varName],
-                                   varData,
-                                   flatLen,
-                                   self.numDepWrites)
-                
-            self.numIndepWrites = self.numIndepWrites + 1
-            self.numDepWrites = self.numDepWrites + 1
-            
-        self.file.attrs["Number Of Rows Added"] = self.numIndepWrites
-        self.file.flush()
+          with self.fileLock:
+            self._writeColumns(columns, numRows)
       else:
         raise self.exception
     else:
@@ -318,23 +366,189 @@ class dataChest(dateStamp):
         + "Datasets are created using the createDataset().\r\n\t"
         )
 
+  def enableWriteBuffer(self, maxRows = DEFAULT_BUFFER_ROWS,
+                        flushInterval = DEFAULT_FLUSH_INTERVAL):
+    """Buffers addData() rows in memory and commits them in groups.
+
+    A background thread commits the buffer every flushInterval seconds
+    or as soon as maxRows rows are waiting. Should the buffer reach
+    BUFFER_BACKPRESSURE_FACTOR*maxRows rows, addData() commits inline.
+    Use flush() to force a commit and close() when done logging.
+    """
+    if not (isinstance(maxRows, int) and maxRows > 0):
+      raise ValueError("maxRows must be a positive integer.")
+    elif not flushInterval > 0:
+      raise ValueError("flushInterval must be positive.")
+    self.maxBufferRows = maxRows
+    self.flushInterval = flushInterval
+    if self.writeBuffer is None:
+      self.writeBuffer = []
+      self.bufferedRows = 0
+      self.flushEvent.clear()
+      self.flusherThread = threading.Thread(target=self._flusherLoop,
+                                            name="dataChest flusher")
+      self.flusherThread.daemon = True
+      self.flusherThread.start()
+
+  def disableWriteBuffer(self):
+    """Commits any buffered rows and returns to synchronous writes.
+
+    Should the commit fail, the rows stay buffered and the error is
+    raised, so that flush() or disableWriteBuffer() can be retried.
+    """
+    if self.writeBuffer is not None:
+      flusherThread = self.flusherThread
+      self.flusherThread = None
+      if flusherThread is not None:
+        self.flushEvent.set()
+        flusherThread.join()
+      self.flush()
+      self.writeBuffer = None
+
+  def flush(self):
+    """Commits buffered rows to the current dataset.
+
+    Rows that fail to commit are put back at the front of the buffer,
+    and the error is raised here or, for background commits, by the
+    next addData(), flush() or close().
+    """
+    with self.fileLock:
+      if self.writeBuffer is not None:
+        with self.bufferLock:
+          batches = self.writeBuffer
+          numRows = self.bufferedRows
+          self.writeBuffer = []
+          self.bufferedRows = 0
+        if numRows > 0:
+          try:
+            if len(batches) == 1:
+              columns = batches[0]
+            else:
+              columns = [np.concatenate(column) for column in zip(*batches)]
+              batches = [columns]
+            self._writeColumns(columns, numRows)
+          except Exception:
+            with self.bufferLock:
+              self.writeBuffer[:0] = batches
+              self.bufferedRows = self.bufferedRows + numRows
+            raise
+      if self.parametersDirty and hasattr(self, 'file'):
+        self.file.flush()
+        self.parametersDirty = False
+    self._raiseWriterException()
+
+  def close(self):
+    """Commits buffered rows and closes the current file.
+
+    The files are closed even if the commit fails, in which case the
+    buffered rows are dropped and the error is raised.
+    """
+    try:
+      self.disableWriteBuffer()
+    finally:
+      self.writeBuffer = None
+      self.bufferedRows = 0
+      self.writerException = None
+      if hasattr(self, 'file'):
+        if self.file.id.valid:
+          self.file.close()
+        del self.file
+      self.currentHDF5Filename = None
+
+  def _bufferColumns(self, columns, numRows):
+    #columns may be views of the caller's array, which it is free to
+    #reuse once addData() returns
+    columns = [np.array(column, copy=True) for column in columns]
+    with self.bufferLock:
+      self.writeBuffer.append(columns)
+      self.bufferedRows = self.bufferedRows + numRows
+      bufferedRows = self.bufferedRows
+    if bufferedRows >= BUFFER_BACKPRESSURE_FACTOR*self.maxBufferRows:
+      self.flush() #flusher is falling behind, commit inline
+    elif bufferedRows >= self.maxBufferRows:
+      self.flushEvent.set()
+
+  def _flusherLoop(self):
+    while self.flusherThread is not None:
+      self.flushEvent.wait(self.flushInterval)
+      self.flushEvent.clear()
+      try:
+        self.flush()
+      except Exception as e:
+        self.writerException = e
+
+  def _raiseWriterException(self):
+    if self.writerException is not None:
+      exception = self.writerException
+      self.writerException = None
+      raise exception
+
+  def _writeColumns(self, columns, numRows):
+    """Appends flat columns after the rows recorded in the file.
+
+    Data goes in at offsets computed from the row count, and the count
+    is only advanced once every column is written, so rows left over
+    from an interrupted write are overwritten rather than misaligned.
+    """
+    os.utime(self.currentHDF5Filename, None)
+    shapes = self._getAllShapes()
+    names = (self.varDict["independents"]["names"]
+             + self.varDict["dependents"]["names"])
+    numIndeps = len(self.varDict["independents"]["names"])
+    for colNum in range(0, len(shapes)):
+      if colNum<numIndeps:
+        varGrp = "independents"
+        numWrites = self.numIndepWrites
+      else:
+        varGrp = "dependents"
+        numWrites = self.numDepWrites
+      flatLen = self._flatShape(shapes[colNum])[0]
+      self._addToDataset(self.file[varGrp][names[colNum]],
+                         columns[colNum],
+                         numRows*flatLen,
+                         numWrites*flatLen)
+    self.numIndepWrites = self.numIndepWrites + numRows
+    self.numDepWrites = self.numDepWrites + numRows
+    self.file.attrs["Number Of Rows Added"] = self.numIndepWrites
+    self.file.flush()
+    self.parametersDirty = False
+
+  def _getAllShapes(self):
+    return (self.varDict["independents"]["shapes"]
+            + self.varDict["dependents"]["shapes"])
 
   def getNumRows(self):
     if self.currentHDF5Filename is not None:
+      self.flush()
       numRows = self.file.attrs["Number Of Rows Added"]
       return numRows
     else:
       raise Warning("No dataset is currently open.")
       
-  def getData(self, startIndex = np.nan, stopIndex = np.nan, variablesList = None):
-    """Retrieves data from the current dataset."""
+  def getData(self, startIndex = np.nan, stopIndex = np.nan,
+              variablesList = None, returnFormat = "list"):
+    """Retrieves data from the current dataset.
+
+    returnFormat = "list" gives the historical rows of columns,
+    "dict" gives {varName: ndarray} with each array shaped
+    (rows, *varShape) and "structured" gives one structured ndarray
+    of length rows with one field per variable.
+    """
+    if returnFormat not in VALID_RETURN_FORMATS:
+      raise ValueError(
+        "Invalid returnFormat provided.\r\n\t"
+        + "Format provided="+str(returnFormat)+"\r\n\t"
+        + "Valid formats="+str(VALID_RETURN_FORMATS)
+        )
     if self.currentHDF5Filename is not None:
+      self.flush()
       dataDict = {}
       numRows = self.file.attrs["Number Of Rows Added"]
       sliceIndices = self._sortSliceIndices(startIndex, stopIndex, numRows)
       if not isinstance(sliceIndices, list):
         raise self.exception
       startIndex, stopIndex = sliceIndices[0], sliceIndices[1]
+      stopIndex = max(startIndex, min(stopIndex, numRows))
       for varTypes in self.varDict.keys():
         if variablesList is not None:
           desiredVarList = []
@@ -344,21 +558,18 @@ class dataChest(dateStamp):
         else:
           desiredVarList = self.file[varTypes].keys()
         for variables in desiredVarList:
-          varGrp = self.file[varTypes]
-          dataset = varGrp[variables].value
-          originalShape = varGrp[variables].attrs["shapes"]
+          dset = self.file[varTypes][variables]
+          originalShape = dset.attrs["shapes"]
           chunkSize = self._flatShape(originalShape)[0]
-          totalLen = varGrp[variables].shape[0]
-          numChunks = totalLen/chunkSize
-          dataDict[variables]=[]
-          if len(originalShape)>1 or originalShape!=[1]:           
-            for ii in range(0, numRows):
-              chunk = np.asarray(dataset[ii*chunkSize:(ii+1)*chunkSize])
-              chunk = np.reshape(chunk, tuple(originalShape))
-              dataDict[variables].append(chunk.tolist())
+          #hyperslab read of the requested rows only
+          dataset = dset[startIndex*chunkSize:stopIndex*chunkSize]
+          if len(originalShape)>1 or originalShape!=[1]:
+            rows = np.reshape(dataset, (-1,)+tuple(originalShape))
+            if returnFormat == "list":
+              dataDict[variables] = rows.tolist()
+            else:
+              dataDict[variables] = rows
           else:
-            if len(dataset) != numRows:
-              dataset = dataset[0:numRows]
             dataDict[variables] = dataset
 
       data = []
@@ -368,15 +579,24 @@ class dataChest(dateStamp):
       else:
         allVars = (self.varDict["independents"]["names"]
                  + self.varDict["dependents"]["names"])
-      
-      if self.getDataCategory() == "Arbitrary Type 1":
+
+      if returnFormat == "dict":
+        return dict((str(name), dataDict[name]) for name in allVars)
+      elif returnFormat == "structured":
+        fields = [(str(name), dataDict[name].dtype, dataDict[name].shape[1:])
+                  for name in allVars]
+        data = np.empty(stopIndex-startIndex, dtype=fields)
+        for name in allVars:
+          data[str(name)] = dataDict[name]
+        return data
+      elif self.getDataCategory() == "Arbitrary Type 1":
         for ii in range(0, len(allVars)):
           data.append(dataDict[allVars[ii]])
         data = np.asarray(data)
         data = data.T
-        return data[startIndex:stopIndex]
+        return data
       else:
-        for ii in range(startIndex,stopIndex): #making slicing efficient
+        for ii in range(0, stopIndex-startIndex):
           row = []
           for jj in range(0,len(allVars)):
             row.append(dataDict[allVars[jj]][ii])
@@ -393,41 +613,23 @@ class dataChest(dateStamp):
     """Opens a dataset in the current working directory if it exists."""
     if '.hdf5' not in filename: #adds file extension if omitted
       filename = filename+".hdf5"
-    existingFiles = self.ls()[0]
+    existingFiles = self._getDirIndex()["fileSet"]
     if filename in existingFiles:
-      if hasattr(self, 'file'):
-        self.file.close() #close current file if existent
-      
-      if grapher1 is False:
-          self.file = h5py.File(self.pwd()+"/"+filename,'r+') #read+write
-          self.currentHDF5Filename = self.pwd() + "/" + filename
-      else:
-          self.file = h5py.File(self.pwd()+"/"+filename,'r') #read+write
-          self.currentHDF5Filename = self.pwd() + "/" + filename
+      with self.fileLock:
+        self.flush()
+        self._releaseCurrentFile()
+        if grapher1 is False:
+          fileMode = 'r+' #read+write
+        else:
+          fileMode = 'r'
+        self._openCachedFile(self.pwd() + "/" + filename, fileMode)
    
-      if modify is True:
-        self.readOnlyFlag = False
-      else:
-        self.readOnlyFlag = True
-  
-      for varType in self.varDict.keys(): #copying varDict from file
-        varGroupAttributes = self.file[varType].attrs.keys()
-        varGrp = self.file[varType]
-        for item in varGroupAttributes:
-          #hack for backward compatibility with N-d datasets
-          if item == 'shapes':
-            tempList = varGrp.attrs[item].tolist()
-            if type(tempList[0]) == str:
-              tempList = self._convertElementsToLists(tempList)
-              self.varDict[varType][str(item)] = tempList
-            else:
-              self.varDict[varType][str(item)] = varGrp.attrs[item].tolist()
-          else:
-            self.varDict[varType][str(item)] = varGrp.attrs[item].tolist()
-
-      self.dataCategory = self.file.attrs["Data Category"]
-      self.numIndepWrites = self.file.attrs["Number Of Rows Added"]
-      self.numDepWrites = self.numIndepWrites    
+        if modify is True:
+          self.readOnlyFlag = False
+        else:
+          self.readOnlyFlag = True
+        self.numIndepWrites = self.file.attrs["Number Of Rows Added"]
+        self.numDepWrites = self.numIndepWrites    
     else:
       self.currentHDF5Filename = None
       raise ValueError(
@@ -435,6 +637,76 @@ class dataChest(dateStamp):
         + "the desired dataset."
         )
 
+  def _openCachedFile(self, path, fileMode):
+    """Opens path as the current file, reusing cached metadata if possible.
+
+    The mtime is taken once the file is open and the cached metadata is
+    reused only if it was read from the file at that same mtime. Opening
+    a file for writing changes its mtime, so only read-only opens can
+    hit the cache.
+    """
+    self.file = h5py.File(path, fileMode)
+    self.fileMode = fileMode
+    self.currentHDF5Filename = path
+    self.openMtime = os.stat(path).st_mtime
+    with self.metadataCacheLock:
+      entry = self.metadataCache.pop(path, None)
+    if (entry is not None and fileMode == 'r'
+        and entry["mtime"] == self.openMtime):
+      self.varDict = entry["varDict"]
+      self.dataCategory = entry["dataCategory"]
+      self._resetParameterCache(entry["paramCache"], entry["paramNames"])
+      return
+
+    self._resetParameterCache()
+    self.varDict = {}
+    self.varDict["independents"] = {}
+    self.varDict["dependents"] = {}
+    for varType in self.varDict.keys(): #copying varDict from file
+      varGroupAttributes = self.file[varType].attrs.keys()
+      varGrp = self.file[varType]
+      for item in varGroupAttributes:
+        #hack for backward compatibility with N-d datasets
+        if item == 'shapes':
+          tempList = varGrp.attrs[item].tolist()
+          if type(tempList[0]) == str:
+            tempList = self._convertElementsToLists(tempList)
+            self.varDict[varType][str(item)] = tempList
+          else:
+            self.varDict[varType][str(item)] = varGrp.attrs[item].tolist()
+        else:
+          self.varDict[varType][str(item)] = varGrp.attrs[item].tolist()
+    self.dataCategory = self.file.attrs["Data Category"]
+
+  def _releaseCurrentFile(self):
+    """Closes the current file, caching its metadata if still accurate.
+
+    Metadata is cached only for files opened read-only whose mtime has
+    not moved since they were opened, keyed by that mtime, so a write by
+    anyone else in between is never mistaken for the cached state.
+    """
+    if hasattr(self, 'file'):
+      path = self.currentHDF5Filename
+      if self.file.id.valid:
+        self.file.close()
+      del self.file
+      if (path is not None and self.fileMode == 'r'
+          and METADATA_CACHE_SIZE > 0
+          and os.stat(path).st_mtime == self.openMtime):
+        entry = {
+          "mtime": self.openMtime,
+          "varDict": copy.deepcopy(self.varDict),
+          "dataCategory": self.dataCategory,
+          "paramCache": self.paramCache,
+          "paramNames": self.paramNames
+          }
+        with self.metadataCacheLock:
+          self.metadataCache[path] = entry
+          while len(self.metadataCache) > METADATA_CACHE_SIZE:
+            self.metadataCache.popitem(last=False)
+    self.currentHDF5Filename = None
+    self.openMtime = None
+
   def _getParamterTypeString(self, paramValue):
     paramTypeString = paramValue.__class__.__name__
     for ii in range(0, len(VALID_PARAMETER_TYPES)):
@@ -454,11 +726,16 @@ class dataChest(dateStamp):
 
   def getParameterUnits(self, paramName):
     if self.currentHDF5Filename is not None:
-      if paramName in self.file["parameters"].attrs.keys():
+      if paramName in self.paramCache:
+        paramUnits = self.paramCache[paramName]["units"]
+        if paramUnits == "":
+          return None
+        else:
+          return paramUnits
+      elif paramName in self.file["parameters"].attrs:
         return None
-      elif paramName in self.file["parameters"].keys():
-        paramGrp = self.file["parameters"][paramName]
-        paramUnits = str(paramGrp.attrs["units"])
+      elif paramName in self.file["parameters"]:
+        paramUnits = self._readParameterEntry(paramName)["units"]
         if paramUnits == "":
           return None
         else:
@@ -484,9 +761,11 @@ class dataChest(dateStamp):
     elif self.currentHDF5Filename is not None:
       if paramName in self.file["parameters"].keys():
         if type(paramUnits) == str:
-          paramGrp = self.file["parameters"][paramName]
-          paramGrp.attrs["units"] = paramUnits
-          self.file.flush()
+          with self.fileLock:
+            paramGrp = self.file["parameters"][paramName]
+            paramGrp.attrs["units"] = paramUnits
+            self.paramCache.pop(paramName, None)
+            self.file.flush()
         else:
           raise IOError("Parameter units must be of type string."
                         + " " + str(type(paramUnits))
@@ -511,18 +790,9 @@ class dataChest(dateStamp):
         )
     elif self.currentHDF5Filename is not None:
       if self._isParameterValid(paramName, paramValue, paramUnits, overwrite): 
-        if paramName not in self.file["parameters"].keys():
-          self.file["parameters"].create_group(paramName)
-
-        paramTypeStr = self._getParamterTypeString(paramValue)
-        if paramTypeStr in ["long", "tuple", "dict"]:
-          paramValue = pickle.dumps(paramValue, protocol=0)
-        paramGrp = self.file["parameters"][paramName]
-        paramGrp.attrs["value"] = paramValue
-        paramGrp.attrs["dtype"] = paramTypeStr
-        paramGrp.attrs["units"] = paramUnits
-        
-        self.file.flush()
+        with self.fileLock:
+          self._writeParameter(paramName, paramValue, paramUnits)
+          self._flushParameters()
       else:
         raise self.exception
     else:
@@ -531,19 +801,131 @@ class dataChest(dateStamp):
         + "createDataset() before using addParameter()."
         )
 
+  def setParameters(self, paramDict, unitsDict=None, overwrite=False):
+    """Adds several parameters at once with a single flush.
+
+    paramDict maps parameter names to values and the optional unitsDict
+    maps some of those names to units. Every parameter is validated
+    before any is written, and values identical to the ones already in
+    the file are not rewritten.
+    """
+    if unitsDict is None:
+      unitsDict = {}
+    if self.readOnlyFlag == True:
+      raise Warning(
+        "You cannot add parameters to this file as it was\r\n\t"
+        + "opened read only. Files opened with openDataset()\r\n\t"
+        + "are read only by design. You must make a new set\r\n\t"
+        + "if you wish to add parameters to one. or set\r\n\t"
+        + "modify = True."
+        )
+    elif self.currentHDF5Filename is not None:
+      for paramName in paramDict:
+        paramUnits = unitsDict.get(paramName, "")
+        if not self._isParameterValid(paramName, paramDict[paramName],
+                                      paramUnits, overwrite):
+          raise self.exception
+      with self.fileLock:
+        for paramName in paramDict:
+          self._writeParameter(paramName, paramDict[paramName],
+                               unitsDict.get(paramName, ""))
+        self._flushParameters()
+    else:
+      raise Warning(
+        "No file is currently selected. Create a file using\r\n\t"
+        + "createDataset() before using setParameters()."
+        )
+
+  def getParameters(self, paramNames=None, bypassIOError=False):
+    """Returns {paramName: getParameter(paramName)} for several names.
+
+    All parameters in the file are returned when paramNames is None.
+    """
+    if paramNames is None:
+      paramNames = self.getParameterList()
+    parameters = {}
+    for paramName in paramNames:
+      parameters[paramName] = self.getParameter(paramName, bypassIOError)
+    return parameters
+
+  def _writeParameter(self, paramName, paramValue, paramUnits):
+    """Writes one parameter unless the file already holds that value."""
+    paramTypeStr = self._getParamterTypeString(paramValue)
+    if paramName in self.paramCache:
+      entry = self.paramCache[paramName]
+    elif paramName in self.file["parameters"]:
+      entry = self._readParameterEntry(paramName)
+    else:
+      entry = None
+    if entry is not None and self._isParameterUnchanged(
+        entry, paramTypeStr, paramValue, paramUnits):
+      return False
+
+    if paramName not in self.file["parameters"]:
+      self.file["parameters"].create_group(paramName)
+      self.paramNames = None
+    if paramTypeStr in ["long", "tuple", "dict"]:
+      paramValue = pickle.dumps(paramValue, protocol=0)
+    paramGrp = self.file["parameters"][paramName]
+    paramGrp.attrs["value"] = paramValue
+    paramGrp.attrs["dtype"] = paramTypeStr
+    paramGrp.attrs["units"] = paramUnits
+    self._readParameterEntry(paramName) #cache what a reader will get
+    self.parametersDirty = True
+    return True
+
+  def _flushParameters(self):
+    #buffered datasets pick the attributes up with the next commit
+    if self.parametersDirty and self.writeBuffer is None:
+      self.file.flush()
+      self.parametersDirty = False
+
+  def _isParameterUnchanged(self, entry, paramTypeStr, paramValue,
+                            paramUnits):
+    if entry["dtype"] != paramTypeStr or entry["units"] != paramUnits:
+      return False
+    try:
+      oldValue = np.asarray(entry["value"])
+      newValue = np.asarray(paramValue)
+      return bool(oldValue.dtype == newValue.dtype and
+                  oldValue.shape == newValue.shape and
+                  np.array_equal(oldValue, newValue))
+    except Exception:
+      return False
+
+  def _readParameterEntry(self, paramName):
+    paramGrp = self.file["parameters"][paramName]
+    paramValue = paramGrp.attrs["value"]
+    paramType = str(paramGrp.attrs["dtype"])
+    if paramType in ["long", "tuple", "dict"]:
+      paramValue = pickle.loads(paramValue)
+    paramUnits = str(paramGrp.attrs["units"])
+    paramValue = self._typeCastParameter(paramValue, paramType)
+    entry = {"dtype": paramType, "value": paramValue, "units": paramUnits}
+    self.paramCache[paramName] = entry
+    return entry
+
+  def _resetParameterCache(self, paramCache=None, paramNames=None):
+    if paramCache is None:
+      paramCache = {}
+    self.paramCache = paramCache
+    self.paramNames = paramNames
+    self.parametersDirty = False
+
   def getParameter(self, paramName, bypassIOError=False):
     if self.currentHDF5Filename is not None:
-      if paramName in self.file["parameters"].attrs.keys():
+      if paramName in self.paramCache:
+        entry = self.paramCache[paramName]
+      elif paramName in self.file["parameters"].attrs:
         paramValue = self.file["parameters"].attrs[paramName] # add in type preservation here
         return paramValue
-      elif paramName in self.file["parameters"].keys():
-        paramGrp = self.file["parameters"][paramName]
-        paramValue = paramGrp.attrs["value"]
-        paramType = str(paramGrp.attrs["dtype"])
-        if paramType in ["long", "tuple", "dict"]:
-          paramValue = pickle.loads(paramValue)
-        paramUnits = str(paramGrp.attrs["units"])
-        paramValue = self._typeCastParameter(paramValue, str(paramType))
+      elif paramName in self.file["parameters"]:
+        entry = self._readParameterEntry(paramName)
+      else:
+        entry = None
+      if entry is not None:
+        paramValue = copy.deepcopy(entry["value"]) #callers may mutate it
+        paramUnits = entry["units"]
         if paramUnits == "":
           return paramValue
         else:
@@ -572,13 +954,15 @@ class dataChest(dateStamp):
 
   def getParameterList(self):
     if self.currentHDF5Filename is not None:
-      #backwards compatibility
-      paramList1 = self.file["parameters"].attrs.keys()
-      paramList1 = [str(x) for x in paramList1] # convert from unicode
-      #new style parameters
-      paramList2 = self.file["parameters"].keys()
-      paramList2 = [str(x) for x in paramList2]
-      return paramList1 + paramList2
+      if self.paramNames is None:
+        #backwards compatibility
+        paramList1 = self.file["parameters"].attrs.keys()
+        paramList1 = [str(x) for x in paramList1] # convert from unicode
+        #new style parameters
+        paramList2 = self.file["parameters"].keys()
+        paramList2 = [str(x) for x in paramList2]
+        self.paramNames = paramList1 + paramList2
+      return list(self.paramNames)
     else:
       raise Warning(
         "No file is currently selected. Please select a file\r\n\t"
@@ -592,7 +976,10 @@ class dataChest(dateStamp):
     self.numDepWrites = 0
     
     self.file = h5py.File(self.pwd()+"/"+filename) #Try catch this
+    self.fileMode = 'r+'
+    self._resetParameterCache()
     self.currentHDF5Filename = self.pwd()+"/"+filename
+    self._addFileToDirIndex(filename)
     self.readOnlyFlag = False # gives user read and write access
     
     #create base groups within new file
@@ -672,10 +1059,14 @@ class dataChest(dateStamp):
       if varType == 'string':
         dataType = h5py.special_dtype(vlen=str)
         dShape = tuple(self._flatShape(varDict["shapes"][ii]))
+        if self.storageProfile is None:
+          chunkShape = dShape
+        else:
+          chunkShape = self._getChunkShape(dShape[0], dataType)
         dset = group.create_dataset(varDict["names"][ii],
                                     dShape,
                                     dtype=dataType,
-                                    chunks=dShape,
+                                    chunks=chunkShape,
                                     maxshape=(None,))       
       else:
         if varType == 'utc_datetime':
@@ -684,16 +1075,26 @@ class dataChest(dateStamp):
           dataType = varDict["types"][ii]
         fillVal = None
         dShape = tuple(self._flatShape(varDict["shapes"][ii]))
-        if dShape == (1,):
-          chunkShape = (10000,)
+        filters = {}
+        if self.storageProfile is None:
+          if dShape == (1,):
+            chunkShape = (10000,)
+          else:
+            chunkShape = dShape
         else:
-          chunkShape = dShape
+          chunkShape = self._getChunkShape(dShape[0], dataType)
+          if self.storageProfile["compression"] is not None:
+            filters["compression"] = self.storageProfile["compression"]
+          if self.storageProfile["compression"] == "gzip":
+            filters["compression_opts"] = self.storageProfile["compressionLevel"]
+          filters["shuffle"] = self.storageProfile["shuffle"]
         dset = group.create_dataset(varDict["names"][ii],
                                     dShape,
                                     dtype=dataType,
                                     chunks=chunkShape,
                                     maxshape=(None,),
-                                    fillvalue=fillVal)
+                                    fillvalue=fillVal,
+                                    **filters)
   
       #stores name, shape, type, and units as attributes for this dset
       #(sort of redundant as this is done at the varType group level)?
@@ -708,17 +1109,72 @@ class dataChest(dateStamp):
             "Type: "+str(type(varDict[keys][ii]))
             )
 
+  def _getChunkShape(self, flatLen, dataType):
+    """Picks a chunk holding whole rows close to chunkBytes in size.
+
+    Rows bigger than chunkBytes are split evenly across several chunks
+    and small rows are grouped, capped at the expected number of rows.
+    """
+    chunkBytes = self.storageProfile["chunkBytes"]
+    rowBytes = flatLen*np.dtype(dataType).itemsize
+    if rowBytes >= chunkBytes:
+      chunksPerRow = -(-rowBytes//chunkBytes)
+      return (-(-flatLen//chunksPerRow),)
+    rowsPerChunk = chunkBytes//rowBytes
+    if self.storageProfile["expectedRows"] is not None:
+      rowsPerChunk = max(1, min(rowsPerChunk,
+                                self.storageProfile["expectedRows"]))
+    return (rowsPerChunk*flatLen,)
+
+  def _getStorageProfile(self, storageProfile, expectedRows):
+    if storageProfile is None:
+      if expectedRows is not None:
+        storageProfile = "uncompressed"
+      else:
+        return None
+    if isinstance(storageProfile, str):
+      if storageProfile not in STORAGE_PROFILES:
+        raise ValueError(
+          "Unknown storage profile.\r\n\t"
+          + "Profile provided="+storageProfile+"\r\n\t"
+          + "Valid profiles="+str(sorted(STORAGE_PROFILES.keys()))
+          )
+      storageProfile = STORAGE_PROFILES[storageProfile]
+    elif not isinstance(storageProfile, dict):
+      raise TypeError("Storage profiles should be a str or dict.")
+    profile = dict(STORAGE_PROFILES["uncompressed"])
+    for key in storageProfile:
+      if key not in profile:
+        raise ValueError("Unknown storage profile key: "+str(key))
+      profile[key] = storageProfile[key]
+    if expectedRows is not None:
+      profile["expectedRows"] = expectedRows
+    if profile["compression"] not in VALID_COMPRESSION_FILTERS:
+      raise ValueError(
+        "Invalid compression filter provided.\r\n\t"
+        + "Filter provided="+str(profile["compression"])+"\r\n\t"
+        + "Valid filters="+str(VALID_COMPRESSION_FILTERS)
+        )
+    elif not (isinstance(profile["chunkBytes"], int)
+              and profile["chunkBytes"] > 0):
+      raise ValueError("chunkBytes must be a positive integer.")
+    elif (profile["expectedRows"] is not None and
+          not (isinstance(profile["expectedRows"], int)
+               and profile["expectedRows"] > 0)):
+      raise ValueError("expectedRows must be a positive integer.")
+    return profile
+
   def _generateUniqueFilename(self, datasetName, dateStamp):
-    uniquenessFlag = False
-    uniqueName = ""
     maxTries = 100
-    ii = 0
-    existingNames = self.ls()[0]
-    while ii<maxTries and uniquenessFlag == False:
-      if dateStamp is None:
-        fileDateStamp = self.dateStamp.dateStamp()
-      else:
-        fileDateStamp = dateStamp
+    existingNames = self._getDirIndex()["fileSet"]
+    if dateStamp is None:
+      fileDateStamp = self.dateStamp.dateStamp()
+    else:
+      fileDateStamp = dateStamp
+    #resume numbering where the last call for this name left off
+    counterKey = (self.cwdPath, fileDateStamp, datasetName)
+    firstTry = self.uniqueNameCounters.get(counterKey, 0)
+    for ii in range(firstTry, firstTry+maxTries):
       if ii == 0:
         uniqueName = (fileDateStamp +
                       "_"+datasetName+".hdf5")
@@ -727,10 +1183,9 @@ class dataChest(dateStamp):
                       "_"+str(ii)+"_"+datasetName+".hdf5") 
 
       if uniqueName not in existingNames:
-        uniquenessFlag = True
-      else:
-        ii = ii + 1
-    return uniqueName
+        self.uniqueNameCounters[counterKey] = ii+1
+        return uniqueName
+    return ""
 
   def _updateVariableDict(self, varDict, varList):
     varDict["names"] = self._getVariableNames(varList)
@@ -898,23 +1353,30 @@ class dataChest(dateStamp):
       varTypes.append(varsList[ii][VAR_UNIT_INDEX])
     return varTypes
 
-  def _addToDataset(self, dset, data, chunkSize, numWrites):
-    os.utime(self.currentHDF5Filename, None) 
-    if numWrites == 0:
-      data = np.reshape(data, (chunkSize,))
-      if dset.shape[0] == 1 and len(dset.shape) == 1: #arbitrary type 1 hack
-        dset.resize((chunkSize,))
-      dset[:chunkSize] = data
-    else:
-      data = np.reshape(data, (chunkSize,))
-      dset.resize((dset.shape[0]+chunkSize,))
-      dset[-chunkSize:] = data
+  def _addToDataset(self, dset, data, chunkSize, offset):
+    data = np.reshape(data, (chunkSize,))
+    if dset.shape[0] != offset+chunkSize:
+      dset.resize((offset+chunkSize,))
+    dset[offset:offset+chunkSize] = data
+
+  def _stackColumn(self, data, colNum, flatLen):
+    """Stacks one column of a batch of rows into a flat array."""
+    column = np.asarray([data[ii][colNum] for ii in range(0, len(data))])
+    if column.size != len(data)*flatLen:
+      raise ValueError(
+        "Column "+str(colNum)+" could not be stacked into\r\n\t"
+        + "rows of "+str(flatLen)+" element(s) each."
+        )
+    return column
 
   def _isDataValid(self, data):
+    self.validatedColumns = None
     if isinstance(data, (list, np.ndarray)): # checks that its a list
       numRows = len(data)
       if numRows>0: # if length nonzero proceed to check tuples
-        if self.dataCategory == "Arbitrary Type 1":
+        if self._isBatchValid(data):
+          return True
+        elif self.dataCategory == "Arbitrary Type 1":
           if self._isDataFormatArbType1(data, self.varDict):
             return True
           else:
@@ -963,6 +1425,59 @@ class dataChest(dateStamp):
       return False
     return True
 
+  def _isBatchValid(self, data):
+    """Validates a whole batch at once, one stacked column at a time.
+
+    This is only a fast path: it returns False on anything unexpected
+    and leaves the detailed per-row checks to produce the error. On
+    success the stacked columns are kept in self.validatedColumns so
+    addData does not have to convert the batch a second time.
+    """
+    shapes = (self.varDict["independents"]["shapes"]
+              + self.varDict["dependents"]["shapes"])
+    types = (self.varDict["independents"]["types"]
+             + self.varDict["dependents"]["types"])
+    numRows = len(data)
+    numVars = len(shapes)
+    isArray = isinstance(data, np.ndarray) and data.dtype != object
+    try:
+      if isArray:
+        if data.ndim < 2 or data.shape[1] != numVars:
+          return False
+      else:
+        for row in data:
+          if len(row) != numVars:
+            return False
+          elif (self.dataCategory == "Other" and
+                not isinstance(row, (list, np.ndarray))):
+            return False
+      columns = []
+      for colIndex in range(0, numVars):
+        if isArray:
+          column = data[:, colIndex]
+        else:
+          column = np.asarray([data[ii][colIndex]
+                               for ii in range(0, numRows)])
+        if shapes[colIndex] == [1]:
+          expectedShape = (numRows,)
+        else:
+          expectedShape = (numRows,) + tuple(shapes[colIndex])
+        if column.shape != expectedShape:
+          return False
+        elif types[colIndex] == 'string':
+          if column.dtype.kind != 'S':
+            return False
+        elif types[colIndex] == 'utc_datetime':
+          if column.dtype.name != 'float64':
+            return False
+        elif column.dtype.name != types[colIndex]:
+          return False
+        columns.append(column)
+    except (TypeError, ValueError, IndexError):
+      return False
+    self.validatedColumns = columns
+    return True
+
   def _isRowValid(self, dataList):
     numIndeps = len(self.varDict["independents"]["names"])
     numDeps = len(self.varDict["dependents"]["names"])
@@ -1132,13 +1647,13 @@ class dataChest(dateStamp):
         return False
       elif type(paramUnits) != str and type(paramUnits) != np.string_:
         self.exception = ValueError("Parameter units must be type str.")
-      elif overwrite is False and paramName in self.file["parameters"].attrs.keys():
+      elif overwrite is False and paramName in self.file["parameters"].attrs:
         self.exception = RuntimeError(
           "Parameter name already exists. \r\n\t"
           +"Parameter values cannot be overwritten."
           )
         return False
-      elif overwrite is False and paramName in self.file["parameters"].keys():
+      elif overwrite is False and paramName in self.file["parameters"]:
         self.exception = RuntimeError(
           "Parameter name already exists. \r\n\t"
           +"Parameter values cannot be overwritten."
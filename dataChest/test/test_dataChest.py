@@ -0,0 +1,205 @@
+"""
+Tests for the dataChest write buffer and metadata cache.
+
+Run from the dataChest directory:
+    python -m pytest test
+"""
+
+import os
+import subprocess
+import sys
+import threading
+import time
+
+import mock
+import numpy as np
+import pytest
+
+import dataChest as dataChestModule
+from dataChest import dataChest
+
+
+@pytest.fixture
+def chest(tmpdir, monkeypatch):
+    monkeypatch.setenv('DATA_ROOT', str(tmpdir))
+    monkeypatch.setattr(dataChest, 'metadataCache',
+                        dataChestModule.collections.OrderedDict())
+    d = dataChest('test')
+    yield d
+    d.close()
+
+
+def _create(d, name='buffered'):
+    d.createDataset(name, [('x', [1], 'float64', 's')],
+                    [('y', [1], 'float64', 'V')])
+    return d.getDatasetName()
+
+
+def _wait_for(condition, timeout=5.0):
+    end = time.time() + timeout
+    while not condition():
+        assert time.time() < end, 'timed out'
+        time.sleep(0.01)
+
+
+def test_flush_on_close(chest):
+    name = _create(chest)
+    chest.enableWriteBuffer(flushInterval=60)
+    chest.addData([[1.0, 2.0], [3.0, 4.0]])
+    assert chest.bufferedRows == 2
+    chest.close()
+    chest.openDataset(name)
+    assert chest.getNumRows() == 2
+    assert np.array_equal(chest.getData(), [[1.0, 2.0], [3.0, 4.0]])
+
+
+def test_buffer_copies_rows(chest):
+    _create(chest)
+    chest.enableWriteBuffer(flushInterval=60)
+    data = np.array([[1.0, 2.0], [3.0, 4.0]])
+    chest.addData(data)
+    # The caller reuses its array before the buffer is committed.
+    data[:] = 99
+    chest.flush()
+    assert np.array_equal(chest.getData(), [[1.0, 2.0], [3.0, 4.0]])
+
+
+def test_failed_flush_keeps_rows(chest):
+    _create(chest)
+    chest.enableWriteBuffer(flushInterval=60)
+    chest.addData([[1.0, 2.0]])
+    chest.addData([[3.0, 4.0]])
+    with mock.patch.object(chest, '_writeColumns',
+                           side_effect=IOError('disk full')):
+        with pytest.raises(IOError):
+            chest.flush()
+    assert chest.bufferedRows == 2
+    chest.addData([[5.0, 6.0]])
+    chest.flush()
+    assert np.array_equal(chest.getData(),
+                          [[1.0, 2.0], [3.0, 4.0], [5.0, 6.0]])
+
+
+def test_background_flush_error(chest):
+    _create(chest)
+    chest.enableWriteBuffer(flushInterval=60)
+    chest.addData([[1.0, 2.0]])
+    with mock.patch.object(chest, '_writeColumns',
+                           side_effect=IOError('disk full')):
+        chest.flushEvent.set()
+        _wait_for(lambda: chest.writerException is not None)
+    # The error is reported by the next call, and the rows are kept.
+    with pytest.raises(IOError):
+        chest.addData([[3.0, 4.0]])
+    assert chest.bufferedRows == 1
+    chest.flush()
+    assert np.array_equal(chest.getData(), [[1.0, 2.0]])
+
+
+def test_file_swap_holds_file_lock(chest):
+    first = _create(chest, 'first')
+    chest.enableWriteBuffer(flushInterval=60)
+    chest.addData([[1.0, 2.0]])
+    held = []
+
+    def checkLock(original):
+        def wrapper(*args, **kwargs):
+            # Another thread, such as the flusher, must block here.
+            acquired = []
+            thread = threading.Thread(
+                target=lambda: acquired.append(chest.fileLock.acquire(False)))
+            thread.start()
+            thread.join()
+            if acquired[0]:
+                chest.fileLock.release()
+            held.append(not acquired[0])
+            return original(*args, **kwargs)
+        return wrapper
+
+    for method in ['_releaseCurrentFile', '_initDataset', '_openCachedFile']:
+        setattr(chest, method, checkLock(getattr(chest, method)))
+    _create(chest, 'second')
+    chest.openDataset(first)
+    assert held == [True]*4
+    assert chest.getNumRows() == 1
+
+
+def test_release_closes_file(chest):
+    first = _create(chest, 'first')
+    path = chest.currentHDF5Filename
+    chest.addData([[1.0, 2.0]])
+    handle = chest.file
+    _create(chest, 'second')
+    assert not handle.id.valid
+    # Metadata of a file that was written to is not cached.
+    assert path not in dataChest.metadataCache
+    chest.openDataset(first, grapher1=True)
+    handle = chest.file
+    chest.getParameterList()
+    _create(chest, 'third')
+    assert not handle.id.valid
+    assert dataChest.metadataCache[path]['paramNames'] == []
+
+
+def test_cached_metadata_reused(chest):
+    first = _create(chest, 'first')
+    path = chest.currentHDF5Filename
+    chest.addParameter('gain', 2.0)
+    _create(chest, 'second')
+    chest.openDataset(first, grapher1=True)
+    assert chest.getParameter('gain') == 2.0
+    _create(chest, 'third')
+    cached = dataChest.metadataCache[path]
+    with mock.patch.object(chest, '_convertElementsToLists') as parse:
+        chest.openDataset(first, grapher1=True)
+    assert not parse.called
+    assert chest.paramCache is cached['paramCache']
+    assert chest.getVariables() == [[('x', [1], 'float64', 's')],
+                                    [('y', [1], 'float64', 'V')]]
+    assert chest.getParameter('gain') == 2.0
+    # Opening the file to modify it always reads its metadata again.
+    _create(chest, 'fourth')
+    with mock.patch.object(chest, '_convertElementsToLists',
+                           wraps=chest._convertElementsToLists) as parse:
+        chest.openDataset(first, modify=True)
+    assert parse.called
+
+
+def test_metadata_cache_eviction(chest, monkeypatch):
+    monkeypatch.setattr(dataChestModule, 'METADATA_CACHE_SIZE', 2)
+    names = [_create(chest, 'set{}'.format(i)) for i in range(3)]
+    paths = []
+    for name in names:
+        chest.openDataset(name, grapher1=True)
+        paths.append(chest.currentHDF5Filename)
+    _create(chest, 'set3')
+    # The least recently used entry is evicted.
+    assert list(dataChest.metadataCache.keys()) == paths[1:]
+
+
+_WRITER = """
+import dataChest
+d = dataChest.dataChest('test')
+d.openDataset(%r, modify=True)
+d.addData([[3.0, 4.0]])
+d.addParameter('written', 1)
+d.close()
+"""
+
+
+def test_other_process_can_write(chest, tmpdir):
+    first = _create(chest, 'first')
+    chest.addData([[1.0, 2.0]])
+    chest.openDataset(first, grapher1=True)
+    assert chest.getParameterList() == []
+    _create(chest, 'second')
+    # A process writing to the file we moved away from is not locked out.
+    env = dict(os.environ, DATA_ROOT=str(tmpdir))
+    subprocess.check_call([sys.executable, '-c', _WRITER % first],
+                          cwd=os.path.dirname(
+                              os.path.abspath(dataChestModule.__file__)),
+                          env=env)
+    # Its changes are seen instead of the cached metadata.
+    chest.openDataset(first, grapher1=True)
+    assert chest.getParameterList() == ['written']
+    assert np.array_equal(chest.getData(), [[1.0, 2.0], [3.0, 4.0]])
@@ -0,0 +1,230 @@
+"""
+Benchmark the throughput of the GHz FPGA server.
+
+Runs run_sequence on an FPGAServer whose board group talks to emulated
+boards (see fpgalib.emulator) instead of a direct ethernet server. The sweep
+covers the number of DAC and ADC boards, the number of reps, memory (build
+8, pageable) vs jump table (build 15, not pageable) DACs, and ADC demodulate
+vs average mode. For each case we report points per second and the median
+time of each stage of BoardGroup.run.
+
+With the default time scale of 0 the emulated boards finish instantly, so
+this measures the cost of the server itself: building packets, uploading,
+reading and extracting data. The emulated boards then do their own work
+while the run packets are sent, which shows up in the trigger stage. Use
+--time-scale 1 to include modeled sequence run times and --latency to delay
+each direct ethernet request.
+
+Example:
+    python fpga_benchmark.py --dacs 1 4 16 --adcs 0 2 --reps 30 3000 30000 \\
+        --csv benchmark.csv
+"""
+
+import argparse
+import collections
+import itertools
+import os
+import sys
+import time
+
+import numpy as np
+from twisted.internet import task
+from twisted.internet.defer import inlineCallbacks, returnValue
+
+import fpgalib.emulator as emulator
+import fpgalib.fpga as fpga
+import ghz_fpga_server
+
+GROUP = 'Bench'
+# Memory sequence for pageable DACs: time a 10 us delay.
+MEMORY = [0x400000, 0x3000F9, 0x400001, 0xF00000]
+SRAM_WORDS = 1024
+# Four demodulators, each triggered 4 times per rep.
+TRIGGER_TABLE = [(4, 100, 50, 4)]
+DEMODS = 4
+
+Case = collections.namedtuple('Case', 'dacs adcs dacBuild adcMode reps')
+
+
+def _parse_arguments():
+    parser = argparse.ArgumentParser(description='Benchmark run_sequence '
+            'on emulated GHz FPGA boards.')
+    parser.add_argument('--dacs', type=int, nargs='+', default=[1, 4, 16],
+            help='numbers of DAC boards')
+    parser.add_argument('--adcs', type=int, nargs='+', default=[0, 1],
+            help='numbers of ADC boards')
+    parser.add_argument('--reps', type=int, nargs='+',
+            default=[30, 3000, 30000], help='reps per point')
+    parser.add_argument('--dac-builds', type=int, nargs='+', default=[8, 15],
+            help='DAC builds: 8 is pageable, 15 uses jump tables')
+    parser.add_argument('--adc-modes', nargs='+',
+            default=['demodulate', 'average'], help='ADC run modes')
+    parser.add_argument('--points', type=int, default=20,
+            help='points to run for each case')
+    parser.add_argument('--same-sequence', action='store_true',
+            help='run the same SRAM every point, so uploads are cached')
+    parser.add_argument('--latency', type=float, default=0.0,
+            help='latency of each direct ethernet request in seconds')
+    parser.add_argument('--time-scale', type=float, default=0.0,
+            help='factor applied to modeled board run times')
+    parser.add_argument('--csv', default=None,
+            help='file to append results to')
+    parser.add_argument('--verbose', action='store_true',
+            help='show output from the server')
+    return parser.parse_args()
+
+
+def cases(args):
+    """All combinations of the swept parameters."""
+    for dacs, adcs, build, reps in itertools.product(
+            args.dacs, args.adcs, args.dac_builds, args.reps):
+        for mode in (args.adc_modes if adcs else [None]):
+            yield Case(dacs, adcs, build, mode, reps)
+
+
+@inlineCallbacks
+def makeServer(case, latency, timeScale):
+    """Make an FPGA server with one board group of emulated boards.
+
+    Returns the server, the board group and the names of the boards, DACs
+    first so that the first DAC is master.
+    """
+    server = ghz_fpga_server.FPGAServer()
+    server.devices = {}
+    server.boardGroups = {}
+    # Not connected to labrad, so there is no client for setup packets.
+    server.client = None
+    de = emulator.DirectEthernetEmulator(timeScale=timeScale)
+    bg = ghz_fpga_server.BoardGroup(server, de, 0)
+    server.boardGroups[de._labrad_name, 0] = bg
+    yield bg.init()
+    boards = ([('DAC', n, case.dacBuild) for n in range(1, case.dacs + 1)] +
+              [('ADC', case.dacs + n, 7) for n in range(1, case.adcs + 1)])
+    bg.configure(GROUP, [('{} {}'.format(kind, n), 0)
+                         for kind, n, build in boards])
+    names = []
+    for guid, (kind, n, build) in enumerate(boards):
+        if kind == 'DAC':
+            de.addBoard(emulator.DacEmulator(n, build))
+        else:
+            de.addBoard(emulator.AdcEmulator(n, build))
+        name = '{} {} {}'.format(GROUP, kind, n)
+        dev = fpga.REGISTRY[kind, build](guid, name)
+        yield dev.connect(name, bg, de, 0, n, build)
+        server.devices[dev.guid] = dev
+        server.devices[dev.name] = dev
+        names.append(name)
+    # Only sequences see the latency, not the setup above.
+    de.latency = latency
+    returnValue((server, bg, names))
+
+
+def configure(server, c, case, names):
+    """Set up a sequence on all boards in context c.
+
+    Returns whether there is any timing data to get back.
+    """
+    dacs = [name for name in names if ' DAC ' in name]
+    adcs = [name for name in names if ' ADC ' in name]
+    for name in dacs:
+        server.select_device(c, name)
+        if case.dacBuild == 15:
+            server.jump_table_clear(c)
+            server.jump_table_add_entry(c, 'END', SRAM_WORDS)
+        else:
+            server.dac_memory(c, MEMORY)
+        server.dac_sram(c, np.zeros(SRAM_WORDS, dtype='<u4'))
+    for name in adcs:
+        server.select_device(c, name)
+        server.adc_run_mode(c, case.adcMode)
+        server.start_delay(c, 0)
+        server.adc_trigger_table(c, TRIGGER_TABLE)
+        for channel in range(DEMODS):
+            server.adc_mixer_table(c, channel,
+                                   np.zeros((256, 2), dtype=int))
+    server.sequence_boards(c, names)
+    if adcs and case.adcMode == 'demodulate':
+        timingOrder = ['{}::{}'.format(name, channel)
+                       for name in adcs for channel in range(DEMODS)]
+    elif adcs:
+        timingOrder = adcs
+    elif case.dacBuild != 15:
+        timingOrder = dacs[:1]
+    else:
+        timingOrder = []  # Jump table DACs return no timing data.
+    server.sequence_timing_order(c, timingOrder)
+    return bool(timingOrder)
+
+
+@inlineCallbacks
+def runCase(case, args):
+    """Run one case. Returns points per second and median stage times."""
+    server, bg, names = yield makeServer(case, args.latency, args.time_scale)
+    c = server.newContext(1)
+    server.initContext(c)
+    getTimingData = configure(server, c, case, names)
+    # Warm up, so one-time costs are not counted.
+    yield server.run_sequence(c, case.reps, getTimingData)
+    bg.stageTimes.clear()
+    sram = np.zeros(SRAM_WORDS, dtype='<u4')
+    server.select_device(c, names[0])
+    start = time.time()
+    # Start all points at once, so the board group can pipeline them.
+    points = []
+    for i in range(args.points):
+        if not args.same_sequence:
+            sram[0] = i + 1
+            server.dac_sram(c, sram)
+        points.append(server.run_sequence(c, case.reps, getTimingData))
+    for point in points:
+        yield point
+    elapsed = time.time() - start
+    stages = dict((stage, ps[0]) for stage, count, ps, maxTime
+                  in bg.stageTimes.percentiles([50]))
+    returnValue((args.points / elapsed, stages))
+
+
+@inlineCallbacks
+def main(reactor, args):
+    header = list(Case._fields) + ['pointsPerSec'] + [
+            stage + '_median' for stage in ghz_fpga_server.PIPELINE_STAGES]
+    csvFile = None
+    if args.csv:
+        newFile = not os.path.isfile(args.csv)
+        csvFile = open(args.csv, 'a')
+        if newFile:
+            csvFile.write(','.join(header) + '\n')
+    print('{:>5} {:>5} {:>5} {:>10} {:>6} {:>10}  {}'.format(
+            'dacs', 'adcs', 'build', 'adcMode', 'reps', 'points/s',
+            'slowest stages (median ms)'))
+    try:
+        for case in cases(args):
+            stdout = sys.stdout
+            if not args.verbose:
+                sys.stdout = open(os.devnull, 'w')
+            try:
+                rate, stages = yield runCase(case, args)
+            finally:
+                if sys.stdout is not stdout:
+                    sys.stdout.close()
+                    sys.stdout = stdout
+            slowest = sorted(stages.items(), key=lambda x: -x[1])[:3]
+            print('{:>5} {:>5} {:>5} {:>10} {:>6} {:>10.1f}  {}'.format(
+                    case.dacs, case.adcs, case.dacBuild, case.adcMode or '-',
+                    case.reps, rate,
+                    ', '.join('{} {:.2f}'.format(stage, t * 1e3)
+                              for stage, t in slowest)))
+            if csvFile is not None:
+                fields = [str(x) if x is not None else '' for x in case]
+                fields += ['{:.3f}'.format(rate)]
+                fields += ['{:.6f}'.format(stages[stage])
+                           for stage in ghz_fpga_server.PIPELINE_STAGES]
+                csvFile.write(','.join(fields) + '\n')
+                csvFile.flush()
+    finally:
+        if csvFile is not None:
+            csvFile.close()
+
+
+if __name__ == '__main__':
+    task.react(main, [_parse_arguments()])
@@ -11,7 +11,7 @@ from labrad.devices import DeviceWrapper
 from labrad import types as T
 import labrad.support
 
-from fpgalib.util import littleEndian, TimedLock
+from fpgalib.util import littleEndian, TimedLock, contentHash
 
 import fpgalib.mondict as mondict
 
@@ -68,6 +68,9 @@ class ADC(fpga.FPGA):
         self.devName = name
         self.serverName = de._labrad_name
         self.timeout = T.Value(1, 's')
+        # Content hash and packet data of the last trigger and mixer tables,
+        # by table name. See ADC_Branch2.cachedTable.
+        self.tableCache = {}
 
         # Set up our context with the ethernet server.
         # This context is expired when the device shuts down.
@@ -153,7 +156,20 @@ class ADC(fpga.FPGA):
 
 
 class AdcRunner(object):
-    pass
+
+    def loadHashes(self):
+        """Content hashes of the parts of our load packet, by part name.
+
+        ADC load packets carry no board memory, so nothing is cached.
+        """
+        return {}
+
+    def streamPacket(self, seqTime, ctx, timingOrder):
+        """Create a StreamingRead to use instead of collect and read.
+
+        Returns None if data should be collected and read the usual way.
+        """
+        return None
 
 
 class ADC_Branch1(ADC):
@@ -206,6 +222,9 @@ class ADC_Branch1(ADC):
             regs = self.regSerial(d)
             yield self._sendRegisters(regs, readback=False)
     
+    def _initPLL(self):
+        return self._runSerial([0x1FC093, 0x1FC092, 0x100004, 0x000C11])
+    
     # Externally available board communication methods
     # These run in test mode.
     
@@ -216,12 +235,6 @@ class ADC_Branch1(ADC):
             yield self._sendRegisters(regs, readback=False)
         return self.testMode(func)
     
-    def initPLL(self):
-        @inlineCallbacks
-        def func():
-            yield self._runSerial([0x1FC093, 0x1FC092, 0x100004, 0x000C11])
-        return self.testMode(func)
-    
     def runCalibrate(self):
         raise Exception("Depricated. Use recalibrate instead")
         @inlineCallbacks
@@ -655,6 +668,21 @@ class AdcRunner_Build7(AdcRunner_Build2):
         # print("ADC run packet: %s" % (regs,))
         return regs    
     
+    def streamPacket(self, seqTime, ctx, timingOrder):
+        """
+        Read demodulated data in chunks while the sequence runs, if there is
+        enough of it to be worth it. The result is the same as extract.
+        """
+        keep = any(s.startswith(self.dev.devName) for s in timingOrder)
+        if (not keep or self.runMode != 'demodulate' or
+                self.nPackets <= fpga.STREAM_CHUNK_PACKETS):
+            return None
+        # Whole demod packets are kept, since extract needs the counters too.
+        decoder = fpga.PacketDecoder(
+                self.nPackets, 0, self.dev.DEMOD_PACKET_LEN + 2, 'u1',
+                self.extract)
+        return self.dev.streamRead(self.nPackets, seqTime, ctx, decoder)
+    
     def extract(self, packets):
         """Extract data coming back from a readPacket."""
         if self.runMode == 'average':
@@ -703,6 +731,14 @@ class ADC_Branch2(ADC):
         ...
         d(1025)sram(+1022)[7..0]	spare
 
+        """
+        p.write(cls.triggerTableData(triggerTable))
+
+    @classmethod
+    def triggerTableData(cls, triggerTable):
+        """Get the SRAM write packet for a trigger table, as a byte string.
+
+        See makeTriggerTable for the packet format.
         """
         # takes trigger table and turns it into a packet for ADC
         
@@ -722,37 +758,28 @@ class ADC_Branch2(ADC):
             else:
                 raise Exception("rlen < 50 clock cycles (200 ns) can cause FIFO backup for 12 chans")
         
-        data = np.zeros(cls.SRAM_RETRIGGER_PKT_LEN, dtype='<u1')
-        
-        data[0] = 0 # SRAM page for start address: middle bits = 0,
-        data[1] = 0 # upper bits; size of SRAM implies bits [23..19] = 0
+        # WARNING: rchan defined in a funny way
+        # if you want a trigger to measure a subset of channels,
+        # those channels must be the lowest channels.
+        # i.e. you can only read out:
+        # (0, 0-1, 0-2, ... 0-11)
+        # you cannot cherry pick which channels to read out 
+        # as far as JK and TW understand it.
+        # For now, we will not make use of rchan,
+        # rather default it all channels always read out.
+        table = np.asarray(triggerTable, dtype=int).reshape(-1, 4)
+        count, delay, length, chans = table.T
+        # One row of four 16 bit words per entry. See documentation above,
+        # and compensate for FPGA offsets.
+        entries = np.zeros((len(table), 4), dtype='<u2')
+        entries[:, 0] = count - 1
+        entries[:, 1] = delay - 4
+        entries[:, 2] = ((length - 1) & 0xFF) + ((chans & 0xFF) << 8)
         
-        for idx,entry in enumerate(triggerTable):
-            currCount, currDelay, currLength, currChans = entry
-            
-            # WARNING: currChans defined in a funny way
-            # if you want a trigger to measure a subset of channels,
-            # those channels must be the lowest channels.
-            # i.e. you can only read out:
-            # (0, 0-1, 0-2, ... 0-11)
-            # you cannot cherry pick which channels to read out 
-            # as far as JK and TW understand it.
-            # For now, we will not make use of currChans(rchan),
-            # rather default it all channels always read out.
-            
-            # See documentation above
-            currCount -= 1 # compensate for FPGA offsets
-            currDelay -= 4 # compensate for FPGA offsets
-            currLength -=1 # compensate for FPGA offsets
-            
-            midx = idx * 8 + 2
-            data[midx:midx+2] = littleEndian(currCount, 2)
-            data[midx+2:midx+4] = littleEndian(currDelay, 2)
-            data[midx+4] = currLength
-            data[midx+5] = currChans
-            data[midx+6:midx+8] = littleEndian(0, 2) # spare
-        
-        p.write(data.tostring())
+        data = np.zeros(cls.SRAM_RETRIGGER_PKT_LEN, dtype='<u1')
+        # SRAM page for start address is 0, in data[0:2]
+        data[2:2 + entries.nbytes] = entries.view('<u1').reshape(-1)
+        return data.tostring()
         
     @classmethod
     def makeMixerTable(cls, demods, p):
@@ -781,16 +808,35 @@ class ADC_Branch2(ADC):
         """
 
         for idx,demod in enumerate(demods):
-            data = np.zeros(cls.SRAM_MIXER_PKT_LEN, dtype='<i1')
-            # retrigger table is page 0, mixer tables are pages 1-13, factor of 4 from stripping least significant bits
-            data[0:2] = littleEndian((idx+1),2) # SRAM page address
-            mixerTable = demod['mixerTable']
-            for tidx, row in enumerate(mixerTable):
-                I, Q = row
-                data[(tidx*2)+2] = I
-                data[(tidx*2+1)+2] = Q
-                
-            p.write(data.tostring())
+            p.write(cls.mixerTableData(idx, demod['mixerTable']))
+
+    @classmethod
+    def mixerTableData(cls, idx, mixerTable):
+        """Get the SRAM write packet for the mixer table of demodulator idx.
+
+        mixerTable is an Nx2 array of (I, Q) values. See makeMixerTable for
+        the packet format.
+        """
+        data = np.zeros(cls.SRAM_MIXER_PKT_LEN, dtype='<i1')
+        # retrigger table is page 0, mixer tables are pages 1-13, factor of 4 from stripping least significant bits
+        data[0:2] = littleEndian((idx+1),2) # SRAM page address
+        # I and Q interleaved
+        iq = np.asarray(mixerTable, dtype=int).reshape(-1)
+        data[2:2 + len(iq)] = iq
+        return data.tostring()
+
+    def cachedTable(self, name, table, makeData):
+        """Get the content hash and packet data for a trigger or mixer table.
+
+        makeData(table) makes the packet data. The last table under each
+        name is remembered, so unchanged tables aren't rebuilt every point.
+        """
+        key = contentHash(table, dtype='<i4')
+        cached = self.tableCache.get(name)
+        if cached is None or cached[0] != key:
+            cached = (key, makeData(table))
+            self.tableCache[name] = cached
+        return cached
         
     # board communication (can be called from within test mode)
     
@@ -801,6 +847,9 @@ class ADC_Branch2(ADC):
             regs = self.regSerial(d)
             yield self._sendRegisters(regs, readback=False)
     
+    def _initPLL(self):
+        return self._runSerial([0x1FC093, 0x1FC092, 0x100004, 0x000C11])
+    
     # Externally available board communication methods
     # These run in test mode.
     
@@ -811,12 +860,6 @@ class ADC_Branch2(ADC):
             yield self._sendRegisters(regs, readback=False)
         return self.testMode(func)
     
-    def initPLL(self):
-        @inlineCallbacks
-        def func():
-            yield self._runSerial([0x1FC093, 0x1FC092, 0x100004, 0x000C11])
-        return self.testMode(func)
-    
     # Utility
     
     @staticmethod
@@ -916,14 +959,21 @@ class ADC_Build7(ADC_Branch2):
         triggerTable = info['triggerTable']
         demods = [info[idx] for idx in range(self.DEMOD_CHANNELS) if idx in info]
         
-        # demods = [info[idx] for idx in range(self.DEMOD_CHANNELS) if idx in info]
         p = self.makePacket("setup")
-        self.makeTriggerTable(triggerTable, p)
-        self.makeMixerTable(demods, p)
+        key, data = self.cachedTable('triggerTable', triggerTable,
+                                     self.triggerTableData)
+        p.write(data)
+        states = ['triggerTable=%s' % key.encode('hex')]
+        for idx, demod in enumerate(demods):
+            makeData = lambda table: self.mixerTableData(idx, table)
+            key, data = self.cachedTable('mixTable%d' % idx,
+                                         demod['mixerTable'], makeData)
+            p.write(data)
+            states.append('mixTable%d=%s' % (idx, key.encode('hex')))
         
-        triggerTableState = " ".join(['triggerTableState%d=%s' % (idx, triggerTable[idx]) for idx in range(len(triggerTable)) ])
-        mixTableState = " ".join(['mixTable%d=%s' % (idx, demod['mixerTable']) for idx,demod in enumerate(demods) ])
-        setupState = " ".join([triggerTableState,mixTableState])
+        # The setup state identifies the tables by content, so the board
+        # group skips this packet when the same tables are already loaded.
+        setupState = " ".join([self.devName] + states)
         return p, setupState
     
     # Direct ethernet server packet update methods
@@ -1068,6 +1118,11 @@ class ADC_Build7(ADC_Branch2):
         
         Returns a tuple of (demodData, packet counters, readback counters)
         
+        packets is a list of byte strings, or a 2D uint8 array with one
+        packet per row. The counters are arrays with one entry for every
+        packet, in the order received, so dropped or reordered packets can be
+        spotted.
+        
         demodData is a 3-index numpy array with the following indices:
             0: channel
             1: stat
@@ -1122,8 +1177,6 @@ class ADC_Build7(ADC_Branch2):
         d(47)	spare [7..0]		
         
         """
-        #stick all data strings in packets together, chopping out last 4 bytes
-        #from each string
         rchans = [trig[3] for trig in triggerTable]
         nTrigger = [trig[0] for trig in triggerTable]
              
@@ -1137,69 +1190,38 @@ class ADC_Build7(ADC_Branch2):
         else:
             rchan = rchans[0]
         
+        if mode != 'iq':
+            # In bit readout mode (rchan=0) each of the 44 data bytes is the
+            # sign bits of channels 0 to 7 for one trigger, [ch7..ch0].
+            raise RuntimeError('Operation mode %s not implemented / available' % (mode,))
+        
         totalTriggers = np.sum(nTrigger)
-        # pkt_per_stat = int(np.ceil((totalTriggers * rchan * 2.0)/cls.DEMOD_CHANNELS_PER_PACKET))
         pkt_per_stat = int(np.ceil((totalTriggers * rchan)/float(cls.DEMOD_CHANNELS_PER_PACKET)))
-        # print 'totalTriggers: %s, rchan: %s, DEMOD_CHANNELS_PER_PACKET: %s' % (totalTriggers, rchan, cls.DEMOD_CHANNELS_PER_PACKET)
-        reps = len(packets)//pkt_per_stat
-        if len(packets) % pkt_per_stat:
-            raise RuntimeError("wrong number of packets: %d not a multiple of pkt_per_stat: %d" % (len(packets), pkt_per_stat))
-
         
-        # Puke all over the console output.
-        #print "extract demod packets.  Total triggers: %d, rchan: %d" % (totalTriggers, rchan)
-        #for p in packets:
-        #    print "len: %d" % (len(p),)
-        #    print labrad.support.hexdump(p)
-        # print "total packets: %s, packets_per_stat: %s, reps: %s" % (len(packets), pkt_per_stat, reps)
+        # One row of bytes per packet.
+        pktLen = cls.DEMOD_PACKET_LEN + 2
+        if isinstance(packets, np.ndarray):
+            raw = packets[:, :pktLen]
+        else:
+            raw = np.frombuffer(''.join(data[:pktLen] for data in packets),
+                                dtype='<u1').reshape(-1, pktLen)
+        reps = len(raw)//pkt_per_stat
+        if len(raw) % pkt_per_stat:
+            raise RuntimeError("wrong number of packets: %d not a multiple of pkt_per_stat: %d" % (len(raw), pkt_per_stat))
         
-        stat_pkt_list = [packets[idx*pkt_per_stat:pkt_per_stat*(idx+1)] for idx in range(reps)]
-        # print "len of stat_pkt_list: %d, len stat_packet 0: %d" % (len(stat_pkt_list),len(stat_pkt_list[0]))
-        all_data = []
-        for stat_packet in stat_pkt_list:
-            data = np.fromstring(''.join(data[:44] for data in stat_packet), dtype='<u1')
-            pktCounters = [ord(pkt[46]) for pkt in stat_packet]
-            readbackCounters = [ ord(pkt[44]) + ord(pkt[45])<<8 for pkt in stat_packet ]
-            #print "packet counters: %s, readback counters: %s" % (pktCounters, readbackCounters)
-            if mode=='iq':
-                # Convert to 16-bit int array and chop garbage from last packet
-                vals = np.fromstring(data, dtype='<i2')[:2*rchan*totalTriggers] 
-                # Slowest varying index: time step, next slowest index : demodulator, fastest index: I vs Q
-                #  Transpose first two indices to make demodulator first index 
-                # Iq0[t=0], Qq0[t=0], Iq1[t=0], Qq1[t=0], Iq0[t=1], Qq0[t=1], Iq1[t=1], Qq1[t=1]
-                #    
-                #     goes to:
-                # data[qubit][time_step][(I=0 | Q=1)]       
-                #print "flat values: ", vals
-                reshapedData = vals.reshape(totalTriggers , rchan, 2).astype(int)
-                #print "reshaped data: ", reshapedData
-                transposedData = reshapedData.transpose((1, 0, 2))
-                #print "transposed data: ", transposedData
-                all_data.append(transposedData)
-            else:
-                '''
-                In bit readout mode, use rchan[7..0]=0.  Readout is only the sign bit of channels 0 to 7; one byte readout is designed for compactness to minimize number of Ethernet packets.  The bit is 0 if real quadrature of the channel is positive.  Bit is flipped with XOR mask bitflip[7..0] defined in register write.  Order of bits in output byte is [ch7..ch0].
-
-                l(0)	length[15..8]		set to 0
-                l(1)	length[7..0]		set to 48
-
-                d(0)	bits1[7..0]		1st bitstring
-                d(1)	bits2[7..0]		2nd bitstring
-                ...	
-                d(43)	bits44[7..0]		44th bitstring
-
-                d(44)	countrb[7..0]		Running count of triggers since last start
-                d(45)	countrb[15..8]		   1st readback has countrb=1
-                d(46)	countpack[7..0]	Packet counter for retriggering, reset when countrb incr
-                d(47)	spare [7..0]		   
-                '''
-                raise RuntimeError('Operation mode %s not implemented / available' % (mode,))
-        #print "all data length: %d, element 0 size: %s" % (len(all_data), all_data[0].shape)
-        # This makes stat the first index, giving us: data[stat][qubit][time_step][(I=0 | Q=1)]
-        all_data = np.array(all_data)
-        # data[stat][qubit][time_step][(I=0 | Q=1)] --> data[qubit][stat][time_step][(I=0 | Q=1)]
-        all_data = all_data.transpose([1, 0, 2, 3])
-        #print "all_data shape: ", all_data.shape
-        return (all_data, pktCounters, readbackCounters)  # Only returning the packet counters of the last stat.  FIXME if you care about these
+        pktCounters = raw[:, 46].astype(int)
+        readbackCounters = raw[:, 44].astype(int) + (raw[:, 45].astype(int) << 8)
+        
+        # 11 I/Q pairs of 16-bit ints per packet. Within a stat, the slowest
+        # varying index is time step, then demodulator, then I vs Q. The last
+        # packet of each stat is padded with garbage, which we chop off.
+        vals = np.ascontiguousarray(raw[:, :44]).view('<i2')
+        vals = vals.reshape(reps, pkt_per_stat * 2 * cls.DEMOD_CHANNELS_PER_PACKET)
+        vals = vals[:, :2*rchan*totalTriggers]
+        # data[stat][time_step][qubit][(I=0 | Q=1)]
+        # --> data[qubit][stat][time_step][(I=0 | Q=1)]
+        all_data = vals.reshape(reps, totalTriggers, rchan, 2).astype(int)
+        all_data = all_data.transpose([2, 0, 1, 3])
+        return (all_data, pktCounters, readbackCounters)
 
 fpga.REGISTRY[('ADC', 7)] = ADC_Build7
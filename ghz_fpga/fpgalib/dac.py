@@ -25,7 +25,7 @@ import numpy as np
 from twisted.internet.defer import inlineCallbacks, returnValue
 from labrad import types as T
 
-from fpgalib.util import littleEndian
+from fpgalib.util import littleEndian, contentHash
 import fpgalib.fpga as fpga
 import fpgalib.jump_table as jump_table
 
@@ -93,6 +93,10 @@ class InvalidBoardVersion(Exception):
 
 # Time for master to delay before SRAM to ensure synchronization
 MASTER_SRAM_DELAY_US = 2
+# Rep time assumed for jump tables that never reach END
+JT_UNKNOWN_REP_TIME = 100e-6
+# SRAM words (1 ns each) played per 25 MHz memory clock cycle
+SRAM_WORDS_PER_CYCLE = 40
 
 
 class DAC(fpga.FPGA):
@@ -205,10 +209,14 @@ class DAC(fpga.FPGA):
         regs[46] = 0x80  #Set d[7..0] to 10000000 = reset 1GHz PLL pulse
         return regs
 
-    def resetPLL(self):
+    def _resetPLL(self):
         """Reset PLL"""
         raise NotImplementedError()
 
+    def resetPLL(self):
+        """Reset PLL"""
+        return self.testMode(self._resetPLL)
+
     # Methods to get byte arrays to be written to the board
 
     def _sendSRAM(self, data):
@@ -230,34 +238,51 @@ class DAC(fpga.FPGA):
                If less than a full derp is written, the rest of the derp is
                populated with zeros.
         """
-        assert 0 <= derp < cls.SRAM_WRITE_DERPS, \
-            "SRAM derp out of range: %d" % derp
         assert 0 < len(data) <= cls.SRAM_WRITE_PKT_LEN, \
             "Tried to write %d words to SRAM derp" % len(data)
-        data = np.asarray(data)
+        return cls.pktsWriteSram(derp, data)[0]
+
+    @classmethod
+    def pktsWriteSram(cls, derp, data):
+        """DAC packets to write consecutive derps of SRAM, starting at derp
+
+        Returns a 2D uint8 array with one row per derp. Each row is a
+        complete SRAM write packet: two bytes of write address (derp)
+        followed by SRAM_WRITE_PKT_LEN words of data. The whole array is
+        built with a single copy of the SRAM data, rather than one set of
+        strided byte assignments per derp.
+
+        derp - int: First derp to write, ie address in SRAM
+        data - ndarray: array of SRAM words in <u4 format. The last derp is
+               padded with zeros if data does not fill it.
+        """
+        # Same low 32 bits as masking with 0xFF after each shift.
+        words = np.asarray(data).astype('<u4', copy=False)
+        wordBytes = np.ascontiguousarray(words).view('<u1')
+        bytesPerDerp = 4 * cls.SRAM_WRITE_PKT_LEN
+        nDerps = -(-len(words) // cls.SRAM_WRITE_PKT_LEN)
+        assert 0 <= derp and derp + nDerps <= cls.SRAM_WRITE_DERPS, \
+            "SRAM derp out of range: %d" % (derp + nDerps - 1)
         # Packet length is data length plus two bytes for write address (derp)
-        pkt = np.zeros(1026, dtype='<u1')
+        pkts = np.zeros((nDerps, 2 + bytesPerDerp), dtype='<u1')
         # DAC firmware assumes SRAM write address lowest 8 bits = 0, so here
         # we're only setting the middle and high byte. This is good, because
         # it means that each time we increment derp by 1, we increment our
         # SRAM write address by 256, ie. one derp.
-        pkt[0] = (derp >> 0) & 0xFF
-        pkt[1] = (derp >> 8) & 0xFF
-        # Each sram word is four bytes long
-        # Our data as coming from makeSram is a np array of 4 byte integers
-        # with low bytes first. Because of this you would think that
-        # (data>>24)&0xFF is the least significant bytes. However, python
-        # thinks for you, and it turns out that data>>24 is the most
-        # significant byte. Go figure. The DAC expects the data with
-        # least significant byte first in each word.
-        # Note that if len(data)<SRAM_WRITE_PKT_LEN, ie. smaller than a full
-        # derp, we only take as much data as actually exists.
-
-        pkt[2:2 + len(data) * 4:4] = (data >> 0) & 0xFF  # Least sig. byte
-        pkt[3:3 + len(data) * 4:4] = (data >> 8) & 0xFF
-        pkt[4:4 + len(data) * 4:4] = (data >> 16) & 0xFF
-        pkt[5:5 + len(data) * 4:4] = (data >> 24) & 0xFF  # Most sig. byte
-        return pkt
+        derps = np.arange(derp, derp + nDerps)
+        pkts[:, 0] = derps & 0xFF
+        pkts[:, 1] = (derps >> 8) & 0xFF
+        # The DAC expects the data with least significant byte first in each
+        # word, which is exactly the memory layout of a <u4 array. Full derps
+        # are copied in one block; the unused tail of a partial last derp
+        # stays zero.
+        nFull = len(words) // cls.SRAM_WRITE_PKT_LEN
+        pkts[:nFull, 2:] = wordBytes[:nFull * bytesPerDerp].reshape(
+            nFull, bytesPerDerp)
+        tail = wordBytes[nFull * bytesPerDerp:]
+        if len(tail):
+            pkts[nFull, 2:2 + len(tail)] = tail
+        return pkts
 
     @classmethod
     def pktWriteMem(cls, page, data):
@@ -300,19 +325,13 @@ class DAC(fpga.FPGA):
 
         Takes a list of memory commands and a page number and
         modifies the commands for calling SRAM to point to the
-        appropriate page.
+        appropriate page. Returns a new array of commands.
         """
-
-        def shiftAddr(cmd):
-            opcode, address = MemorySequence.getOpcode(cmd), \
-                              MemorySequence.getAddress(cmd)
-            if opcode in [0x8, 0xA]:
-                address += page * cls.SRAM_PAGE_LEN
-                return (opcode << 20) + address
-            else:
-                return cmd
-
-        return [shiftAddr(cmd) for cmd in cmds]
+        cmds = MemorySequence.asArray(cmds)
+        sramAddrs = MemorySequence.sramAddressMask(cmds)
+        shifted = cmds.copy()
+        shifted[sramAddrs] += page * cls.SRAM_PAGE_LEN
+        return shifted
 
     @staticmethod
     def getCommand(cmds, chan):
@@ -334,7 +353,21 @@ class DAC(fpga.FPGA):
 
 
 class DacRunner(object):
-    pass
+
+    def loadHashes(self):
+        """Content hashes of the parts of our load packet, by part name.
+
+        The board group uses these to skip uploading data that is already
+        resident on a board. An empty dict disables this for the runner.
+        """
+        return {}
+
+    def streamPacket(self, seqTime, ctx, timingOrder):
+        """Create a StreamingRead to use instead of collect and read.
+
+        Returns None if data should be collected and read the usual way.
+        """
+        return None
 
 
 class DacRunner_Build7(DacRunner):
@@ -342,7 +375,8 @@ class DacRunner_Build7(DacRunner):
         self.dev = dev
         self.reps = reps
         self.startDelay = startDelay
-        self.mem = mem
+        # Converted once, so the MemorySequence methods below use it as is.
+        self.mem = MemorySequence.asArray(mem)
         self.sram = sram
         self.blockDelay = None
         self._fixDualBlockSram()
@@ -425,6 +459,20 @@ class DacRunner_Build7(DacRunner):
             self.seqTime = fpga.TIMEOUT_FACTOR * (self.memTime * self.reps) + 1
         return self.dev.load(self.mem, self.sram, page)
 
+    def loadHashes(self):
+        """Content hashes of memory and SRAM, as sent by loadPacket."""
+        return {'mem': contentHash(self.mem), 'sram': contentHash(self.sram)}
+
+    def partialLoadPacket(self, page, skip):
+        """Create a load packet leaving out the parts named in skip.
+
+        Unlike loadPacket this has no side effects, so it can be called after
+        loadPacket once we know what is already resident on the board.
+        """
+        mem = None if 'mem' in skip else self.mem
+        sram = None if 'sram' in skip else self.sram
+        return self.dev.load(mem, sram, page)
+
     def setupPacket(self):
         """Create non-pipelined setup packet.  For DAC, does nothing."""
         return None
@@ -456,10 +504,27 @@ class DacRunner_Build7(DacRunner):
         return self.dev.read(self.nPackets) if keep else \
             self.dev.discard(self.nPackets)
 
+    def streamPacket(self, seqTime, ctx, timingOrder):
+        """
+        Read timing data in chunks while the sequence runs, if there is
+        enough of it to be worth it. The result is the same as extract.
+        """
+        keep = any(s.startswith(self.dev.devName) for s in timingOrder)
+        if not keep or self.nPackets <= fpga.STREAM_CHUNK_PACKETS:
+            return None
+        decoder = fpga.PacketDecoder(self.nPackets, 3, 63, '<u2',
+                                     lambda data: data.reshape(-1).astype('u4'))
+        return self.dev.streamRead(self.nPackets, seqTime, ctx, decoder)
+
     def extract(self, packets):
         """Extract timing data coming back from a readPacket."""
-        data = ''.join(data[3:63] for data in packets)
-        return np.fromstring(data, dtype='<u2').astype('u4')
+        if len(packets) != self.nPackets:
+            raise RuntimeError('Expected {} timing packets from {}, got {}'
+                               .format(self.nPackets, self.dev.devName,
+                                       len(packets)))
+        timings = fpga.packetRows(packets, 3, 3 + 2 * DAC.TIMING_PACKET_LEN,
+                                  '<u2')
+        return timings.astype('u4').reshape(-1)
 
 
 class DAC_Build7(DAC):
@@ -584,10 +649,16 @@ class DAC_Build7(DAC):
     # Direct ethernet server packet creation methods
 
     def load(self, mem, sram, page=0):
-        """Create a packet to write Memory and SRAM data to the FPGA."""
+        """Create a packet to write Memory and SRAM data to the FPGA.
+
+        Either mem or sram may be None, in which case it is left out of the
+        packet.
+        """
         p = self.makePacket()
-        self.makeMemory(mem, p, page=page)
-        self.makeSRAM(sram, p, page=page)
+        if mem is not None:
+            self.makeMemory(mem, p, page=page)
+        if sram is not None:
+            self.makeSRAM(sram, p, page=page)
         return p
 
     # Direct ethernet server packet update methods
@@ -599,22 +670,18 @@ class DAC_Build7(DAC):
         Build parameters like SRAM_PAGE_LEN are in units of SRAM words,
         each of which is 14+14+4=32 bits = 4 bytes long. Therefore the
         actual length of corresponding byte strings have a *4 multiplier.
+
+        The SRAM byte string is viewed in place as <u4 words and all derp
+        packets are laid out at once by pktsWriteSram, so long uploads cost
+        one pass over the data instead of one string slice per derp.
         """
-        bytesPerDerp = cls.SRAM_WRITE_PKT_LEN * 4
+        if not len(data):
+            return
         # Set starting write derp to the beginning of the chosen SRAM page
-        writeDerp = page * cls.SRAM_PAGE_LEN / cls.SRAM_WRITE_PKT_LEN
-        while len(data) > 0:
-            # Chop off enough data for one write packet. This is
-            # SRAM_WRITE_PKT_LEN words, which is 4x more bytes.
-            # WARNING! string reassignment. Maybe use a pointer instead
-            # Note that slicing a np array as myArray[:N], if N is larger
-            # than the length of myArray, returns the entirety of myArray
-            # and does NOT wrap around to the beginning
-            chunk, data = data[:bytesPerDerp], data[bytesPerDerp:]
-            chunk = np.fromstring(chunk, dtype='<u4')
-            dacPkt = cls.pktWriteSram(writeDerp, chunk)
+        writeDerp = page * cls.SRAM_PAGE_LEN // cls.SRAM_WRITE_PKT_LEN
+        words = np.frombuffer(data, dtype='<u4')
+        for dacPkt in cls.pktsWriteSram(writeDerp, words):
             p.write(dacPkt.tostring())
-            writeDerp += 1
 
     @classmethod
     def makeMemory(cls, data, p, page=0):
@@ -710,35 +777,161 @@ class DAC_Build7(DAC):
         ans = int(PHOF), success
         returnValue(ans)
 
-    # Externally available board communication methods
-    # These run in test mode.
-    # Should not be @classmethod
-
-    def initPLL(self):
+    @inlineCallbacks
+    def _initPLL(self):
         """Initial program  of PLL chip
-        
+
         I _believe_ this only has to be run once after the board has been
         powered on. DTS
         """
+        yield self._runSerial(1, [0x1FC093, 0x1FC092, 0x100004, 0x000C11])
+        #Run sram with startAddress=endAddress=0. Run once, no loop.
+        regs = self.regRunSram(0, 0, loop=False)
+        yield self._sendRegisters(regs, readback=False)
 
-        @inlineCallbacks
-        def func():
-            yield self._runSerial(1, [0x1FC093, 0x1FC092, 0x100004, 0x000C11])
-            #Run sram with startAddress=endAddress=0. Run once, no loop.
-            regs = self.regRunSram(0, 0, loop=False)
-            yield self._sendRegisters(regs, readback=False)
+    @inlineCallbacks
+    def _resetPLL(self):
+        regs = self.regPllReset()
+        yield self._sendRegisters(regs)
 
-        return self.testMode(func)
+    @inlineCallbacks
+    def _setLVDS(self, cmd, sd, optimizeSD):
+        # See U:\John\ProtelDesigns\GHzDAC_R3_1\Documentation\HardRegProgram.txt
+        # for how this function works.
+        #TODO: repeat LVDS measurement five times and average results.
+        pkt = [[0x0400 + (i << 4), 0x8500, 0x0400 + i, 0x8500][j]
+               for i in range(16) for j in range(4)]
+
+        if optimizeSD is True:
+            # Find the leading/trailing edges of the DATACLK_IN clock.
+            # First set SD to 0. Then, for bits from 0 to 15, set MSD to
+            # this bit and MHD to 0, read the check bit, set MHD to this
+            # bit and MSD to 0, read the check bit.
+            answer = yield self._runSerial(cmd, [0x0500] + pkt)
+            answer = [answer[i * 2 + 2] & 1 for i in range(32)]
+
+            # Find where check bit changes from 1 to 0 for MSD and MHD.
+            MSD = -2
+            MHD = -2
+            for i in range(16):
+                if MSD == -2 and answer[i * 2] == 1: MSD = -1
+                if MSD == -1 and answer[i * 2] == 0: MSD = i
+                if MHD == -2 and answer[i * 2 + 1] == 1: MHD = -1
+                if MHD == -1 and answer[i * 2 + 1] == 0: MHD = i
+            MSD = max(MSD, 0)
+            MHD = max(MHD, 0)
+            # Find the optimal SD based on MSD and MHD.
+            t = (MHD - MSD) / 2 & 0xF
+            setMSDMHD = False
+        elif sd is None:
+            # Get the SD value from the registry.
+            t = int(self.boardParams['lvdsSD']) & 0xF
+            MSD, MHD = -1, -1
+            setMSDMHD = True
+        else:
+            # This occurs if the SD is not specified (by optimization or
+            # in the registry).
+            t = sd & 0xF
+            MSD, MHD = -1, -1
+            setMSDMHD = True
+
+        # Set the SD and check that the resulting difference between MSD
+        # and MHD is no more than one bit. Any more indicates noise on the
+        # line.
+        answer = yield self._runSerial(cmd, [0x0500 + (t << 4)] + pkt)
+        MSDbits = [bool(answer[i * 4 + 2] & 1) for i in range(16)]
+        MHDbits = [bool(answer[i * 4 + 4] & 1) for i in range(16)]
+        MSDswitch = [(MSDbits[i + 1] != MSDbits[i]) for i in range(15)]
+        MHDswitch = [(MHDbits[i + 1] != MHDbits[i]) for i in range(15)]
+        # Find first index at which MHD/MSD switch
+        leadingEdge = MSDswitch.index(True)
+        trailingEdge = MHDswitch.index(True)
+        if setMSDMHD:
+            if sum(MSDswitch) == 1: MSD = leadingEdge
+            if sum(MHDswitch) == 1: MHD = trailingEdge
+        if abs(trailingEdge - leadingEdge) <= 1 and sum(MSDswitch) == 1 and \
+                        sum(MHDswitch) == 1:
+            success = True
+        else:
+            success = False
+        checkResp = yield self._runSerial(cmd, [0x8500])
+        checkHex = checkResp[0] & 0x7
+        returnValue((success, MSD, MHD, t, (range(16), MSDbits, MHDbits),
+                     checkHex))
 
-    def resetPLL(self):
-        """Reset PLL"""
+    @inlineCallbacks
+    def _setFIFO(self, chan, op, targetFifo):
+        if targetFifo is None:
+            # Grab targetFifo from registry if not specified.
+            targetFifo = int(self.boardParams['fifoCounter'])
+        # set clock polarity to positive
+        clkinv = False
+        yield self._setPolarity(chan, clkinv)
+
+        tries = 1
+        found = False
+
+        while tries <= self.MAX_FIFO_TRIES and not found:
+            # Send all four PHOFs & measure resulting FIFO counters. If
+            # one of these equals targetFifo, set the PHOF and check that
+            # the FIFO counter is indeed targetFifo. If so, break out.
+            pkt = [0x0700, 0x8700, 0x0701, 0x8700, 0x0702, 0x8700,
+                   0x0703, 0x8700]
+            reading = yield self._runSerial(op, pkt)
+            fifoCounters = np.array([(reading[i] >> 4) & 0xF for i in \
+                                     [1, 3, 5, 7]])
+            PHOF, found = yield self._checkPHOF(op, fifoCounters,
+                                                targetFifo)
+            if found:
+                break
+            else:
+                # If none of PHOFs gives FIFO counter of targetFifo
+                # initially or after verification, flip clock polarity and
+                # try again.
+                clkinv = not clkinv
+                yield self._setPolarity(chan, clkinv)
+                tries += 1
+
+        ans = found, clkinv, PHOF, tries, targetFifo
+        returnValue(ans)
 
-        @inlineCallbacks
-        def func():
-            regs = self.regPllReset()
-            yield self._sendRegisters(regs)
+    @inlineCallbacks
+    def _runBIST(self, cmd, shift, dataIn):
+        pkt = self.regRunSram(0, 0, loop=False)
+        yield self._sendRegisters(pkt, readback=False)
+
+        dat = [d & 0x3FFF for d in dataIn]
+        data = [0, 0, 0, 0] + [d << shift for d in dat]
+        # make sure data is at least 20 words long by appending 0's
+        data += [0] * (20 - len(data))
+        data = np.array(data, dtype='<u4').tostring()
+        yield self._sendSRAM(data)
+        startAddr, endAddr = 0, len(data) // 4
+        yield self._runSerial(cmd, [0x0004, 0x1107, 0x1106])
+
+        pkt = self.regRunSram(startAddr, endAddr, loop=False)
+        yield self._sendRegisters(pkt, readback=False)
+
+        seq = [0x1126, 0x9200, 0x9300, 0x9400, 0x9500,
+               0x1166, 0x9200, 0x9300, 0x9400, 0x9500,
+               0x11A6, 0x9200, 0x9300, 0x9400, 0x9500,
+               0x11E6, 0x9200, 0x9300, 0x9400, 0x9500]
+        theory = tuple(self.bistChecksum(dat))
+        bist = yield self._runSerial(cmd, seq)
+        reading = [(bist[i + 4] << 0) + (bist[i + 3] << 8) +
+                   (bist[i + 2] << 16) + (bist[i + 1] << 24)
+                   for i in [0, 5, 10, 15]]
+        lvds, fifo = tuple(reading[0:2]), tuple(reading[2:4])
+
+        # lvds and fifo may be reversed.  This is okay
+        lvds = lvds[::-1] if lvds[::-1] == theory else lvds
+        fifo = fifo[::-1] if fifo[::-1] == theory else fifo
+        returnValue((lvds == theory and fifo == theory, theory, lvds,
+                     fifo))
 
-        return self.testMode(func)
+    # Externally available board communication methods
+    # These run in test mode.
+    # Should not be @classmethod
 
     def debugOutput(self, word1, word2, word3, word4):
         @inlineCallbacks
@@ -802,73 +995,7 @@ class DAC_Build7(DAC):
                  tuple(list[int], list[bool], list[bool]),
                  int)
         """
-
-        @inlineCallbacks
-        # See U:\John\ProtelDesigns\GHzDAC_R3_1\Documentation\HardRegProgram.txt
-        # for how this function works.
-        def func():
-            #TODO: repeat LVDS measurement five times and average results.
-            pkt = [[0x0400 + (i << 4), 0x8500, 0x0400 + i, 0x8500][j]
-                   for i in range(16) for j in range(4)]
-
-            if optimizeSD is True:
-                # Find the leading/trailing edges of the DATACLK_IN clock.
-                # First set SD to 0. Then, for bits from 0 to 15, set MSD to
-                # this bit and MHD to 0, read the check bit, set MHD to this
-                # bit and MSD to 0, read the check bit.
-                answer = yield self._runSerial(cmd, [0x0500] + pkt)
-                answer = [answer[i * 2 + 2] & 1 for i in range(32)]
-
-                # Find where check bit changes from 1 to 0 for MSD and MHD.
-                MSD = -2
-                MHD = -2
-                for i in range(16):
-                    if MSD == -2 and answer[i * 2] == 1: MSD = -1
-                    if MSD == -1 and answer[i * 2] == 0: MSD = i
-                    if MHD == -2 and answer[i * 2 + 1] == 1: MHD = -1
-                    if MHD == -1 and answer[i * 2 + 1] == 0: MHD = i
-                MSD = max(MSD, 0)
-                MHD = max(MHD, 0)
-                # Find the optimal SD based on MSD and MHD.
-                t = (MHD - MSD) / 2 & 0xF
-                setMSDMHD = False
-            elif sd is None:
-                # Get the SD value from the registry.
-                t = int(self.boardParams['lvdsSD']) & 0xF
-                MSD, MHD = -1, -1
-                setMSDMHD = True
-            else:
-                # This occurs if the SD is not specified (by optimization or
-                # in the registry).
-                t = sd & 0xF
-                MSD, MHD = -1, -1
-                setMSDMHD = True
-
-            # Set the SD and check that the resulting difference between MSD
-            # and MHD is no more than one bit. Any more indicates noise on the
-            # line.
-            answer = yield self._runSerial(cmd, [0x0500 + (t << 4)] + pkt)
-            MSDbits = [bool(answer[i * 4 + 2] & 1) for i in range(16)]
-            MHDbits = [bool(answer[i * 4 + 4] & 1) for i in range(16)]
-            MSDswitch = [(MSDbits[i + 1] != MSDbits[i]) for i in range(15)]
-            MHDswitch = [(MHDbits[i + 1] != MHDbits[i]) for i in range(15)]
-            # Find first index at which MHD/MSD switch
-            leadingEdge = MSDswitch.index(True)
-            trailingEdge = MHDswitch.index(True)
-            if setMSDMHD:
-                if sum(MSDswitch) == 1: MSD = leadingEdge
-                if sum(MHDswitch) == 1: MHD = trailingEdge
-            if abs(trailingEdge - leadingEdge) <= 1 and sum(MSDswitch) == 1 and \
-                            sum(MHDswitch) == 1:
-                success = True
-            else:
-                success = False
-            checkResp = yield self._runSerial(cmd, [0x8500])
-            checkHex = checkResp[0] & 0x7
-            returnValue((success, MSD, MHD, t, (range(16), MSDbits, MHDbits),
-                         checkHex))
-
-        return self.testMode(func)
+        return self.testMode(self._setLVDS, cmd, sd, optimizeSD)
 
     def setFIFO(self, chan, op, targetFifo):
         """Adjust FIFO buffer. (DAC only)
@@ -897,44 +1024,7 @@ class DAC_Build7(DAC):
                               returned value same as input.
         :rtype: (bool, bool, int, int, int)
         """
-        if targetFifo is None:
-            # Grab targetFifo from registry if not specified.
-            targetFifo = int(self.boardParams['fifoCounter'])
-
-        @inlineCallbacks
-        def func():
-            # set clock polarity to positive
-            clkinv = False
-            yield self._setPolarity(chan, clkinv)
-
-            tries = 1
-            found = False
-
-            while tries <= self.MAX_FIFO_TRIES and not found:
-                # Send all four PHOFs & measure resulting FIFO counters. If
-                # one of these equals targetFifo, set the PHOF and check that
-                # the FIFO counter is indeed targetFifo. If so, break out.
-                pkt = [0x0700, 0x8700, 0x0701, 0x8700, 0x0702, 0x8700,
-                       0x0703, 0x8700]
-                reading = yield self._runSerial(op, pkt)
-                fifoCounters = np.array([(reading[i] >> 4) & 0xF for i in \
-                                         [1, 3, 5, 7]])
-                PHOF, found = yield self._checkPHOF(op, fifoCounters,
-                                                    targetFifo)
-                if found:
-                    break
-                else:
-                    # If none of PHOFs gives FIFO counter of targetFifo
-                    # initially or after verification, flip clock polarity and
-                    # try again.
-                    clkinv = not clkinv
-                    yield self._setPolarity(chan, clkinv)
-                    tries += 1
-
-            ans = found, clkinv, PHOF, tries, targetFifo
-            returnValue(ans)
-
-        return self.testMode(func)
+        return self.testMode(self._setFIFO, chan, op, targetFifo)
 
     def runBIST(self, cmd, shift, dataIn):
         """ Run a BIST on the given SRAM sequence. (DAC only)
@@ -944,42 +1034,7 @@ class DAC_Build7(DAC):
         :param dataIn: SRAM data to use with BIST (random)
         :return:
         """
-
-        @inlineCallbacks
-        def func():
-            pkt = self.regRunSram(0, 0, loop=False)
-            yield self._sendRegisters(pkt, readback=False)
-
-            dat = [d & 0x3FFF for d in dataIn]
-            data = [0, 0, 0, 0] + [d << shift for d in dat]
-            # make sure data is at least 20 words long by appending 0's
-            data += [0] * (20 - len(data))
-            data = np.array(data, dtype='<u4').tostring()
-            yield self._sendSRAM(data)
-            startAddr, endAddr = 0, len(data) // 4
-            yield self._runSerial(cmd, [0x0004, 0x1107, 0x1106])
-
-            pkt = self.regRunSram(startAddr, endAddr, loop=False)
-            yield self._sendRegisters(pkt, readback=False)
-
-            seq = [0x1126, 0x9200, 0x9300, 0x9400, 0x9500,
-                   0x1166, 0x9200, 0x9300, 0x9400, 0x9500,
-                   0x11A6, 0x9200, 0x9300, 0x9400, 0x9500,
-                   0x11E6, 0x9200, 0x9300, 0x9400, 0x9500]
-            theory = tuple(self.bistChecksum(dat))
-            bist = yield self._runSerial(cmd, seq)
-            reading = [(bist[i + 4] << 0) + (bist[i + 3] << 8) +
-                       (bist[i + 2] << 16) + (bist[i + 1] << 24)
-                       for i in [0, 5, 10, 15]]
-            lvds, fifo = tuple(reading[0:2]), tuple(reading[2:4])
-
-            # lvds and fifo may be reversed.  This is okay
-            lvds = lvds[::-1] if lvds[::-1] == theory else lvds
-            fifo = fifo[::-1] if fifo[::-1] == theory else fifo
-            returnValue((lvds == theory and fifo == theory, theory, lvds,
-                         fifo))
-
-        return self.testMode(func)
+        return self.testMode(self._runBIST, cmd, shift, dataIn)
 
     # Utility
 
@@ -1074,10 +1129,20 @@ class DacRunner_Build15(DacRunner_Build7):
         self.reps = reps
         self.start_delay = start_delay
         self.loop_delay = loop_delay
-        self.jump_table = self.dev.make_jump_table(jt_entries, jt_counters)
+        # Serialized once per table for the upload cache hashes and load
+        # packets, and shared by runners for points with the same table.
+        self.jump_table, self.jump_table_bytes = self.dev.cachedJumpTable(
+            jt_entries, jt_counters)
         self.sram = sram
         self.nPackets = 0  # we don't expect any packets back
-        self.seqTime = fpga.TIMEOUT_FACTOR * (100 * self.reps) * 10**-6 + 1  # TODO: what should we do here? issue #49
+        # calculate sequence time from the jump table and the loop delay
+        try:
+            self.memTime = self.jump_table.sequence_time_sec()
+        except ValueError:
+            # The table loops forever, so there is nothing to wait for.
+            self.memTime = JT_UNKNOWN_REP_TIME
+        self.memTime += self.loop_delay * 1e-6
+        self.seqTime = fpga.TIMEOUT_FACTOR * (self.memTime * self.reps) + 1
 
     def pageable(self):
         return False  # no paging for JT
@@ -1095,7 +1160,18 @@ class DacRunner_Build15(DacRunner_Build7):
         if isMaster:
             # TODO: how can we add a delay to the JT?
             self.start_delay += MASTER_SRAM_DELAY_US
-        return self.dev.load(self.jump_table, self.sram)
+        return self.dev.load(self.jump_table_bytes, self.sram)
+
+    def loadHashes(self):
+        """Content hashes of jump table and SRAM, as sent by loadPacket."""
+        return {'jt': contentHash(self.jump_table_bytes),
+                'sram': contentHash(self.sram)}
+
+    def partialLoadPacket(self, page, skip):
+        """Create a load packet leaving out the parts named in skip."""
+        jt = None if 'jt' in skip else self.jump_table_bytes
+        sram = None if 'sram' in skip else self.sram
+        return self.dev.load(jt, sram)
 
     def runPacket(self, page, slave, delay, sync):
         """ Create run packet.
@@ -1176,6 +1252,9 @@ class DAC_Build15(DAC_Build8):
 
     HAS_JUMP_TABLE = True
     RUNNER_CLASS = DacRunner_Build15
+    # Content hash, jump table and its bytes for the last table we built.
+    # See cachedJumpTable.
+    jumpTableCache = None
 
     SRAM_LEN = 18432
     SRAM_WRITE_PKT_LEN = 256
@@ -1407,16 +1486,21 @@ class DAC_Build15(DAC_Build8):
         A load packet is a packet to the direct ethernet server that has
         commands for loading the jump table and the SRAM.
 
-        :param jump_table.JumpTable jt: jump table, from make_jump_table
-        :param sram: sram data
+        :param jump_table.JumpTable jt: jump table, from make_jump_table, or
+            its serialized string, or None to leave it out of the packet
+        :param sram: sram data, or None to leave it out of the packet
         :param page: None (anything else is invalid for JT boards)
         :return: packet to the direct ethernet server
         """
         if page is not None:
             raise NotImplementedError("page argument not valid for jump table")
         p = self.makePacket()
-        p.write(jt.toString())
-        self.makeSRAM(sram, p)
+        if isinstance(jt, jump_table.JumpTable):
+            jt = jt.toString()
+        if jt is not None:
+            p.write(jt)
+        if sram is not None:
+            self.makeSRAM(sram, p)
         return p
 
     @classmethod
@@ -1483,18 +1567,43 @@ class DAC_Build15(DAC_Build8):
         :return: jump table object
         :rtype: jump_table.JumpTable
         """
-        for i, a in enumerate(jt_entries):
-            for j, b in enumerate(jt_entries[i+1:]):
-                if abs(a.from_addr - b.from_addr) < cls.JT_MIN_FROM_ADDR_SPACING:
-                    raise ValueError(
-                        "Entries {}({}) and {}({}) have from addrstoo close together.".format(
-                            i, a.operation, i+j+1, b.operation)
-                    )
-        return jump_table.JumpTable(
+        jt = jump_table.JumpTable(
             start_addr=cls.convert_to_address(start_address_ns),
             jumps=jt_entries,
             counters=counters
         )
+        # Neighbors in from address order are the closest pairs.
+        from_addrs = jt.entries['from_addr'].astype(int)
+        order = np.argsort(from_addrs, kind='mergesort')
+        close = np.flatnonzero(
+            np.diff(from_addrs[order]) < cls.JT_MIN_FROM_ADDR_SPACING)
+        if len(close):
+            i, j = sorted(order[close[0]:close[0] + 2])
+            raise ValueError(
+                "Entries {}({}) and {}({}) have from addrs too close together.".format(
+                    i, jt_entries[i].operation, j, jt_entries[j].operation)
+            )
+        return jt
+
+    def cachedJumpTable(self, jt_entries, counters=None):
+        """Get a jump table and its serialized bytes, reusing the last one.
+
+        The last table is remembered by the content of its entries and
+        counters, so repeated points don't build and serialize it again.
+        See make_jump_table for the arguments.
+
+        :return: (jump table object, bytes for the board)
+        :rtype: tuple(jump_table.JumpTable, str)
+        """
+        counters = jump_table.JumpTable._initialize_counters(counters)
+        key = contentHash(jump_table.entry_array(jt_entries).tostring() +
+                          np.asarray(counters, dtype='<u4').tostring())
+        cached = self.jumpTableCache
+        if cached is None or cached[0] != key:
+            jt = self.make_jump_table(jt_entries, counters)
+            cached = (key, jt, jt.toString())
+            self.jumpTableCache = cached
+        return cached[1:]
 
     @classmethod
     def jt_run_sram(cls, start_addr_ns, end_addr_ns, loop=False):
@@ -1528,35 +1637,18 @@ class DAC_Build15(DAC_Build8):
     def pktWriteMem(cls, page, data):
         raise NotImplementedError("No memory commands for jump table!")
 
-    def initPLL(self):
-        @inlineCallbacks
-        def func():
-            yield self._runSerial(1, [0x1FC093, 0x1FC092, 0x100004, 0x000C11])
-            yield self._sendSRAM(np.zeros(256*10, dtype='<u4').tostring())
-            jt = self.jt_run_sram(0, 256*10, False)
-            p = self.makePacket()
-            p.write(jt.toString())
-            yield p.send()
-            yield self._sendRegisters(self.regRunSimple())
-
-        return self.testMode(func)
-
-    def runSram(self, dataIn, loop, blockDelay):
-        @inlineCallbacks
-        def func():
-            # yield self._sendRegisters(self.regPing())  # Why is this here? DTS/PJJO
-            data = np.array(dataIn, dtype='<u4').tostring()
-            yield self._sendSRAM(data)
-            startAddr, endAddr = 0, len(dataIn)
-            jt = self.jt_run_sram(startAddr, endAddr, loop)
-            p = self.makePacket()
-            p.write(jt.toString())
-            yield p.send()
-            yield self._sendRegisters(self.regRunSimple(), readback=True)
-
-        return self.testMode(func)
+    @inlineCallbacks
+    def _initPLL(self):
+        yield self._runSerial(1, [0x1FC093, 0x1FC092, 0x100004, 0x000C11])
+        yield self._sendSRAM(np.zeros(256*10, dtype='<u4').tostring())
+        jt = self.jt_run_sram(0, 256*10, False)
+        p = self.makePacket()
+        p.write(jt.toString())
+        yield p.send()
+        yield self._sendRegisters(self.regRunSimple())
 
-    def runBIST(self, cmd, shift, dataIn):
+    @inlineCallbacks
+    def _runBIST(self, cmd, shift, dataIn):
         """ Run a BIST on given SRAM sequence. Jump Table DAC version.
 
         This is rewritten from the non-JT version because we can no longer
@@ -1567,46 +1659,57 @@ class DAC_Build15(DAC_Build8):
         :param dataIn: input SRAM data
         :return: (bool--checksums match?, checksum, lvds, fifo)
         """
+        # serial commands for the BIST.
+        dat = [d & 0x3FFF for d in dataIn]
+        data = [0, 0, 0, 0] + [d << shift for d in dat]
+        # make sure data is at least 20 words long by appending 0's
+        data += [0] * (20 - len(data))
+        data = np.array(data, dtype='<u4').tostring()
+        yield self._sendSRAM(data)
+        yield self._runSerial(cmd, [0x0004, 0x1107, 0x1106])
+
+        # JT run
+        startAddr = 0
+        endAddr = len(data) // 4 + 4
+        jt = self.jt_run_sram(startAddr, endAddr, loop=False)
+        p = self.makePacket()
+        p.write(jt.toString())
+        yield p.send()
+        # print jt.pretty_string()
+        yield self._sendRegisters(self.regRunSimple(readback=False), readback=False)
+
+        # checksum
+        seq = [0x1126, 0x9200, 0x9300, 0x9400, 0x9500,
+               0x1166, 0x9200, 0x9300, 0x9400, 0x9500,
+               0x11A6, 0x9200, 0x9300, 0x9400, 0x9500,
+               0x11E6, 0x9200, 0x9300, 0x9400, 0x9500]
+        theory = tuple(self.bistChecksum(dat))
+        bist = yield self._runSerial(cmd, seq)
+        reading = [(bist[i + 4] << 0) + (bist[i + 3] << 8) +
+                   (bist[i + 2] << 16) + (bist[i + 1] << 24)
+                   for i in [0, 5, 10, 15]]
+        # print "bist = ", bist
+        # print "reading = ", reading
+        lvds, fifo = tuple(reading[0:2]), tuple(reading[2:4])
+
+        # lvds and fifo may be reversed.  This is okay
+        lvds = lvds[::-1] if lvds[::-1] == theory else lvds
+        fifo = fifo[::-1] if fifo[::-1] == theory else fifo
+        returnValue((lvds == theory and fifo == theory, theory, lvds, fifo))
 
+    def runSram(self, dataIn, loop, blockDelay):
         @inlineCallbacks
         def func():
-            # serial commands for the BIST.
-            dat = [d & 0x3FFF for d in dataIn]
-            data = [0, 0, 0, 0] + [d << shift for d in dat]
-            # make sure data is at least 20 words long by appending 0's
-            data += [0] * (20 - len(data))
-            data = np.array(data, dtype='<u4').tostring()
+            # yield self._sendRegisters(self.regPing())  # Why is this here? DTS/PJJO
+            data = np.array(dataIn, dtype='<u4').tostring()
             yield self._sendSRAM(data)
-            yield self._runSerial(cmd, [0x0004, 0x1107, 0x1106])
-
-            # JT run
-            startAddr = 0
-            endAddr = len(data) // 4 + 4
-            jt = self.jt_run_sram(startAddr, endAddr, loop=False)
+            startAddr, endAddr = 0, len(dataIn)
+            jt = self.jt_run_sram(startAddr, endAddr, loop)
             p = self.makePacket()
             p.write(jt.toString())
             yield p.send()
-            # print jt.pretty_string()
-            yield self._sendRegisters(self.regRunSimple(readback=False), readback=False)
-
-            # checksum
-            seq = [0x1126, 0x9200, 0x9300, 0x9400, 0x9500,
-                   0x1166, 0x9200, 0x9300, 0x9400, 0x9500,
-                   0x11A6, 0x9200, 0x9300, 0x9400, 0x9500,
-                   0x11E6, 0x9200, 0x9300, 0x9400, 0x9500]
-            theory = tuple(self.bistChecksum(dat))
-            bist = yield self._runSerial(cmd, seq)
-            reading = [(bist[i + 4] << 0) + (bist[i + 3] << 8) +
-                       (bist[i + 2] << 16) + (bist[i + 1] << 24)
-                       for i in [0, 5, 10, 15]]
-            # print "bist = ", bist
-            # print "reading = ", reading
-            lvds, fifo = tuple(reading[0:2]), tuple(reading[2:4])
-
-            # lvds and fifo may be reversed.  This is okay
-            lvds = lvds[::-1] if lvds[::-1] == theory else lvds
-            fifo = fifo[::-1] if fifo[::-1] == theory else fifo
-            returnValue((lvds == theory and fifo == theory, theory, lvds, fifo))
+            yield self._sendRegisters(self.regRunSimple(), readback=True)
+
         return self.testMode(func)
 
     # extensions to board communication
@@ -1628,17 +1731,21 @@ def maxSRAM(cmds):
     This is used to determine whether a given memory sequence is pageable,
     since only half of the available SRAM can be used when paging.
     """
-
-    def addr(cmd):
-        return MemorySequence.getAddress(cmd) if \
-            MemorySequence.getOpcode(cmd) in [0x8, 0xA] else 0
-
-    return max(addr(cmd) for cmd in cmds)
+    cmds = MemorySequence.asArray(cmds)
+    addrs = MemorySequence.getAddress(cmds[MemorySequence.sramAddressMask(cmds)])
+    return int(addrs.max(initial=0))
 
 
 #Memory sequence functions
 
 class MemorySequence(list):
+    """Builds memory sequences, and works on lists or arrays of commands.
+
+    The static methods take a list of commands or a uint32 array and work
+    on the whole array at once. Runners convert their commands with asArray
+    once, so the methods do not convert them again.
+    """
+
     @staticmethod
     def getOpcode(cmd):
         return (cmd & 0xF00000) >> 20
@@ -1647,6 +1754,17 @@ class MemorySequence(list):
     def getAddress(cmd):
         return (cmd & 0x0FFFFF)
 
+    @staticmethod
+    def asArray(cmds):
+        """Memory commands as a uint32 array, without copying if possible."""
+        return np.asarray(cmds, dtype='<u4').reshape(-1)
+
+    @staticmethod
+    def sramAddressMask(cmds):
+        """Boolean mask of the SRAM start and end address commands."""
+        opcodes = MemorySequence.getOpcode(MemorySequence.asArray(cmds))
+        return (opcodes == 0x8) | (opcodes == 0xA)
+
     def noOp(self):
         self.append(0x000000)
         return self
@@ -1726,15 +1844,12 @@ class MemorySequence(list):
         
         TODO: check for repeated delay calls to make sure delays actually happen
         """
-        newCmds = []
+        cmds = MemorySequence.asArray(cmds)
         delayCycles = int(delay_us * 25)  #memory clock speed is 25MHz
         assert delayCycles < 0xFFFFF
         delayCmd = 0x300000 + delayCycles
-        for cmd in cmds:
-            if MemorySequence.getOpcode(cmd) == 0xC:  # call SRAM
-                newCmds.append(delayCmd)  # add delay
-            newCmds.append(cmd)
-        return newCmds
+        calls = np.flatnonzero(MemorySequence.getOpcode(cmds) == 0xC)
+        return np.insert(cmds, calls, delayCmd)
 
     @staticmethod
     def cmdTime_cycles(cmd):
@@ -1761,14 +1876,61 @@ class MemorySequence(list):
         else:
             raise Exception("Unknown opcode: %s address: %s" % (opcode, MemorySequence.getAddress(cmd)))
     
+    @staticmethod
+    def sequenceCycles(cmds):
+        """Number of memory clock cycles of one pass through a sequence.
+
+        Commands after the first branch to start never run. SRAM calls take
+        one cycle plus the time to play from the last SRAM start address
+        to the last SRAM end address, which includes any delay blocks (see
+        fixSRAMaddresses). An SRAM call before both addresses are set is
+        taken to be as long as the one in cmdTime_cycles.
+
+        cmds - list of numbers: memory commands for GHz DAC
+        """
+        cmds = MemorySequence.asArray(cmds)
+        opcodes = MemorySequence.getOpcode(cmds)
+        branches = np.flatnonzero(opcodes == 0xF)
+        if len(branches):
+            cmds = cmds[:branches[0] + 1]
+            opcodes = opcodes[:branches[0] + 1]
+        addrs = cmds & 0xFFFFF
+        known = np.in1d(opcodes, [0x0, 0x1, 0x2, 0x3, 0x4, 0x8, 0xA, 0xC,
+                                  0xF])
+        if not known.all():
+            i = np.flatnonzero(~known)[0]
+            raise Exception("Unknown opcode: %s address: %s" %
+                            (opcodes[i], addrs[i]))
+        cycles = np.ones(len(cmds), dtype=np.int64)
+        cycles[opcodes == 0xF] = 2
+        delays = opcodes == 0x3
+        cycles[delays] += addrs[delays]
+        calls = np.flatnonzero(opcodes == 0xC)
+        if len(calls):
+            # Index of the last start and end address commands before each
+            # call, or -1 if there is none.
+            index = np.arange(len(cmds))
+            starts = np.maximum.accumulate(
+                np.where(opcodes == 0x8, index, -1))[calls]
+            ends = np.maximum.accumulate(
+                np.where(opcodes == 0xA, index, -1))[calls]
+            words = addrs[ends].astype(np.int64) - addrs[starts] + 1
+            # SRAM plays one word per ns, 40 per memory clock cycle.
+            sramCycles = 1 + (np.maximum(words, 0) + SRAM_WORDS_PER_CYCLE -
+                              1) // SRAM_WORDS_PER_CYCLE
+            unset = (starts < 0) | (ends < 0)
+            sramCycles[unset] = MemorySequence.cmdTime_cycles(0xC00000)
+            cycles[calls] = sramCycles
+        return int(cycles.sum())
+
     @staticmethod
     def sequenceTime_sec(cmds):
-        """Conservative estimate of the length of a sequence in seconds.
-        
+        """Length of one pass through a sequence in seconds.
+
         cmds - list of numbers: memory commands for GHz DAC
         """
-        cycles = sum(MemorySequence.cmdTime_cycles(c) for c in cmds)
-        return cycles * 40e-9  # assume 25 MHz clock -> 40 ns per cycle
+        cycles = MemorySequence.sequenceCycles(cmds)
+        return cycles * 40e-9  # 25 MHz clock -> 40 ns per cycle
 
     @staticmethod
     def fixSRAMaddresses(mem, sram, device):
@@ -1803,30 +1965,25 @@ class MemorySequence(list):
         in other words, endAddr is equal to
         # of 0s in block0 + # of -'s in block0 + # of -'s in block1 + DELAY
         """
+        if not isinstance(sram, tuple):
+            return mem
         block0Len_words = len(sram[0]) / 4
         block1Len_words = len(sram[1]) / 4
         delayBlocks = sram[2]
-        if not isinstance(sram, tuple):
-            return mem
-        numSramCalls = sum(MemorySequence.getOpcode(cmd) == 0xC for cmd in mem)
+        mem = MemorySequence.asArray(mem)
+        opcodes = MemorySequence.getOpcode(mem)
+        numSramCalls = np.count_nonzero(opcodes == 0xC)
         if numSramCalls > 1:
             raise Exception('Only one SRAM call allowed in multi-block sequences.')
 
-        def fixAddr(cmd):
-            opcode, address = MemorySequence.getOpcode(cmd), MemorySequence.getAddress(cmd)
-            if opcode == 0x8:
-                # SRAM start address
-                address = device.SRAM_BLOCK0_LEN - block0Len_words
-                return (opcode << 20) + address
-            elif opcode == 0xA:
-                # SRAM end address
-                address = device.SRAM_BLOCK0_LEN + block1Len_words \
-                          + device.SRAM_DELAY_LEN * delayBlocks - 1
-                return (opcode << 20) + address
-            else:
-                return cmd
-
-        return [fixAddr(cmd) for cmd in mem]
+        fixed = mem.copy()
+        # SRAM start address
+        fixed[opcodes == 0x8] = (0x8 << 20) + \
+            device.SRAM_BLOCK0_LEN - block0Len_words
+        # SRAM end address
+        fixed[opcodes == 0xA] = (0xA << 20) + device.SRAM_BLOCK0_LEN + \
+            block1Len_words + device.SRAM_DELAY_LEN * delayBlocks - 1
+        return fixed
 
     @staticmethod
     def timerCount(cmds):
@@ -1839,5 +1996,4 @@ class MemorySequence(list):
         user's responsibility at this point (if using the qubit server,
         these things are automatically checked).
         """
-        return int(sum(np.asarray(cmds) == 0x400001))  # numpy version
-        #return cmds.count(0x400001) # python list version
+        return np.count_nonzero(MemorySequence.asArray(cmds) == 0x400001)
@@ -0,0 +1,709 @@
+"""
+Software emulation of GHz FPGA boards and the direct ethernet server.
+
+The FPGA server only talks to boards through a direct ethernet server, so
+replacing that server with a DirectEthernetEmulator lets the board group,
+the device objects and the whole load/run/collect/read pipeline run without
+any hardware, e.g. for tests and benchmarks:
+
+    de = DirectEthernetEmulator()
+    de.addBoard(DacEmulator(1, build=15))
+    de.addBoard(AdcEmulator(2, build=7))
+    boardGroup = BoardGroup(fpgaServer, de, 0)
+
+Device objects are then connected with de as their ethernet server, just
+as FPGAServer.findDevices does with the real one.
+
+Emulated boards parse the register, SRAM, memory and jump table packets
+written to them. They run when started directly or by a master board over
+the daisy chain, and send back register readbacks, DAC timing data and ADC
+demodulator or average data in packets of the same size and number as the
+real boards. Run times are modeled from the uploaded memory, jump table or
+trigger table and multiplied by timeScale. Each request to the emulated
+server can also be given a fixed latency.
+
+With timeScale and latency both zero (the default) everything happens
+synchronously while packets are sent, which keeps tests simple. Otherwise
+delays are scheduled on clock, which defaults to the twisted reactor; tests
+can pass a twisted.internet.task.Clock and advance it by hand.
+
+The returned data is synthetic: DAC timing results count repetitions, and
+demodulator I values are the channel number and Q values the repetition.
+"""
+
+import collections
+
+import numpy as np
+from twisted.internet import defer, task
+from twisted.internet.defer import inlineCallbacks, returnValue
+
+from labrad import types as T
+from labrad.units import Value
+
+import fpgalib.adc as adc
+import fpgalib.dac as dac
+import fpgalib.fpga as fpga
+import fpgalib.jump_table as jump_table
+from fpgalib.util import littleEndian
+
+# MAC address of the emulated ethernet adapters, with the port number last.
+ADAPTER_MAC_PREFIX = '00:1B:21:00:00:'
+# Ether type reported for received packets (IEEE 802.3 length field).
+ETHER_TYPE = -1
+# A run sends its data in at most this many bursts spread over the run.
+MAX_RUN_CHUNKS = 100
+
+
+class Response(dict):
+    """Result of an emulated packet. Results can be looked up by key or
+    as attributes, as for labrad packets."""
+
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+
+class EmulatedPacket(object):
+    """A packet of requests to an emulated server.
+
+    Like a labrad packet, requests are added by calling methods named after
+    settings, e.g. p.read(10), and may be given a key with which to look up
+    their result or replace their data with p[key] = data.
+    """
+
+    def __init__(self, server, context=None):
+        self._server = server
+        self._context = context
+        self._packet = []
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        def addRecord(*args, **kw):
+            key = kw.pop('key', name)
+            self._packet.append([name, args, key])
+            return self
+        return addRecord
+
+    def __setitem__(self, key, data):
+        for rec in self._packet:
+            if rec[2] == key:
+                rec[1] = (data,)
+
+    def send(self, context=None, **kw):
+        if context is None:
+            context = self._context
+        records = [tuple(rec) for rec in self._packet]
+        return self._server._send(context, records)
+
+
+class EmulatedServer(object):
+    """Base class for emulated labrad servers.
+
+    Each context gets an instance of CONTEXT_CLASS, whose methods named in
+    its SETTINGS are the settings of the server. Requests in one context are
+    handled one at a time, in order, as by labrad.
+    """
+
+    CONTEXT_CLASS = None
+
+    def __init__(self, name, cxn=None, latency=0.0, clock=None):
+        self._labrad_name = name
+        self.latency = latency
+        self._clock = clock
+        self._contexts = {}
+        self._nextContext = 1
+        self._cxn = cxn if cxn is not None else EmulatedConnection()
+        self._cxn.addServer(self)
+
+    @property
+    def clock(self):
+        if self._clock is None:
+            from twisted.internet import reactor
+            self._clock = reactor
+        return self._clock
+
+    def seconds(self):
+        return self.clock.seconds()
+
+    def callLater(self, delay, func, *args):
+        """Call func after delay seconds, or right away if delay is 0."""
+        if delay > 0:
+            self.clock.callLater(delay, func, *args)
+        else:
+            func(*args)
+
+    def context(self):
+        ctx = (self._cxn.ID, self._nextContext)
+        self._nextContext += 1
+        return ctx
+
+    def packet(self, context=None, **kw):
+        return EmulatedPacket(self, context)
+
+    def _context(self, key):
+        if key not in self._contexts:
+            self._contexts[key] = self.CONTEXT_CLASS(self)
+        return self._contexts[key]
+
+    def _send(self, context, records):
+        ctx = self._context(context)
+        return ctx.lock.run(self._execute, ctx, records)
+
+    @inlineCallbacks
+    def _execute(self, ctx, records):
+        if self.latency:
+            yield task.deferLater(self.clock, self.latency, lambda: None)
+        ans = Response()
+        for name, args, key in records:
+            if name not in ctx.SETTINGS:
+                raise T.Error('{} has no setting {}'.format(
+                        self._labrad_name, name))
+            result = yield getattr(ctx, name)(*args)
+            if result is not None:
+                ans[key] = result
+        returnValue(ans)
+
+    def _expire(self, context):
+        ctx = self._contexts.pop(context, None)
+        if ctx is not None:
+            ctx.expire()
+
+
+class EmulatedConnection(object):
+    """The parts of a labrad connection used by the FPGA server's devices:
+    the manager and the registry."""
+
+    ID = 1000
+
+    def __init__(self, registryValues=None):
+        self.servers = {}
+        self.manager = _ManagerEmulator(self)
+        self.registry = RegistryEmulator(self, registryValues)
+
+    def addServer(self, server):
+        server.ID = len(self.servers) + 1
+        self.servers[server.ID] = server
+
+
+class _ManagerEmulator(object):
+
+    def __init__(self, cxn):
+        self.cxn = cxn
+
+    def servers(self):
+        return defer.succeed([(ID, server._labrad_name)
+                              for ID, server in self.cxn.servers.items()])
+
+    def expire_context(self, ID, context=None):
+        if ID in self.cxn.servers:
+            self.cxn.servers[ID]._expire(context)
+        return defer.succeed(None)
+
+
+class _RegistryContext(object):
+
+    SETTINGS = ('cd', 'get')
+
+    def __init__(self, server):
+        self.server = server
+        self.lock = defer.DeferredLock()
+        self.path = ['']
+
+    def cd(self, path, create=False):
+        self.path = list(path) if isinstance(path, list) else [path]
+        return self.path
+
+    def get(self, key, set=False, default=None):
+        # Missing keys read as empty lists so that emulated boards need no
+        # registry setup.
+        if default is None:
+            default = []
+        return self.server.values.get(key, default)
+
+    def expire(self):
+        pass
+
+
+class RegistryEmulator(EmulatedServer):
+    """A registry holding a flat dict of keys, ignoring directories."""
+
+    CONTEXT_CLASS = _RegistryContext
+
+    def __init__(self, cxn, values=None):
+        EmulatedServer.__init__(self, 'Registry', cxn)
+        self.values = dict(values or {})
+
+
+class _EthernetContext(object):
+    """State and settings of one context of the emulated ethernet server."""
+
+    SETTINGS = ('connect', 'listen', 'timeout', 'destination_mac',
+                'require_source_mac', 'require_length', 'write', 'collect',
+                'read', 'discard', 'clear', 'send_trigger',
+                'wait_for_trigger')
+
+    def __init__(self, server):
+        self.server = server
+        self.lock = defer.DeferredLock()
+        self.port = None
+        self.destinationMac = None
+        self.sourceMacFilter = None
+        self.lengthFilter = None
+        self.readTimeout = None
+        self.listening = False
+        self.packets = collections.deque()
+        self.triggers = 0
+        self.waiters = []
+
+    # Settings
+
+    def connect(self, port):
+        if port not in self.server.ports:
+            raise T.Error('Adapter {} does not exist'.format(port), 10)
+        self.port = port
+
+    def listen(self):
+        self.listening = True
+
+    def timeout(self, t):
+        self.readTimeout = t['s']
+
+    def destination_mac(self, mac):
+        self.destinationMac = mac.upper()
+
+    def require_source_mac(self, mac):
+        self.sourceMacFilter = mac.upper()
+
+    def require_length(self, length):
+        self.lengthFilter = length
+
+    def write(self, data):
+        if self.port is None:
+            raise T.Error('Not connected to an adapter', 10)
+        self.server._toBoard(self.port, self.destinationMac, data)
+
+    def collect(self, n=1):
+        if self.readTimeout is None:
+            raise T.Error('Read Timeout not set', 11)
+        msg = 'Timeout! Failed to collect {} packets after {} s'.format(
+                n, self.readTimeout)
+        return self._await(lambda: len(self.packets) >= n, msg,
+                           self.readTimeout)
+
+    def read(self, n=1):
+        d = self.collect(n)
+        d.addCallback(lambda _: [self.packets.popleft() for _ in range(n)])
+        return d
+
+    def discard(self, n=1):
+        def drop(_):
+            for _ in range(n):
+                self.packets.popleft()
+        return self.collect(n).addCallback(drop)
+
+    def clear(self):
+        self.packets.clear()
+
+    def send_trigger(self, context):
+        self.server._context(context).trigger()
+
+    def wait_for_trigger(self, n=1, timeout=Value(3600, 's')):
+        start = self.server.seconds()
+        def done(_):
+            self.triggers -= n
+            return Value(self.server.seconds() - start, 's')
+        msg = 'Timeout! Waiting for {} triggers'.format(n)
+        d = self._await(lambda: self.triggers >= n, msg, timeout['s'])
+        return d.addCallback(done)
+
+    # Called by the server
+
+    def receive(self, port, src, data):
+        """Buffer a packet from a board if it passes our filters."""
+        if not self.listening or port != self.port:
+            return
+        if self.sourceMacFilter is not None and src != self.sourceMacFilter:
+            return
+        if self.lengthFilter is not None and len(data) != self.lengthFilter:
+            return
+        dst = ADAPTER_MAC_PREFIX + '{:02X}'.format(port)
+        self.packets.append((src, dst, ETHER_TYPE, data))
+        self._update()
+
+    def trigger(self):
+        self.triggers += 1
+        self._update()
+
+    def expire(self):
+        waiters, self.waiters = self.waiters, []
+        for cond, d, call in waiters:
+            if call is not None and call.active():
+                call.cancel()
+            d.errback(T.Error('Context expired'))
+
+    def _await(self, cond, msg, timeout):
+        """Get a deferred that fires once cond() is true."""
+        if cond():
+            return defer.succeed(None)
+        if timeout <= 0:
+            return defer.fail(T.Error(msg, 12))
+        d = defer.Deferred()
+        waiter = [cond, d, None]
+        waiter[2] = self.server.clock.callLater(timeout, self._timeout,
+                                                waiter, msg)
+        self.waiters.append(waiter)
+        return d
+
+    def _timeout(self, waiter, msg):
+        self.waiters.remove(waiter)
+        waiter[1].errback(T.Error(msg, 12))
+
+    def _update(self):
+        for waiter in list(self.waiters):
+            cond, d, call = waiter
+            if waiter in self.waiters and cond():
+                self.waiters.remove(waiter)
+                if call.active():
+                    call.cancel()
+                d.callback(None)
+
+
+class DirectEthernetEmulator(EmulatedServer):
+    """Stand-in for a direct ethernet server with emulated boards attached.
+
+    ports is the list of adapter numbers. Each request takes latency seconds
+    and board runs take timeScale times their modeled duration.
+    """
+
+    CONTEXT_CLASS = _EthernetContext
+
+    def __init__(self, ports=(0,), latency=0.0, timeScale=0.0, clock=None,
+                 name='Emulated Direct Ethernet', cxn=None):
+        EmulatedServer.__init__(self, name, cxn, latency, clock)
+        self.ports = list(ports)
+        self.timeScale = timeScale
+        self.boards = {}  # (port, MAC) -> board emulator
+
+    def addBoard(self, board, port=0):
+        board.attach(self, port)
+        self.boards[port, board.MAC] = board
+        return board
+
+    def adapters(self, context=None):
+        return defer.succeed([(port, 'Emulated adapter {}'.format(port))
+                              for port in self.ports])
+
+    def read(self, n=1, context=None):
+        p = self.packet(context=context)
+        p.read(n)
+        return p.send().addCallback(lambda ans: ans['read'])
+
+    def _toBoard(self, port, mac, data):
+        board = self.boards.get((port, mac))
+        if board is not None:
+            board.receive(data)
+
+    def _fromBoard(self, port, mac, data):
+        for ctx in list(self._contexts.values()):
+            ctx.receive(port, mac, data)
+
+    def _daisyChainStart(self, port, master):
+        for (p, mac), board in sorted(self.boards.items()):
+            if p == port and board is not master:
+                board.daisyStart()
+
+
+class BoardEmulator(object):
+    """Base class for emulated boards.
+
+    Subclasses handle the packets written to the board in receive.
+    """
+
+    BOARD_TYPE = None
+
+    def __init__(self, board, build):
+        self.devClass = fpga.REGISTRY[(self.BOARD_TYPE, build)]
+        self.board = board
+        self.build = build
+        self.MAC = self.devClass.macFor(board)
+        self.server = None
+        self.port = None
+        self.armed = None  # Run to start on the next daisy chain pulse.
+        self.running = False
+        self.executionCount = 0
+        self.badPackets = 0
+
+    def attach(self, server, port):
+        self.server = server
+        self.port = port
+
+    def send(self, data):
+        """Send a packet from this board to the ethernet adapter."""
+        self.server._fromBoard(self.port, self.MAC, data)
+
+    def receive(self, data):
+        raise NotImplementedError()
+
+    def daisyStart(self):
+        if self.armed is not None:
+            run, self.armed = self.armed, None
+            run()
+
+    def startRun(self, reps, repTime, makeData, finish=None, master=False):
+        """Run reps repetitions of repTime seconds each.
+
+        makeData(start, stop) gives the packets sent for repetitions
+        start to stop-1, and finish is called once the run is done. A master
+        starts the armed boards on its port through the daisy chain.
+        """
+        self.running = True
+        self.executionCount = 0
+        if master:
+            self.server._daisyChainStart(self.port, self)
+        duration = reps * repTime * self.server.timeScale
+        nChunks = max(1, min(reps, MAX_RUN_CHUNKS)) if duration > 0 else 1
+        bounds = np.linspace(0, reps, nChunks + 1).astype(int)
+        for i in range(nChunks):
+            last = i == nChunks - 1
+            self.server.callLater(duration * (i + 1) / nChunks,
+                                  self._runChunk, bounds[i], bounds[i + 1],
+                                  makeData, finish if last else None, last)
+
+    def _runChunk(self, start, stop, makeData, finish, last):
+        self.executionCount = stop
+        for data in makeData(start, stop):
+            self.send(data)
+        if last:
+            self.running = False
+            if finish is not None:
+                finish()
+
+
+class DacEmulator(BoardEmulator):
+    """Emulated DAC board, for builds with or without a jump table."""
+
+    BOARD_TYPE = 'DAC'
+
+    def __init__(self, board, build=15):
+        BoardEmulator.__init__(self, board, build)
+        cls = self.devClass
+        self.sram = np.zeros(cls.SRAM_LEN, dtype='<u4')
+        self.mem = np.zeros((2, cls.MEM_PAGE_LEN), dtype='<u4')
+        self.jumpTable = None
+        self._timings = np.zeros(0, dtype='<u2')
+
+    def receive(self, data):
+        cls = self.devClass
+        a = np.fromstring(data, dtype='<u1')
+        if len(a) == cls.REG_PACKET_LEN:
+            if cls.HAS_JUMP_TABLE:
+                self.registerJumpTable(a)
+            else:
+                self.registerMemory(a)
+        elif len(a) == 2 + 4 * cls.SRAM_WRITE_PKT_LEN:
+            derp = a[0] + (a[1] << 8)
+            start = derp * cls.SRAM_WRITE_PKT_LEN
+            self.sram[start:start + cls.SRAM_WRITE_PKT_LEN] = \
+                np.frombuffer(data[2:], dtype='<u4')
+        elif cls.HAS_JUMP_TABLE and len(a) == cls.JUMP_TABLE_LEN:
+            self.jumpTable = a
+        elif not cls.HAS_JUMP_TABLE and len(a) == 1 + 3 * cls.MEM_PAGE_LEN:
+            words = a[1:].reshape(-1, 3).astype('<u4')
+            self.mem[a[0] & 1] = (words[:, 0] + (words[:, 1] << 8) +
+                                  (words[:, 2] << 16))
+        else:
+            self.badPackets += 1
+
+    def readback(self):
+        a = np.zeros(self.devClass.READBACK_LEN, dtype='<u1')
+        a[51] = self.build
+        a[52:54] = littleEndian(self.executionCount & 0xFFFF, 2)
+        return a.tostring()
+
+    def registerMemory(self, regs):
+        """Handle a register write to a memory (build 7 and 8) board."""
+        start, page, readback = regs[0] & 0x7F, regs[0] >> 7, regs[1]
+        mode = regs[43]  # 0: master, 1: slave, 3: idle
+        if start == 1:
+            reps = regs[13] + (regs[14] << 8)
+            run = lambda: self.runMemory(page, reps, readback == 3,
+                                         master=mode == 0)
+            if mode == 0:
+                run()
+            else:
+                self.armed = run if mode == 1 else None
+        elif start == 0:
+            self.armed = None
+        if readback in (1, 2):
+            self.send(self.readback())
+
+    def runMemory(self, page, reps, stream, master):
+        cmds = self.mem[page]
+        branches = np.nonzero((cmds >> 20) == 0xF)[0]
+        if len(branches):
+            cmds = cmds[:branches[0] + 1]
+        nTimers = dac.MemorySequence.timerCount(cmds) if stream else 0
+        repTime = dac.MemorySequence.sequenceTime_sec(cmds)
+        self._timings = np.zeros(0, dtype='<u2')
+        self.startRun(reps, repTime,
+                      lambda start, stop: self.timingPackets(start, stop,
+                                                             nTimers),
+                      master=master)
+
+    def timingPackets(self, start, stop, nTimers):
+        """Timing packets completed by repetitions start to stop-1."""
+        n = dac.DAC.TIMING_PACKET_LEN
+        values = np.repeat(np.arange(start, stop), nTimers) & 0xFFFF
+        timings = np.concatenate((self._timings, values.astype('<u2')))
+        nPackets = len(timings) // n
+        pkts = np.zeros((nPackets, self.devClass.READBACK_LEN), dtype='<u1')
+        pkts[:, 3:3 + 2 * n] = timings[:nPackets * n].view('<u1').reshape(
+                nPackets, 2 * n)
+        self._timings = timings[nPackets * n:]
+        return [row.tostring() for row in pkts]
+
+    def registerJumpTable(self, regs):
+        """Handle a register write to a jump table (build 15) board."""
+        start, readback = regs[0], regs[1]  # start 1: master, 3: slave
+        reps = regs[13] + (regs[14] << 8)
+        loopDelay = regs[15] + (regs[16] << 8)
+        if start in (1, 3) and reps:
+            run = lambda: self.runJumpTable(reps, loopDelay, readback,
+                                            master=start == 1)
+            if start == 1:
+                run()
+            else:
+                self.armed = run
+            return
+        if start == 0:
+            self.armed = None
+        if readback:
+            self.send(self.readback())
+
+    def runJumpTable(self, reps, loopDelay, readback, master):
+        finish = (lambda: self.send(self.readback())) if readback else None
+        self.startRun(reps, self.jumpTableRepTime() + loopDelay * 1e-6,
+                      lambda start, stop: [], finish, master=master)
+
+    def jumpTableRepTime(self):
+        """Time of one pass through the jump table."""
+        if self.jumpTable is None:
+            return 0.0
+        data = self.jumpTable.astype('<u4')
+        counters = (data[0:16].reshape(4, 4) << [0, 8, 16, 24]).sum(1)
+        startAddr = data[16] + (data[17] << 8) + (data[18] << 16)
+        table = data[24:].reshape(-1, 8)
+        entries = np.zeros(len(table), dtype=jump_table.ENTRY_DTYPE)
+        entries['from_addr'] = table[:, 0] + (table[:, 1] << 8) + \
+            (table[:, 2] << 16)
+        entries['to_addr'] = table[:, 3] + (table[:, 4] << 8) + \
+            (table[:, 5] << 16)
+        entries['op'] = table[:, 6] + (table[:, 7] << 8)
+        try:
+            cycles = jump_table.sequence_cycles(startAddr, entries,
+                                                counters.tolist())
+        except ValueError:
+            return 0.0
+        return cycles * jump_table.CYCLE_TIME
+
+
+class AdcEmulator(BoardEmulator):
+    """Emulated ADC board (build 7)."""
+
+    BOARD_TYPE = 'ADC'
+
+    def __init__(self, board, build=7):
+        BoardEmulator.__init__(self, board, build)
+        self.triggerTable = []
+        self.mixerTables = {}
+
+    def receive(self, data):
+        cls = self.devClass
+        a = np.fromstring(data, dtype='<u1')
+        if len(a) == cls.REG_PACKET_LEN:
+            self.register(a)
+        elif len(a) == cls.SRAM_RETRIGGER_PKT_LEN:
+            page = a[0] + (a[1] << 8)
+            if page == 0:
+                self.triggerTable = self.parseTriggerTable(a[2:])
+            else:
+                self.mixerTables[page - 1] = a[2:].view('<i1')
+        else:
+            self.badPackets += 1
+
+    @staticmethod
+    def parseTriggerTable(data):
+        """Rows of (count, delay, length, chans), as given to the server."""
+        rows = []
+        for entry in data.reshape(-1, 8).astype(int):
+            if not entry.any():
+                break
+            rows.append((entry[0] + (entry[1] << 8) + 1,
+                         entry[2] + (entry[3] << 8) + 4,
+                         entry[4] + 1, entry[5]))
+        return rows
+
+    def readback(self):
+        a = np.zeros(self.devClass.READBACK_LEN, dtype='<u1')
+        a[0] = self.build
+        a[2:4] = littleEndian(self.executionCount & 0xFFFF, 2)
+        return a.tostring()
+
+    def register(self, regs):
+        cls = self.devClass
+        mode = regs[0]
+        reps = regs[7] + (regs[8] << 8)
+        if mode == cls.RUN_MODE_REGISTER_READBACK:
+            self.send(self.readback())
+        elif mode in (cls.RUN_MODE_AVERAGE_AUTO, cls.RUN_MODE_AVERAGE_DAISY):
+            run = lambda: self.runAverage(reps)
+            if mode == cls.RUN_MODE_AVERAGE_AUTO:
+                run()
+            else:
+                self.armed = run
+        elif mode in (cls.RUN_MODE_DEMOD_AUTO, cls.RUN_MODE_DEMOD_DAISY):
+            run = lambda: self.runDemod(reps)
+            if mode == cls.RUN_MODE_DEMOD_AUTO:
+                run()
+            else:
+                self.armed = run
+
+    def repTime(self):
+        return 4e-9 * sum(count * (delay + rlen)
+                          for count, delay, rlen, chans in self.triggerTable)
+
+    def runAverage(self, reps):
+        cls = self.devClass
+        def finish():
+            for _ in range(cls.AVERAGE_PACKETS):
+                self.send('\x00' * cls.AVERAGE_PACKET_LEN)
+        self.startRun(reps, self.repTime(), lambda start, stop: [], finish)
+
+    def runDemod(self, reps):
+        self.startRun(reps, self.repTime(), self.demodPackets)
+
+    def demodPackets(self, start, stop):
+        """Demodulator packets for repetitions start to stop-1."""
+        cls = self.devClass
+        if not self.triggerTable:
+            return []
+        nTriggers = sum(row[0] for row in self.triggerTable)
+        rchan = self.triggerTable[0][3]
+        perPacket = cls.DEMOD_CHANNELS_PER_PACKET
+        perStat = -(-nTriggers * rchan // perPacket)
+        nStats = stop - start
+        iq = np.zeros((nStats, perStat * perPacket, 2), dtype='<i2')
+        used = iq[:, :nTriggers * rchan].reshape(nStats, nTriggers, rchan, 2)
+        used[..., 0] = np.arange(rchan)
+        used[..., 1] = (np.arange(start, stop) & 0x7FFF)[:, None, None]
+        pkts = np.zeros((nStats * perStat, cls.DEMOD_PACKET_LEN + 2),
+                        dtype='<u1')
+        pkts[:, :4 * perPacket] = iq.view('<u1').reshape(-1, 4 * perPacket)
+        counts = np.arange(start * perStat, stop * perStat) + 1
+        pkts[:, 44] = counts & 0xFF
+        pkts[:, 45] = (counts >> 8) & 0xFF
+        pkts[:, 46] = np.tile(np.arange(perStat), nStats) & 0xFF
+        return [row.tostring() for row in pkts]
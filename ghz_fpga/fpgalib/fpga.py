@@ -18,6 +18,11 @@ TIMEOUT_FACTOR = 10
 
 USE_LOGGING_PACKETS = False
 
+# Boards returning more packets than this read them in chunks of this many
+# packets while the sequence is still running, rather than collecting them all
+# before reading.
+STREAM_CHUNK_PACKETS = 1024
+
 
 class FPGA(DeviceWrapper):
     """Manages communication with a single GHz FPGA board.
@@ -135,6 +140,25 @@ class FPGA(DeviceWrapper):
         """
         return self.makePacket().read(nPackets)
     
+    def streamRead(self, nPackets, timeout, triggerCtx, decoder,
+                   chunk=STREAM_CHUNK_PACKETS):
+        """
+        Create a StreamingRead which reads nPackets in chunks and then
+        triggers the board group context.
+        
+        This takes the place of both collect and read. As with collect, the
+        trigger is only sent if all packets arrive before the timeout.
+        """
+        packets = []
+        for start in range(0, nPackets, chunk):
+            p = self.makePacket()
+            p.timeout(Value(timeout, 's'))
+            p.read(min(chunk, nPackets - start))
+            packets.append(p)
+        if triggerCtx is not None:
+            packets[-1].send_trigger(triggerCtx)
+        return StreamingRead(packets, decoder)
+    
     def discard(self, nPackets):
         """
         Create a direct ethernet server request that discards packets for this
@@ -186,6 +210,10 @@ class FPGA(DeviceWrapper):
         """Send data to serial interface"""
         raise NotImplementedError()
     
+    def _initPLL(self):
+        """Initialize PLL chip"""
+        raise NotImplementedError()
+    
     # Externally available board interaction functions.
     # These run in test mode.
     
@@ -218,7 +246,7 @@ class FPGA(DeviceWrapper):
     
     def initPLL(self):
         """Initialize PLL chip"""
-        raise NotImplementedError()
+        return self.testMode(self._initPLL)
     
     # Utility methods
     
@@ -235,3 +263,78 @@ class FPGA(DeviceWrapper):
         eg. data taking, are halted until the test operation completes.
         """
         return self.boardGroup.testMode(func, *a, **kw)
+
+
+def packetRows(packets, start, stop, dtype):
+    """Get bytes start:stop of each packet as the rows of an array.
+    
+    The packets are joined into one buffer and the rows are a strided view of
+    it, so no copy is made of each packet. All packets must have the same
+    length.
+    """
+    dtype = np.dtype(dtype)
+    shape = (len(packets), (stop - start) // dtype.itemsize)
+    if not packets:
+        return np.zeros(shape, dtype=dtype)
+    length = len(packets[0])
+    raw = ''.join(packets)
+    if len(raw) != len(packets) * length or stop > length:
+        raise ValueError('Expected packets of at least {} bytes and all the '
+                         'same length'.format(stop))
+    return np.ndarray(shape, dtype=dtype, buffer=raw, offset=start,
+                      strides=(length, dtype.itemsize))
+
+
+class PacketDecoder(object):
+    """Decode packets from one board into a preallocated array.
+    
+    Each packet contributes the bytes data[start:stop] as one row of the
+    array, so packets can be decoded as they arrive instead of all at once at
+    the end. finish, if given, turns the filled array into the final result.
+    """
+    
+    def __init__(self, nPackets, start, stop, dtype, finish=None):
+        dtype = np.dtype(dtype)
+        self.start = start
+        self.stop = stop
+        self.finish = finish
+        self.data = np.empty((nPackets, (stop - start) // dtype.itemsize),
+                             dtype=dtype)
+        self.count = 0
+    
+    def add(self, packets):
+        """Decode a list of packets (byte strings) into the next rows."""
+        n = len(packets)
+        self.data[self.count:self.count + n] = packetRows(
+                packets, self.start, self.stop, self.data.dtype)
+        self.count += n
+    
+    def result(self):
+        """Get the decoded data once all packets have been added."""
+        if self.count != len(self.data):
+            raise RuntimeError('Decoded {} of {} packets'.format(
+                    self.count, len(self.data)))
+        if self.finish is None:
+            return self.data
+        return self.finish(self.data)
+
+
+class StreamingRead(object):
+    """Chunked read of a board's data, used in place of a collect packet.
+    
+    The chunks are sent one after another in the board's context, and each
+    one is decoded while the next is on the wire. send() returns a deferred
+    firing with the decoder once all chunks are read, or failing if any
+    chunk times out.
+    """
+    
+    def __init__(self, packets, decoder):
+        self.packets = packets
+        self.decoder = decoder
+    
+    @inlineCallbacks
+    def send(self):
+        for p in self.packets:
+            ans = yield p.send()
+            self.decoder.add([data for src, dst, eth, data in ans.read])
+        returnValue(self.decoder)
@@ -9,6 +9,16 @@ IDLE_NUM_BITS = 15
 IDLE_MIN_CYCLES = 0
 IDLE_MAX_CYCLES = (2 ** IDLE_NUM_BITS) - 1
 
+# The board plays one SRAM cell (4 ns) per FPGA cycle.
+CYCLE_TIME = 4e-9
+# Entries visited before we give up on a table that never ends.
+MAX_SEQUENCE_STEPS = 100000
+
+# Jump table entries as an array. On the board each entry is a 3 byte from
+# address, a 3 byte to address and a 2 byte op code.
+ENTRY_DTYPE = np.dtype([('from_addr', '<u4'), ('to_addr', '<u4'),
+                        ('op', '<u2')])
+
 
 class JumpEntry(object):
     """A single entry in the jump table.
@@ -56,6 +66,85 @@ class JumpEntry(object):
         return data
 
 
+def entry_array(jumps):
+    """Get jump table entries as a structured array.
+
+    :param list[JumpEntry] jumps: the entries
+    :return: ndarray with dtype ENTRY_DTYPE, one element per entry
+    :rtype: np.ndarray
+    """
+    return np.array([(jump.from_addr, jump.to_addr, jump.operation.code())
+                     for jump in jumps], dtype=ENTRY_DTYPE)
+
+
+def sequence_cycles(start_addr, entries, counters):
+    """Number of FPGA cycles from the start address until END finishes.
+
+    Follows the entries the way the board does: one SRAM cell is played
+    per cycle up to the from address of the active entry, IDLE holds for
+    its count + 1 cycles, JUMP and CYCLE play one more cell and go to their
+    to address, and END plays two more cells before stopping. CHECK
+    depends on the daisy chain at run time and is taken as not firing.
+    Once a CYCLE comes around twice with the other counters in the same
+    state, the rest of its passes are added in one step, so the time does
+    not depend on the counter values.
+
+    :param int start_addr: SRAM cell at which the sequence starts.
+    :param np.ndarray entries: entries with dtype ENTRY_DTYPE, the first
+        of which is jump index 1.
+    :param list[int] counters: count value of each counter.
+    :return: number of cycles
+    :rtype: int
+    :raises ValueError: if the entries never reach an END.
+    """
+    from_addrs = entries['from_addr'].tolist()
+    to_addrs = entries['to_addr'].tolist()
+    ops = entries['op'].tolist()
+    count = [0] * len(counters)
+    # Entry index of each CYCLE -> (count, other counts, cycles) when we
+    # last went back.
+    passes = {}
+    addr, i, cycles = start_addr, 0, 0
+    for _ in range(MAX_SEQUENCE_STEPS):
+        if not 0 <= i < len(ops) or from_addrs[i] < addr:
+            break
+        op = ops[i]
+        cycles += from_addrs[i] - addr + 1
+        addr, nexti = from_addrs[i] + 1, i + 1
+        if op & 0x7 == 0x7:  # END
+            return cycles + 2
+        elif op & 0x1 == 0:  # IDLE
+            cycles += (op >> 1) + 1
+            addr += 1
+        elif op & 0x7 == 0x3:  # CYCLE
+            c = (op >> 4) & 0x3
+            others = count[:c] + count[c + 1:]
+            last = passes.get(i)
+            if count[c] < counters[c] and last is not None and \
+                    last[:2] == (count[c] - 1, others):
+                # The remaining passes take as long as the last one.
+                cycles += (cycles - last[2]) * (counters[c] - count[c])
+                count[c] = counters[c]
+            if count[c] < counters[c]:
+                passes[i] = (count[c], others, cycles)
+                count[c] += 1
+                cycles += 1
+                addr, nexti = to_addrs[i], ((op >> 8) & 0x3F) - 1
+            else:
+                count[c] = 0
+        elif op & 0xF == 0xD:  # JUMP
+            cycles += 1
+            addr, nexti = to_addrs[i], ((op >> 8) & 0x3F) - 1
+        i = nexti
+    raise ValueError("Jump table does not reach an END entry.")
+
+
+def _bytes(values, n):
+    """Little endian bytes of each value, as an array of shape (len, n)."""
+    words = np.ascontiguousarray(values, dtype='<u4')
+    return words.view('u1').reshape(len(words), 4)[:, :n]
+
+
 # Operations (ie op codes)
 
 class Operation(object):
@@ -76,6 +165,11 @@ class Operation(object):
         """
         raise NotImplementedError()
 
+    def code(self):
+        """Get the op code as an int."""
+        data = self.as_bytes()
+        return int(data[0]) + (int(data[1]) << 8)
+
 
 class IDLE(Operation):
     """Idle operation
@@ -258,14 +352,16 @@ class JumpTable(object):
             ith counter.
         start_addr (int): SRAM address at which to start sequence.
         jumps (list of JumpEntry): Ordered list of jump table entries.
-
-    TODO: make self.jumps a property with some checking on type and
-        number.
+            Assign a new list to change them, rather than changing the
+            list in place, so that entries is kept up to date.
+        entries (np.ndarray): jumps as an array with dtype ENTRY_DTYPE.
     """
     PACKET_LEN = 528
     COUNTER_BITS = 32  # 32 bit register for counters
     COUNT_MAX = 2**COUNTER_BITS - 1
     NUM_COUNTERS = 4
+    ENTRIES_OFFSET = 24  # counters, start address and start op come first
+    MAX_ENTRIES = (PACKET_LEN - ENTRIES_OFFSET) // 8
 
     def __init__(self, start_addr=None, jumps=None, counters=None):
         """
@@ -279,6 +375,18 @@ class JumpTable(object):
         self.start_addr = start_addr
         self.jumps = jumps
 
+    @property
+    def jumps(self):
+        return self._jumps
+
+    @jumps.setter
+    def jumps(self, jumps):
+        if jumps is not None and len(jumps) > self.MAX_ENTRIES:
+            raise ValueError("Cannot have more than {} jump table entries, "
+                             "got {}.".format(self.MAX_ENTRIES, len(jumps)))
+        self._jumps = jumps
+        self.entries = entry_array(jumps or [])
+
     @classmethod
     def _initialize_counters(cls, counters=None):
         if counters is None:
@@ -297,6 +405,14 @@ class JumpTable(object):
                 c.append(0)
         return c
 
+    def sequence_time_sec(self):
+        """Time from the start address until END finishes, in seconds.
+
+        See sequence_cycles. Raises ValueError if the table never ends.
+        """
+        cycles = sequence_cycles(self.start_addr, self.entries, self.counters)
+        return cycles * CYCLE_TIME
+
     def __str__(self):
         counter = '\n'.join(
             "Counter {}: {}".format(
@@ -315,17 +431,20 @@ class JumpTable(object):
         """Serialize jump table to a byte string for the FPGA"""
         data = np.zeros(self.PACKET_LEN, dtype='<u1')
         # Set counter values. Each one is 4 bytes
-        for i, c in enumerate(self.counters):
-            data[i * 4:(i + 1) * 4] = littleEndian(c, 4)
+        data[0:16] = _bytes(self.counters, 4).reshape(-1)
         # Set start address
         data[16:19] = littleEndian(self.start_addr, 3)
         data[19:22] = littleEndian(self.start_addr, 3)
         # Start op code
         data[22] = 5
         data[23] = 0
-        for i, jump in enumerate(self.jumps):
-            ofs = 24 + i * 8
-            data[ofs:ofs+8] = jump.as_bytes()
+        # Entries, 8 bytes each
+        n = len(self.entries)
+        table = data[self.ENTRIES_OFFSET:self.ENTRIES_OFFSET + 8 * n]
+        table = table.reshape(n, 8)
+        table[:, 0:3] = _bytes(self.entries['from_addr'], 3)
+        table[:, 3:6] = _bytes(self.entries['to_addr'], 3)
+        table[:, 6:8] = _bytes(self.entries['op'], 2)
         return data.tostring()
 
     def pretty_string(self):
@@ -0,0 +1,272 @@
+"""
+Run the FPGA server's board group against emulated boards.
+
+Unlike test_fpga_server, which inspects the packets the server builds, these
+tests send them through fpgalib.emulator and check what comes back, so they
+cover BoardGroup.run and the device read/extract code end to end.
+"""
+
+import mock
+import numpy as np
+import pytest
+from labrad.units import Value
+from twisted.internet import defer, task
+
+import fpgalib.adc as adc
+import fpgalib.emulator as emulator
+import fpgalib.fpga as fpga
+import ghz_fpga_server
+
+GROUP = 'Test'
+
+
+def _sync(d):
+    """Get the result of a deferred that has already fired."""
+    results = []
+    d.addBoth(results.append)
+    assert results, 'deferred has not fired'
+    if hasattr(results[0], 'raiseException'):
+        results[0].raiseException()
+    return results[0]
+
+
+def _make_server(boards, **kw):
+    """Make an FPGA server with one board group of emulated boards.
+
+    boards is a list of (board type, board number, build).
+    """
+    server = ghz_fpga_server.FPGAServer()
+    server.initServer()
+    # Not connected to labrad, so there is no client to send setup packets.
+    server.client = None
+    de = emulator.DirectEthernetEmulator(**kw)
+    bg = ghz_fpga_server.BoardGroup(server, de, 0)
+    server.boardGroups[de._labrad_name, 0] = bg
+    _sync(bg.init())
+    bg.configure(GROUP, [('{} {}'.format(kind, board), 0)
+                         for kind, board, build in boards])
+    for guid, (kind, board, build) in enumerate(boards):
+        em_cls = {'DAC': emulator.DacEmulator, 'ADC': emulator.AdcEmulator}
+        de.addBoard(em_cls[kind](board, build))
+        name = '{} {} {}'.format(GROUP, kind, board)
+        dev = fpga.REGISTRY[kind, build](guid, name)
+        _sync(dev.connect(name, bg, de, 0, board, build))
+        server.devices[dev.guid, dev.name] = dev
+    ctx = server.newContext(1)
+    server.initContext(ctx)
+    return server, ctx, de, bg
+
+
+def _setup_adc(server, c, name, trigger_table, n_demods):
+    server.select_device(c, name)
+    server.adc_run_mode(c, 'demodulate')
+    server.start_delay(c, 0)
+    server.adc_trigger_table(c, trigger_table)
+    for ch in range(n_demods):
+        server.adc_mixer_table(c, ch, np.zeros((256, 2), dtype=int))
+
+
+def test_detect_boards():
+    clock = task.Clock()
+    boards = [('DAC', 1, 15), ('DAC', 2, 8), ('ADC', 3, 7)]
+    server, c, de, bg = _make_server(boards, clock=clock)
+    # DAC 6 is configured but not turned on yet, DAC 4 is not configured.
+    bg.configure(GROUP, [('DAC 1', 0), ('DAC 2', 0), ('ADC 3', 0),
+                         ('DAC 6', 0)])
+    de.addBoard(emulator.DacEmulator(4, 8))
+    d = bg.detectBoards()
+    # Detection waits for DAC 6 until the timeout.
+    assert not d.called
+    clock.advance(1)
+    found = sorted(_sync(d))
+    assert [name for name, args in found] == [
+        'Test ADC 3', 'Test DAC 1', 'Test DAC 2', 'Test DAC 4']
+    assert [args[-1] for name, args in found] == [7, 15, 8, 8]
+
+    # Once DAC 6 is on, we only ping boards we have no device for, without
+    # waiting for running sequences, and stop as soon as DAC 6 answers.
+    de.addBoard(emulator.DacEmulator(6, 15))
+    _sync(bg.runLock.acquire())
+    with mock.patch.object(de.boards[0, fpga.REGISTRY['DAC', 8].macFor(2)],
+                           'receive') as receive:
+        found = sorted(_sync(bg.detectBoards(newOnly=True)))
+    assert not receive.called
+    assert [name for name, args in found] == [
+        'Test ADC 3', 'Test DAC 1', 'Test DAC 2', 'Test DAC 4', 'Test DAC 6']
+    assert [args[-1] for name, args in found] == [7, 15, 8, 8, 15]
+    assert clock.seconds() == 1
+
+
+def test_detect_unlisted_board_type():
+    clock = task.Clock()
+    server, c, de, bg = _make_server([('DAC', 1, 8)], clock=clock)
+    de.addBoard(emulator.AdcEmulator(5, 7))
+    # No ADC is configured, so ADC detection waits for the full timeout
+    # rather than stopping once the configured DAC has answered.
+    d = bg.detectBoards()
+    assert not d.called
+    clock.advance(1)
+    found = sorted(_sync(d))
+    assert [name for name, args in found] == ['Test ADC 5', 'Test DAC 1']
+
+
+def test_run_sequence_dac_timing():
+    server, c, de, bg = _make_server([('DAC', 1, 8)])
+    name = 'Test DAC 1'
+    server.select_device(c, name)
+    # Two timers per rep: start, stop, start, stop, branch to start.
+    server.dac_memory(c, [0x400000, 0x400001, 0x400000, 0x400001, 0xF00000])
+    server.dac_sram(c, np.zeros(64, dtype='u4'))
+    server.sequence_boards(c, [name])
+    server.sequence_timing_order(c, [name])
+    data = _sync(server.run_sequence(c, 45, True))
+    # reps are rounded up to 60.
+    assert data.shape == (1, 1, 120)
+    assert np.array_equal(data[0, 0], np.repeat(np.arange(60), 2))
+    assert de.boards[0, fpga.REGISTRY['DAC', 8].macFor(1)].badPackets == 0
+
+
+def test_run_sequence_jump_table_adc(monkeypatch):
+    monkeypatch.setattr(fpga, 'STREAM_CHUNK_PACKETS', 16)
+    server, c, de, bg = _make_server([('DAC', 1, 15), ('ADC', 2, 7)])
+    server.select_device(c, 'Test DAC 1')
+    server.jump_table_clear(c)
+    server.jump_table_add_entry(c, 'END', 256)
+    server.dac_sram(c, np.zeros(512, dtype='u4'))
+    _setup_adc(server, c, 'Test ADC 2', [(3, 100, 50, 4)], 4)
+    server.sequence_boards(c, ['Test DAC 1', 'Test ADC 2'])
+    server.sequence_timing_order(c, ['Test ADC 2::0', 'Test ADC 2::3'])
+    # 12 I/Q pairs per rep take 2 packets; 40 packets are streamed.
+    reps = 20
+    data = _sync(server.run_sequence(c, reps, True))
+    assert data.shape == (2, reps, 3, 2)
+    assert np.all(data[0, ..., 0] == 0)
+    assert np.all(data[1, ..., 0] == 3)
+    assert np.array_equal(data[1, :, 2, 1], np.arange(reps))
+    # The same sequence again is served from the upload cache, and the ADC
+    # tables are not sent again.
+    adc_board = de.boards[0, fpga.REGISTRY['ADC', 7].macFor(2)]
+    with mock.patch.object(adc_board, 'receive',
+                           wraps=adc_board.receive) as receive:
+        _sync(server.run_sequence(c, reps, True, [], ['a']))
+        assert bg.uploadCacheHits == 1
+        # A new setup state from the caller doesn't resend the tables.
+        _sync(server.run_sequence(c, reps, True, [], ['b']))
+        sizes = [len(call[0][0]) for call in receive.call_args_list]
+        assert sizes.count(adc.ADC_Build7.SRAM_MIXER_PKT_LEN) == 0
+        # Changing a mixer table resends all tables of the board.
+        server.adc_mixer_table(c, 3, np.ones((256, 2), dtype=int))
+        _sync(server.run_sequence(c, reps, True, [], ['b']))
+        sizes = [len(call[0][0]) for call in receive.call_args_list]
+        assert sizes.count(adc.ADC_Build7.SRAM_MIXER_PKT_LEN) == 5
+
+
+def test_pipelined_runs_with_latency():
+    clock = task.Clock()
+    server, c, de, bg = _make_server([('DAC', 1, 8)], clock=clock,
+                                     timeScale=1.0)
+    de.latency = 0.001
+    name = 'Test DAC 1'
+    server.select_device(c, name)
+    # A delay of 25000 cycles of 40 ns: 1 ms per rep.
+    server.dac_memory(c, [0x400000, 0x3061A7, 0x400001, 0xF00000])
+    server.dac_sram(c, np.zeros(64, dtype='u4'))
+    server.sequence_boards(c, [name])
+    server.sequence_timing_order(c, [name])
+    runs = [server.run_sequence(c, 30, True) for _ in range(3)]
+    results = []
+    for d in runs:
+        d.addBoth(results.append)
+    assert results == []
+    for _ in range(1000):
+        clock.advance(0.001)
+        if len(results) == 3:
+            break
+    assert len(results) == 3
+    for data in results:
+        assert np.array_equal(data[0, 0], np.arange(30))
+    # Each run waits for the previous one to finish.
+    assert 3 * 0.030 <= clock.seconds() < 3 * 0.035
+    assert bg.stageTimes.percentiles([50])[0][1] == 3
+
+
+def test_timeout_recovery():
+    clock = task.Clock()
+    server, c, de, bg = _make_server([('DAC', n, 8) for n in (1, 2, 3)],
+                                     clock=clock)
+    names = ['Test DAC {}'.format(n) for n in (1, 2, 3)]
+    for name in names:
+        server.select_device(c, name)
+        server.dac_memory(c, [0x400000, 0x400001, 0xF00000])
+        server.dac_sram(c, np.zeros(64, dtype='u4'))
+    server.timeout_recovery_budget(c, Value(0.5, 's'))
+    devs = [server.devices[name] for name in names]
+
+    def run():
+        runners = [dev.buildRunner(30, c[dev]) for dev in devs]
+        d = bg.run(runners, 30, [], set(), 249, True, names)
+        return d, max(runner.seqTime for runner in runners)
+
+    # Boards 2 and 3 stop answering.
+    missing = [de.boards.pop((0, dev.MAC)) for dev in devs[1:]]
+    d, seqTime = run()
+    clock.advance(seqTime)
+    # Both unanswered pings time out together, within the budget.
+    clock.advance(0.5)
+    with pytest.raises(ghz_fpga_server.TimeoutError) as exc:
+        _sync(d)
+    report = str(exc.value).splitlines()
+    assert report[1] == 'Test DAC 1: OK. Executions: expected=30, actual=30'
+    for line in report[2:]:
+        assert 'timeout!' in line and 'ping failed' in line
+
+    # Recovery sent the missing triggers, so the next run goes ahead.
+    for board in missing:
+        de.boards[0, board.MAC] = board
+    d, seqTime = run()
+    data = _sync(d)
+    assert len(data) == 3
+
+    # Retries reuse the runners, so a ping that works again clears the
+    # earlier failure from the report.
+    runners = [dev.buildRunner(30, c[dev]) for dev in devs]
+    results = [(True, None)] * 3
+    board = de.boards.pop((0, devs[2].MAC))
+    d = bg.recoverFromTimeout(runners, results)
+    clock.advance(0.5)
+    _sync(d)
+    assert 'ping failed' in bg.timeoutReport(runners, results)
+    de.boards[0, board.MAC] = board
+    _sync(bg.recoverFromTimeout(runners, results))
+    report = bg.timeoutReport(runners, results)
+    assert 'ping failed' not in report
+    assert 'unknown' not in report
+
+
+def test_board_group_bringup():
+    clock = task.Clock()
+    server, c, de, bg = _make_server([('DAC', 1, 8), ('DAC', 2, 15),
+                                      ('ADC', 3, 7)], clock=clock)
+    bg.clock = clock
+    # The emulated boards have no DAC chips to calibrate, so we fake the
+    # results for DAC 1. DAC 2 fails as the registry has no lvdsSD for it.
+    dev = server.devices['Test DAC 1']
+    lvds = (True, -1, -1, 3, (range(16), [False] * 16, [False] * 16), 1)
+    fifo = (True, False, 2, 1, 3)
+    bist = (True, (1, 2), (1, 2), (1, 2))
+    with mock.patch.multiple(dev,
+            _setLVDS=lambda *a: defer.succeed(lvds),
+            _setFIFO=lambda *a: defer.succeed(fifo),
+            _runBIST=lambda *a: defer.succeed(bist)):
+        d = server.board_group_bringup(c, GROUP)
+        # All PLLs settle at the same time, without blocking.
+        assert not d.called
+        clock.advance(ghz_fpga_server.PLL_RESET_DELAY)
+        report = _sync(d)
+    channel = 'LVDS ok SD=3, FIFO ok PHOF=2 tries=1, BIST ok'
+    assert report[0] == ('Test DAC 1', True,
+                         'A: {0}; B: {0}'.format(channel))
+    assert report[1] == ('Test DAC 2', False, "error: KeyError: 'lvdsSD'")
+    assert report[2] == ('Test ADC 3', True, 'PLL initialized')
+    # The board group is usable again.
+    assert bg.pipeSemaphore.tokens == ghz_fpga_server.NUM_PAGES
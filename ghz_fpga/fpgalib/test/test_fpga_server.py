@@ -18,13 +18,18 @@ being sent to the boards.
 
 """
 
+import StringIO
+
 import mock
 import numpy as np
 import pytest
+from twisted.internet import defer
 
+import fpgalib.adc as adc
 import fpgalib.dac as dac
 import fpgalib.fpga as fpga
 import fpgalib.jump_table as jump_table
+import fpgalib.util as util
 import ghz_fpga_server
 from labrad.units import Value
 
@@ -192,6 +197,327 @@ class TestFPGAServer(object):
             # check JT
             assert np.array_equal(matching_jt_packet, load_writes[0])
 
+    def test_make_sram_partial_derp(self):
+        # 1.5 derps of SRAM on page 1 of a paged (build 8) DAC.
+        dev_cls = fpga.REGISTRY[('DAC', 8)]
+        sram_data = np.arange(384, dtype='<u4') * 0x01010101
+        p = mock.MagicMock()
+        dev_cls.makeSRAM(sram_data.tostring(), p, page=1)
+        writes = [np.fromstring(x[0][0], dtype='u1')
+                  for x in p.write.call_args_list]
+        first_derp = dev_cls.SRAM_PAGE_LEN // dev_cls.SRAM_WRITE_PKT_LEN
+        assert len(writes) == 2
+        for i, w in enumerate(writes):
+            assert len(w) == 1026
+            assert w[0] + (w[1] << 8) == first_derp + i
+            assert np.array_equal(
+                w, dev_cls.pktWriteSram(first_derp + i,
+                                        sram_data[256 * i:256 * (i + 1)]))
+        assert writes[0][2:].tostring() == sram_data[:256].tostring()
+        assert writes[1][2:514].tostring() == sram_data[256:].tostring()
+        assert not writes[1][514:].any()
+
+    def test_jump_table_spacing(self):
+        dev_cls = fpga.REGISTRY[('DAC', DAC_BUILD)]
+        spacing = dev_cls.JT_MIN_FROM_ADDR_SPACING
+        entries = [jump_table.JumpEntry(addr, 0, jump_table.NOP())
+                   for addr in [400, 100, 300, 200]]
+        jt = dev_cls.make_jump_table(entries)
+        assert list(jt.entries['from_addr']) == [400, 100, 300, 200]
+        entries.append(
+                jump_table.JumpEntry(300 + spacing - 1, 0, jump_table.END()))
+        with pytest.raises(ValueError) as exc:
+            dev_cls.make_jump_table(entries)
+        assert 'Entries 2(NOP) and 4(END)' in str(exc.value)
+
+    def test_upload_cache(self):
+        s, c = self.server, self.ctx
+        sram_data = np.array(np.linspace(0, 0x3FFF, 256), dtype='<u4')
+        s.select_device(c, 1)
+        s.jump_table_clear(c)
+        s.jump_table_add_entry(c, 'END', 256)
+        s.dac_sram(c, sram_data)
+        s.sequence_boards(c, [self.dev.name])
+        s.sequence_timing_order(c, [])
+        self.dev.devName = self.dev.name
+        bg = ghz_fpga_server.BoardGroup(s, mock.MagicMock(), 0)
+
+        def load():
+            runner = self.dev.buildRunner(self.global_reps, c[self.dev])
+            p = runner.loadPacket(page=0, isMaster=True)
+            # The mock DE hands out the same packet every time.
+            self.dev.server = mock.MagicMock()
+            pkts, contents = bg.filterLoadPackets([(runner, p)], 0)
+            bg.commitUploadCache(contents, 0)
+            return pkts
+
+        assert len(load()) == 1
+        assert bg.uploadCacheMisses == 1
+        # Same JT and SRAM again: nothing to send.
+        assert load() == []
+        assert bg.uploadCacheHits == 1
+        # New JT, same SRAM: only the JT is written.
+        s.jump_table_clear(c)
+        s.jump_table_add_entry(c, 'END', 128)
+        pkts = load()
+        assert bg.uploadCacheTrims == 1
+        writes = pkts[0].write.call_args_list
+        assert len(writes) == 1
+        assert len(writes[0][0][0]) == jump_table.JumpTable.PACKET_LEN
+        # Invalidation forces a full upload.
+        bg.invalidateUploadCache()
+        load()
+        assert bg.uploadCacheMisses == 2
+
+    def test_upload_cache_paging(self):
+        dev = fpga.REGISTRY[('DAC', 8)](20, 'Test DAC 8')
+        dev.devName = dev.name
+        dev.server = mock.MagicMock()
+        dev.ctx = {}
+        bg = ghz_fpga_server.BoardGroup(self.server, mock.MagicMock(), 0)
+        n = dev.SRAM_PAGE_LEN
+        # Short SRAM fits in one page, long SRAM runs past the first page.
+        short = {'mem': [0x800000, 0xA00000 + n - 1, 0xC00000, 0xF00000],
+                 'sram': '\x01' * 4 * n}
+        long = {'mem': [0x800000, 0xA00000 + 2 * n - 1, 0xC00000, 0xF00000],
+                'sram': '\x02' * 8 * n}
+
+        def load(info, page):
+            runner = dev.buildRunner(30, info)
+            p = runner.loadPacket(page=page, isMaster=False)
+            pkts, contents = bg.filterLoadPackets([(runner, p)], page)
+            bg.commitUploadCache(contents, page)
+            return runner.pageable(), len(pkts)
+
+        assert load(long, 0) == (False, 1)
+        assert load(long, 0) == (False, 0)
+        # A pageable point on page 1 overwrites the end of the long SRAM,
+        # so the long point has to be loaded again.
+        assert load(short, 1) == (True, 1)
+        assert load(long, 0) == (False, 1)
+        # ...which in turn overwrites page 1.
+        assert load(short, 1) == (True, 1)
+        assert load(short, 0) == (True, 1)
+        assert load(short, 1) == (True, 0)
+        assert load(short, 0) == (True, 0)
+
+    def test_jump_table_cache(self):
+        dev = fpga.REGISTRY[('DAC', 15)](21, 'Test DAC 15')
+        info = {'jt_entries': [dev.make_jump_table_entry('END', [256])],
+                'jt_counters': [2], 'sram': ''}
+        runner_1 = dev.buildRunner(30, info)
+        # Same entries as new objects: the table is not serialized again.
+        info['jt_entries'] = [dev.make_jump_table_entry('END', [256])]
+        with mock.patch.object(jump_table.JumpTable, 'toString') as toString:
+            runner_2 = dev.buildRunner(30, info)
+        assert not toString.called
+        assert runner_2.jump_table_bytes is runner_1.jump_table_bytes
+        # Different counters make a new table.
+        info['jt_counters'] = [3]
+        runner_3 = dev.buildRunner(30, info)
+        assert runner_3.jump_table.counters == [3, 0, 0, 0]
+        assert runner_3.jump_table_bytes != runner_1.jump_table_bytes
+
+    def test_batch_add_point(self):
+        s, c = self.server, self.ctx
+        sram_1 = np.array(np.linspace(0, 0x3FFF, 256), dtype='<u4')
+        sram_2 = np.ones_like(sram_1)
+        s.select_device(c, 1)
+        s.batch_clear(c)
+        s.jump_table_clear(c)
+        s.jump_table_add_entry(c, 'END', 256)
+        s.dac_sram(c, sram_1)
+        assert s.batch_add_point(c, [], ['a']) == 1
+        s.jump_table_clear(c)
+        s.jump_table_add_entry(c, 'END', 128)
+        s.dac_sram(c, sram_2)
+        assert s.batch_add_point(c, [], ['b']) == 2
+        # Later changes to the context don't touch staged points.
+        s.dac_sram(c, sram_1)
+        (boards_1, _, state_1), (boards_2, _, state_2) = c['batch']
+        assert (state_1, state_2) == (['a'], ['b'])
+        runner_1 = self.dev.buildRunner(self.global_reps, boards_1[self.dev])
+        runner_2 = self.dev.buildRunner(self.global_reps, boards_2[self.dev])
+        assert runner_1.sram == sram_1.tostring()
+        assert runner_2.sram == sram_2.tostring()
+        assert (runner_1.jump_table.toString() !=
+                runner_2.jump_table.toString())
+        s.batch_clear(c)
+        assert c['batch'] == []
+
+    def test_streaming_read(self):
+        dev = fpga.REGISTRY[('DAC', 8)](10, 'Test DAC 8')
+        dev.devName = dev.name
+        dev.server = mock.MagicMock()
+        dev.ctx = {}
+        mem = [0x400000, 0x400001, 0xF00000]
+        runner = dev.buildRunner(30 * 2500, {'mem': mem, 'sram': ''})
+        assert runner.nPackets == 2500
+        assert runner.streamPacket(1.0, 0, []) is None
+        stream = runner.streamPacket(1.0, 0, [dev.devName])
+        assert isinstance(stream, fpga.StreamingRead)
+        # Chunks of 1024, 1024 and 452 packets.
+        assert len(stream.packets) == 3
+
+        timings = np.arange(30 * 2500, dtype='<u2')
+        packets = ['\x00' * 3 + timings[30 * i:30 * (i + 1)].tostring() +
+                   '\xff' * 3 for i in range(2500)]
+        chunks = [packets[:1024], packets[1024:2048], packets[2048:]]
+        dev.server.packet.return_value.send.side_effect = [
+            defer.succeed(mock.Mock(read=[('', '', 0, data) for data in c]))
+            for c in chunks]
+        decoders = []
+        stream.send().addCallback(decoders.append)
+        assert np.array_equal(decoders[0].result(), runner.extract(packets))
+        assert decoders[0].result().dtype == runner.extract(packets).dtype
+
+    def test_extract_timing(self):
+        dev = fpga.REGISTRY[('DAC', 8)](10, 'Test DAC 8')
+        dev.devName = dev.name
+        # Two timers per rep.
+        mem = [0x400000, 0x400001, 0x400000, 0x400001, 0xF00000]
+        runner = dev.buildRunner(30, {'mem': mem, 'sram': ''})
+        timings = np.arange(60, dtype='<u2')
+        packets = ['\x01' * 3 + timings[30 * i:30 * (i + 1)].tostring() +
+                   '\xff' * 7 for i in range(2)]
+        data = runner.extract(packets)
+        assert data.dtype == np.uint32
+        assert np.array_equal(data, timings)
+        with pytest.raises(RuntimeError):
+            runner.extract(packets[:1])
+        with pytest.raises(ValueError):
+            runner.extract([packets[0], packets[1][:-1]])
+
+    def test_sequence_time(self):
+        # Start, 10 us delay, SRAM call of 400 words (10 cycles + 1), stop.
+        mem = [0x400000, 0x3000F9, 0x800064, 0xA001F3, 0xC00000, 0x400001,
+               0xF00000, 0x3FFFFF]
+        assert dac.MemorySequence.sequenceCycles(mem) == 1 + 250 + 1 + 1 + \
+            11 + 1 + 2
+        # Without addresses we fall back to the longest SRAM call.
+        assert dac.MemorySequence.sequenceCycles([0xC00000]) == 300
+        with pytest.raises(Exception):
+            dac.MemorySequence.sequenceCycles([0x500000])
+        dev = fpga.REGISTRY[('DAC', 8)](10, 'Test DAC 8')
+        runner = dev.buildRunner(30, {'mem': mem, 'sram': ''})
+        assert runner.memTime == pytest.approx(267 * 40e-9)
+        assert runner.seqTime == pytest.approx(
+            fpga.TIMEOUT_FACTOR * 30 * 267 * 40e-9 + 1)
+
+        # 1 us of SRAM played 3 times, then 2 us of idle, plus loop delay.
+        dev = fpga.REGISTRY[('DAC', 15)](11, 'Test DAC 15')
+        entries = [dev.make_jump_table_entry('CYCLE', [1000, 0, 0, 0]),
+                   dev.make_jump_table_entry('IDLE', [1200, 2000]),
+                   dev.make_jump_table_entry('END', [1400])]
+        runner = dev.buildRunner(10, {'jt_entries': entries,
+                                      'jt_counters': [2], 'sram': '',
+                                      'loop_delay': 5})
+        cycles = 3 * 249 + 2 + 50 + 501 + 48 + 2
+        assert runner.memTime == pytest.approx(cycles * 4e-9 + 5e-6)
+
+    def test_memory_transforms(self):
+        dev = fpga.REGISTRY[('DAC', 8)](10, 'Test DAC 8')
+        mem = [0x400000, 0x800010, 0xA0001F, 0xC00000, 0x400001, 0xF00000]
+        shifted = dev.shiftSRAM(mem, 1)
+        assert shifted.dtype == np.uint32
+        assert list(shifted) == [0x400000, 0x800010 + dev.SRAM_PAGE_LEN,
+                                 0xA0001F + dev.SRAM_PAGE_LEN, 0xC00000,
+                                 0x400001, 0xF00000]
+        assert dac.maxSRAM(mem) == 0x1F
+        assert dac.MemorySequence.timerCount(mem) == 1
+        delayed = dac.MemorySequence.addMasterDelay(mem)
+        assert list(delayed[3:5]) == [0x300032, 0xC00000]
+        sram = ('\x00' * 40, '\x00' * 80, 2)
+        fixed = dac.MemorySequence.fixSRAMaddresses(mem, sram, dev)
+        assert list(fixed[1:3]) == [
+            0x800000 + dev.SRAM_BLOCK0_LEN - 10,
+            0xA00000 + dev.SRAM_BLOCK0_LEN + 20 + 2 * dev.SRAM_DELAY_LEN - 1]
+        assert list(fixed[3:]) == mem[3:]
+        with pytest.raises(Exception):
+            dac.MemorySequence.fixSRAMaddresses(mem + [0xC00000], sram, dev)
+        # A dual block runner ends up with the fixed array.
+        runner = dev.buildRunner(30, {'mem': mem, 'sram': sram})
+        assert np.array_equal(runner.mem, fixed)
+        assert runner.nTimers == 1
+
+    def test_extract_demod(self):
+        # 2 stats of 3 triggers on 5 channels: 15 I/Q pairs, 2 packets/stat.
+        trigger_table = [(3, 10, 20, 5)]
+        iq = np.arange(2 * 3 * 5 * 2).reshape(2, 3, 5, 2)
+        packets = []
+        for stat in range(2):
+            vals = np.zeros(44, dtype='<i2')
+            vals[:30] = iq[stat].reshape(-1)
+            for i in range(2):
+                counters = [(2 * stat + i + 1) & 0xFF, 0x01, i, 0]
+                packets.append(vals[22 * i:22 * (i + 1)].tostring() +
+                               np.array(counters, dtype='u1').tostring())
+        data, pkt_counters, rb_counters = adc.ADC_Build7.extractDemod(
+                packets, trigger_table, 'iq')
+        assert data.shape == (5, 2, 3, 2)
+        assert np.array_equal(data, iq.transpose(2, 0, 1, 3))
+        assert list(pkt_counters) == [0, 1, 0, 1]
+        assert list(rb_counters) == [0x101, 0x102, 0x103, 0x104]
+        rows = np.frombuffer(''.join(packets), dtype='u1').reshape(4, 48)
+        from_rows = adc.ADC_Build7.extractDemod(rows, trigger_table, 'iq')
+        assert np.array_equal(from_rows[0], data)
+
+    def test_adc_table_data(self):
+        dev_cls = adc.ADC_Build7
+        trigger_table = [(1, 30, 50, 12), (300, 260, 128, 12)]
+        data = np.fromstring(dev_cls.triggerTableData(trigger_table),
+                             dtype='u1')
+        assert len(data) == dev_cls.SRAM_RETRIGGER_PKT_LEN
+        assert list(data[:18]) == [0, 0,
+                                   0, 0, 26, 0, 49, 12, 0, 0,
+                                   43, 1, 0, 1, 127, 12, 0, 0]
+        assert not data[18:].any()
+        mixer_table = np.array([[127, -128], [-1, 2]] * 256)
+        data = np.fromstring(dev_cls.mixerTableData(2, mixer_table),
+                             dtype='i1')
+        assert len(data) == dev_cls.SRAM_MIXER_PKT_LEN
+        assert list(data[:8]) == [3, 0, 127, -128, -1, 2, 127, -128]
+        assert np.array_equal(data[2:], mixer_table.reshape(-1))
+
+    def test_pipeline_stage_times(self, tmpdir):
+        s, c = self.server, self.ctx
+        bg = ghz_fpga_server.BoardGroup(s, mock.MagicMock(), 0)
+        for i in range(1, 101):
+            bg.stageTimes.record({'load': 0.01 * i, 'read': 0.5})
+        bg.stageTimes.record({'load': 0.5, 'setup': 2.0})
+        with mock.patch.dict(s.boardGroups, {('DE', 0): bg}, clear=True):
+            csv = tmpdir.join('times.csv')
+            (name, stats), = s.pipeline_stage_times(c, str(csv))
+        assert name == ('DE', 0)
+        stats = dict((stat[0], stat[1:]) for stat in stats)
+        assert stats['load'][0] == 101
+        assert stats['load'][1] == pytest.approx(0.5)
+        assert stats['load'][4] == 1.0
+        assert stats['setup'] == (1, 2.0, 2.0, 2.0, 2.0)
+        assert stats['extract'][0] == 0
+        lines = csv.read().splitlines()
+        assert lines[0].split(',') == (['server', 'port'] +
+                                       list(ghz_fpga_server.PIPELINE_STAGES))
+        assert len(lines) == 102
+        assert lines[-1].split(',')[:3] == ['DE', '0', '']
+        # Later exports only append runs recorded since the last one.
+        bg.stageTimes.record({'load': 0.25})
+        with mock.patch.dict(s.boardGroups, {('DE', 0): bg}, clear=True):
+            s.pipeline_stage_times(c, str(csv))
+            s.pipeline_stage_times(c, str(csv))
+        lines = csv.read().splitlines()
+        assert len(lines) == 103
+        assert lines[-1].split(',')[:3] == ['DE', '0', '']
+        assert lines[-1].split(',')[4] == '0.250000'
+        # Runs dropped from the ring buffer before an export are skipped.
+        times = util.StageTimes(['load'], size=3)
+        for i in range(5):
+            times.record({'load': i})
+        f = StringIO.StringIO()
+        times.writeCSV(f)
+        assert f.getvalue().splitlines() == ['2.000000', '3.000000',
+                                             '4.000000']
+
     def _fake_run_sequence(self):
         """ Emulate some of the logic of run_sequence for testing purposes.
         """
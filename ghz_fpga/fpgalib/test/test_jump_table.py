@@ -71,5 +71,52 @@ def test_table():
     assert np.array_equal(data[32:40], end.as_bytes())
 
 
+def test_table_matches_entry_bytes():
+    jumps = [jump_table.JumpEntry(64 + 4 * i, 0x10203 + i,
+                                  jump_table.CYCLE(i % 4, i))
+             for i in range(jump_table.JumpTable.MAX_ENTRIES - 1)]
+    jumps.append(jump_table.JumpEntry(0x0A0B0C, 0, jump_table.END()))
+    jt = jump_table.JumpTable(0x123456, jumps, [0xDEADBEEF, 1, 2, 3])
+    data = np.fromstring(jt.toString(), dtype='u1')
+    assert len(data) == jump_table.JumpTable.PACKET_LEN
+    assert list(data[0:8]) == [0xEF, 0xBE, 0xAD, 0xDE, 1, 0, 0, 0]
+    assert list(data[16:24]) == [0x56, 0x34, 0x12, 0x56, 0x34, 0x12, 5, 0]
+    expected = np.concatenate([jump.as_bytes() for jump in jumps])
+    assert np.array_equal(data[24:], expected)
+
+
+def test_table_entries():
+    jt = jump_table.JumpTable(0)
+    assert len(jt.entries) == 0
+    jt.jumps = [jump_table.JumpEntry(64, 259, jump_table.JUMP(2))]
+    assert jt.entries['from_addr'][0] == 64
+    assert jt.entries['to_addr'][0] == 259
+    assert jt.entries['op'][0] == (2 << 8) + 13
+    too_many = [jump_table.JumpEntry(4 * i, 0, jump_table.NOP())
+                for i in range(jump_table.JumpTable.MAX_ENTRIES + 1)]
+    with pytest.raises(ValueError):
+        jt.jumps = too_many
+
+
+def test_sequence_cycles():
+    # Play cells 10-40, repeat 21-40 twice and idle for 100 cycles, all of
+    # that 1000 times, then end.
+    inner = jump_table.JumpEntry(40, 21, jump_table.CYCLE(1, 1))
+    idle = jump_table.JumpEntry(50, 0, jump_table.IDLE(100))
+    outer = jump_table.JumpEntry(60, 10, jump_table.CYCLE(0, 1))
+    end = jump_table.JumpEntry(80, 0, jump_table.END())
+    jt = jump_table.JumpTable(10, [inner, idle, outer, end], [999, 2])
+    body = 31 + 2 * (1 + 20) + 10 + 101 + 9
+    cycles = 1000 * body + 999 + 20 + 2
+    assert jump_table.sequence_cycles(jt.start_addr, jt.entries,
+                                      jt.counters) == cycles
+    assert jt.sequence_time_sec() == pytest.approx(
+        cycles * jump_table.CYCLE_TIME)
+    # A table that jumps back forever has no END to reach.
+    loop = jump_table.JumpEntry(40, 10, jump_table.JUMP(1))
+    with pytest.raises(ValueError):
+        jump_table.JumpTable(10, [loop]).sequence_time_sec()
+
+
 if __name__ == '__main__':
     pytest.main(['-v', __file__])
\ No newline at end of file
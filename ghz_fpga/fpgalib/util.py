@@ -1,5 +1,10 @@
+import collections
+import hashlib
+import itertools
 import time
 import os
+
+import numpy as np
 from twisted.internet import defer
 
 DUMP_NUM = 0
@@ -41,6 +46,20 @@ def littleEndian(data, bytes=4):
     return [(data >> ofs) & 0xFF for ofs in (0, 8, 16, 24)[:bytes]]
 
 
+def contentHash(data, dtype='<u4'):
+    """Get a digest identifying data to be uploaded to a board.
+
+    data may be a byte string, a numpy array or a list of words. Lists are
+    packed with dtype before hashing, so a list of memory commands and the
+    equivalent array give the same digest. Returns None for None.
+    """
+    if data is None:
+        return None
+    if not isinstance(data, str):
+        data = np.ascontiguousarray(data, dtype=dtype).tostring()
+    return hashlib.sha1(data).digest()
+
+
 class TimedLock(object):
     """
     A lock that times how long it takes to acquire.
@@ -102,6 +121,81 @@ class TimedLock(object):
             d.callback(dt)
 
 
+class RunTimer(object):
+    """
+    Times consecutive stages of one run.
+
+    Each call to lap(stage) adds the time since the previous lap (or since
+    the timer was created) to that stage.
+    """
+
+    def __init__(self):
+        self.times = {}
+        self.last = time.time()
+
+    def lap(self, stage):
+        now = time.time()
+        self.times[stage] = self.times.get(stage, 0) + now - self.last
+        self.last = now
+
+
+class StageTimes(object):
+    """
+    Keeps the duration of each stage of the most recent runs.
+
+    Each run is recorded as a dict of stage name to seconds. Stages missing
+    from a run (e.g. setup when the setup state was unchanged) are left out
+    of the statistics for that stage.
+    """
+
+    RUNS_TO_KEEP = 1000
+
+    def __init__(self, stages, size=RUNS_TO_KEEP):
+        self.stages = tuple(stages)
+        self.runs = collections.deque(maxlen=size)
+        # Runs recorded in total, and how many of those writeCSV has seen.
+        self.recorded = 0
+        self.written = 0
+
+    def record(self, times):
+        """Add the stage times of one run, dropping the oldest if full."""
+        self.runs.append(dict(times))
+        self.recorded += 1
+
+    def clear(self):
+        self.runs.clear()
+        self.written = self.recorded
+
+    def percentiles(self, qs=(50, 90, 99)):
+        """Get (stage, count, [percentiles], max) in seconds for each stage."""
+        ans = []
+        for stage in self.stages:
+            times = [run[stage] for run in self.runs if stage in run]
+            if times:
+                ans.append((stage, len(times),
+                            [float(p) for p in np.percentile(times, qs)],
+                            max(times)))
+            else:
+                ans.append((stage, 0, [0.0] * len(qs), 0.0))
+        return ans
+
+    def writeCSV(self, f, prefix=()):
+        """Write one line per new run to file object f, oldest first.
+
+        Only runs recorded since the last call are written, so calling this
+        repeatedly does not write any run twice. Each line starts with the
+        values in prefix, followed by the time of each stage in seconds
+        (empty if the run did not have that stage).
+        """
+        new = min(self.recorded - self.written, len(self.runs))
+        self.written = self.recorded
+        for run in itertools.islice(self.runs, len(self.runs) - new, None):
+            fields = [str(x) for x in prefix]
+            fields += ['{:.6f}'.format(run[stage]) if stage in run else ''
+                       for stage in self.stages]
+            f.write(','.join(fields) + '\n')
+
+
 # class LoggingPacketWrapper(object):
     # def __init__(self, packet, outFile=None):
         # self._packet = packet
@@ -149,7 +243,6 @@ def dumpPacketWithHash(file, p, name):
     print str(p)
     toWrite = repr(p)
     file.write(toWrite)
-    import hashlib
     m = hashlib.md5()
     m.update(toWrite)
     hash = m.digest()
@@ -165,14 +165,6 @@
 
 from __future__ import with_statement
 
-"""
-TODO
-cmdTime_cycles does not properly estimate sram length
-
-
-"""
-
-
 """
 ### BEGIN NODE INFO
 [info]
@@ -190,6 +182,7 @@ timeout = 20
 ### END NODE INFO
 """
 
+import copy
 import itertools
 import logging
 import os
@@ -200,7 +193,7 @@ import time
 
 import numpy as np
 
-from twisted.internet import defer
+from twisted.internet import defer, reactor, task
 from twisted.internet.defer import inlineCallbacks, returnValue
 
 from labrad import types as T, units as U
@@ -212,7 +205,7 @@ import labrad.util
 import fpgalib.adc as adc
 import fpgalib.dac as dac
 import fpgalib.fpga as fpga
-from fpgalib.util import TimedLock, LoggingPacket
+from fpgalib.util import TimedLock, LoggingPacket, RunTimer, StageTimes
 
 
 # The logging level is set at the bottom of the file where the server starts.
@@ -232,6 +225,17 @@ LOGGING_PACKET = False
 
 NUM_PAGES = 2
 
+# Seconds to wait for boards to answer pings when recovering from a timeout.
+# All boards are pinged at once, so this bounds the time taken to recover.
+TIMEOUT_RECOVERY_BUDGET = 1.0
+
+# Seconds to let the PLL settle after initializing it in DAC bringup.
+PLL_RESET_DELAY = 0.1
+
+# Stages of BoardGroup.run which are timed for each run, in pipeline order.
+PIPELINE_STAGES = ('makePackets', 'pageLock', 'load', 'runLock', 'trigger',
+                   'setup', 'readLock', 'collect', 'read', 'extract')
+
 I2C_RB = 0x100
 I2C_ACK = 0x200
 I2C_RB_ACK = I2C_RB | I2C_ACK
@@ -282,7 +286,16 @@ class BoardGroup(object):
         self.readLock = TimedLock()
         self.setupState = set()
         self.runWaitTimes = []
+        self.stageTimes = StageTimes(PIPELINE_STAGES)
         self.prevTriggers = 0
+        # What we last loaded onto each page of each board, as (pageable,
+        # dict of content hashes) per (devName, page). See filterLoadPackets.
+        self.pageContents = {}
+        self.uploadCacheHits = 0
+        self.uploadCacheTrims = 0
+        self.uploadCacheMisses = 0
+        # Used to wait without blocking, e.g. in bringup.
+        self.clock = reactor
 
     @inlineCallbacks
     def init(self):
@@ -309,14 +322,37 @@ class BoardGroup(object):
         self.boardOrder = ['{} {}'.format(name, boardName) for
                            (boardName, delay) in boards]
         self.boardDelays = [delay for (boardName, delay) in boards]
+        # Detection stops waiting once all of these have answered.
+        self.configuredMACs = set()
+        for boardName, delay in boards:
+            try:
+                boardType, board = boardName.rsplit(' ', 1)
+                cls = {'DAC': dac.DAC, 'ADC': adc.ADC}[boardType]
+                self.configuredMACs.add(cls.macFor(int(board)))
+            except (KeyError, ValueError):
+                logging.warning('Unknown board "{}" in board group "{}"'
+                                .format(boardName, name))
 
     @inlineCallbacks
-    def detectBoards(self):
+    def detectBoards(self, newOnly=False):
         """Detect boards on the ethernet adapter managed by this board group.
 
         The autodetect operation is guarded by board group locks so that it
         will not conflict with sequences running on this board group.
+
+        If newOnly is True, we only ping MAC addresses for which we have no
+        device yet, and report the known devices as found without talking to
+        them. Since running sequences only use known boards, this is done
+        without taking the locks.
         """
+        if newOnly:
+            known = self.devices()
+            skip = set(dev.MAC for dev in known)
+            found = yield self._detectAll(skip)
+            found += [(dev.name, (dev.name, self, self.directEthernetServer,
+                                  self.port, dev.board, dev.build))
+                      for dev in known]
+            returnValue(found)
         try:
             # Acquire all locks so we can ping boards without interfering with
             # board group operations.
@@ -326,17 +362,10 @@ class BoardGroup(object):
                 yield pageLock.acquire()
             yield self.runLock.acquire()
             yield self.readLock.acquire()
+            # Re-detected boards may have been power cycled or reprogrammed.
+            self.invalidateUploadCache()
 
-            # Detect each board type in its own context.
-            detections = [self.detectDACs(), self.detectADCs()]
-            answer = yield defer.DeferredList(detections, consumeErrors=True)
-            found = []
-            for success, result in answer:
-                if success:
-                    found.extend(result)
-                else:
-                    print 'autodetect error:'
-                    result.printTraceback()
+            found = yield self._detectAll()
 
             # Clear detection packets which may be buffered in device contexts.
             # TODO: check that this actually clears packets.
@@ -355,7 +384,22 @@ class BoardGroup(object):
             self.runLock.release()
             self.readLock.release()
 
-    def detectDACs(self, timeout=1.0):
+    @inlineCallbacks
+    def _detectAll(self, skip=()):
+        """Detect DAC and ADC boards, except at MAC addresses in skip."""
+        # Detect each board type in its own context.
+        detections = [self.detectDACs(skip), self.detectADCs(skip)]
+        answer = yield defer.DeferredList(detections, consumeErrors=True)
+        found = []
+        for success, result in answer:
+            if success:
+                found.extend(result)
+            else:
+                print 'autodetect error:'
+                result.printTraceback()
+        returnValue(found)
+
+    def detectDACs(self, skip=(), timeout=1.0):
         """Try to detect DAC boards on this board group."""
         def callback(src, data):
             board = int(src[-2:], 16)
@@ -366,9 +410,9 @@ class BoardGroup(object):
             return (devName, args)
         macs = [dac.DAC.macFor(board) for board in range(256)]
         return self._doDetection(macs, dac.DAC.regPing(),
-                                 dac.DAC.READBACK_LEN, callback)
+                                 dac.DAC.READBACK_LEN, callback, timeout, skip)
 
-    def detectADCs(self, timeout=1.0):
+    def detectADCs(self, skip=(), timeout=1.0):
         """Try to detect ADC boards on this board group."""
         def callback(src, data):
             board = int(src[-2:], 16)
@@ -379,10 +423,11 @@ class BoardGroup(object):
             return (devName, args)
         macs = [adc.ADC.macFor(board) for board in range(256)]
         return self._doDetection(macs, adc.ADC.regPing(),
-                                 adc.ADC.READBACK_LEN, callback)
+                                 adc.ADC.READBACK_LEN, callback, timeout, skip)
 
     @inlineCallbacks
-    def _doDetection(self, macs, packet, respLength, callback, timeout=1.0):
+    def _doDetection(self, macs, packet, respLength, callback, timeout=1.0,
+                     skip=()):
         """
         Try to detect a boards at the specified mac addresses.
 
@@ -390,7 +435,17 @@ class BoardGroup(object):
         from one of the given mac addresses, the callback function will be
         called and should return data to be added to the list of found
         devices.
+
+        Mac addresses in skip are not pinged, as their boards are known.
+        Responses are read in bulk. Once every configured board among the mac
+        addresses has answered or is in skip, we stop waiting and only pick up
+        those other responses which have already arrived. If none of the mac
+        addresses belong to configured boards, we wait the full timeout.
         """
+        configured = self.configuredMACs & set(macs)
+        macs = [mac for mac in macs if mac not in skip]
+        if not macs:
+            returnValue([])
         try:
             ctx = self.directEthernetServer.context()
 
@@ -405,18 +460,33 @@ class BoardGroup(object):
                 p.write(packet.tostring())
             yield p.send(context=ctx)
             # Listen for responses.
-            start = time.time()
+            deadline = self.clock.seconds() + timeout
+            pending = set(macs)
+            missing = configured & pending
             found = []
-            while (len(found) < len(macs)) and (time.time() - start < timeout):
+
+            def process(packets):
+                for src, dst, eth, data in packets:
+                    if src in pending:
+                        pending.remove(src)
+                        missing.discard(src)
+                        found.append(callback(src, data))
+
+            # Wait for all configured boards of this type or, if there are
+            # none, for every mac address to answer.
+            while pending and (missing or not configured):
+                n = len(missing) or len(pending)
+                remaining = max(deadline - self.clock.seconds(), 0)
+                p = self.directEthernetServer.packet(context=ctx)
+                p.timeout(T.Value(remaining, 's'))
+                p.read(n)
                 try:
-                    ans = yield self.directEthernetServer.read(1, context=ctx)
-                    src, dst, eth, data = ans[0]
-                    if src in macs:
-                        devInfo = callback(src, data)
-                        found.append(devInfo)
-                except T.Error as e:
-                    logging.error('timeout exception: {}'.format(e))
+                    ans = yield p.send()
+                except T.Error:
                     break  # Read timeout.
+                process(ans.read)
+            packets = yield self._readWaiting(ctx, len(pending))
+            process(packets)
             returnValue(found)
         finally:
             # Expire the detection context.
@@ -424,6 +494,29 @@ class BoardGroup(object):
             yield cxn.manager.expire_context(self.directEthernetServer.ID,
                                              context=ctx)
 
+    @inlineCallbacks
+    def _readWaiting(self, ctx, maxPackets):
+        """Read the packets already waiting in a direct ethernet context.
+
+        At most maxPackets are read, all in one request. We find how many are
+        waiting by bisection, using collects which return immediately.
+        """
+        lo, hi = 0, maxPackets
+        while lo < hi:
+            n = (lo + hi + 1) // 2
+            p = self.directEthernetServer.packet(context=ctx)
+            p.timeout(T.Value(0, 's'))
+            p.collect(n)
+            try:
+                yield p.send()
+                lo = n
+            except T.Error:
+                hi = n - 1
+        if not lo:
+            returnValue([])
+        ans = yield self.directEthernetServer.read(lo, context=ctx)
+        returnValue(ans)
+
     def devices(self):
         """
         Return a list of known device objects belonging to this board group.
@@ -444,6 +537,8 @@ class BoardGroup(object):
         for i in xrange(NUM_PAGES):
             yield self.pipeSemaphore.acquire()
         try:
+            # Test mode commands write SRAM and registers directly.
+            self.invalidateUploadCache()
             ans = yield func(*a, **kw)
             returnValue(ans)
         finally:
@@ -480,7 +575,9 @@ class BoardGroup(object):
         are in the time-critical pipeline sections
 
 
-        loadPkts: list of packets, one for each board
+        loadPkts: list of (runner, packet), one for each board. Data
+                  already resident on the boards is filtered out by
+                  filterLoadPackets once the page is locked.
         setupPkts: list of (packet, setup state). Only for ADC
         runPkts: wait, run, both. These packets are sent in the master
                  context, and are placed carefully in order so that the
@@ -488,8 +585,13 @@ class BoardGroup(object):
         collectPkts: list of packets, one for each board. These packets
                      tell the direct ethernet server to collect, and then
                      if successful, send triggers to the master context.
+                     Boards returning a lot of data get a
+                     fpga.StreamingRead instead, which reads and decodes
+                     the data in chunks as it arrives before sending the
+                     trigger.
         readPkts: list of packets. Simply read back data from direct
-                  ethernet buffer for each board's context.
+                  ethernet buffer for each board's context. None for
+                  boards whose collect packet is a StreamingRead.
 
         Packets generated by dac and adc objects are make with the
         context set to that device's context. This ensures that the
@@ -507,7 +609,7 @@ class BoardGroup(object):
                 isMaster = len(loadPkts) == 0
                 p = runner.loadPacket(page, isMaster)
                 if p is not None:
-                    loadPkts.append(p)
+                    loadPkts.append((runner, p))
 
         # Setup board state (not pipelined).
         # Build a list of (setupPacket, setupState).
@@ -548,9 +650,16 @@ class BoardGroup(object):
         runPkts = self.makeRunPackets(boards)
         # Collect and read (or discard) timing results.
         seqTime = max(runner.seqTime for runner in runners)
-        collectPkts = [runner.collectPacket(seqTime, self.ctx)
-                       for runner in runners]
-        readPkts = [runner.readPacket(timingOrder) for runner in runners]
+        collectPkts = []
+        readPkts = []
+        for runner in runners:
+            p = runner.streamPacket(seqTime, self.ctx, timingOrder)
+            if p is None:
+                collectPkts.append(runner.collectPacket(seqTime, self.ctx))
+                readPkts.append(runner.readPacket(timingOrder))
+            else:
+                collectPkts.append(p)
+                readPkts.append(None)
 
         return loadPkts, setupPkts, runPkts, collectPkts, readPkts
 
@@ -615,14 +724,15 @@ class BoardGroup(object):
 
         # Prepare packets.
         logging.info('making packets')
+        timer = RunTimer()
         pkts = self.makePackets(runners, page, reps, timingOrder, sync)
         loadPkts, boardSetupPkts, runPkts, collectPkts, readPkts = pkts
 
-        # Add setup packets from boards (ADCs) to that provided in the args:
-        # setupPkts is a list.
-        # setupState is a set.
-        setupPkts.extend(pkt for pkt, state in boardSetupPkts)
+        # Add setup states from boards (ADCs) to that provided in the args.
+        # setupState is a set. The board setup packets are added to setupPkts
+        # when we know which of them are needed.
         setupState.update(state for pkt, state in boardSetupPkts)
+        timer.lap('makePackets')
 
         try:
             yield self.pipeSemaphore.acquire()
@@ -632,6 +742,11 @@ class BoardGroup(object):
                 for pageLock in pageLocks:  # Lock pages to be written.
                     yield pageLock.acquire()
                 logging.info('page locks acquired')
+                timer.lap('pageLock')
+                # Now that we hold the page, nobody else can change what is
+                # loaded on it, so we can leave out data already there.
+                loadPkts, loadContents = self.filterLoadPackets(loadPkts,
+                                                                page)
                 # Send load packets. Do not wait for response. We already
                 # acquired the page lock, so sending data to SRAM and memory is
                 # kosher at this time.
@@ -642,9 +757,18 @@ class BoardGroup(object):
                 # Send a request for the run lock, do not wait for response.
                 runNow = self.runLock.acquire()
                 try:
-                    yield loadDone  # wait until load is finished.
+                    try:
+                        yield loadDone  # wait until load is finished.
+                    except Exception:
+                        # We don't know what made it onto the boards.
+                        self.invalidateUploadCache(
+                                [name for name, _, _ in loadContents])
+                        raise
+                    self.commitUploadCache(loadContents, page)
+                    timer.lap('load')
                     yield runNow  # Wait for acquisition of the run lock.
                     logging.info('run lock acquired')
+                    timer.lap('runLock')
                     # Set the number of triggers needed before we can actually
                     # run. We expect to get one trigger for each board that
                     # had to run and return data. This is the number of
@@ -661,22 +785,27 @@ class BoardGroup(object):
                     # actual setup state, self.setupState are empty, we need
                     # to set things up. Also if the desired setup state isn't
                     # a subset of the actual one, we need to set up.
-                    # XXX Check what setup state means for ADC. Should this
-                    # include the trigger/demodulator tables or not?
+                    # For ADCs the setup state identifies the trigger and
+                    # mixer tables by content, so their setup packets are
+                    # only sent when the tables on the board are different.
                     needSetup = ((not setupState) or (not self.setupState) or
                                     (not (setupState <= self.setupState)))
                     if needSetup:
                         logging.info('needSetup = True')
+                        pkts = setupPkts + [
+                                pkt for pkt, state in boardSetupPkts
+                                if state not in self.setupState]
                         # we require changes to the setup state so first, wait
                         # for triggers indicating that the previous run has
                         # collected.
                         # If this fails, something BAD happened!
                         r = yield waitPkt.send()
                         logging.info('waitPkt sent')
+                        timer.lap('trigger')
                         try:
                             # Then set up
                             logging.info('sending setupPkts...')
-                            yield self.sendAll(setupPkts, 'Setup')
+                            yield self.sendAll(pkts, 'Setup')
                             logging.info('...setupPkts sent')
                             self.setupState = setupState
                         except Exception as e:
@@ -690,10 +819,12 @@ class BoardGroup(object):
                         logging.info('sending runPkt...')
                         yield runPkt.send()
                         logging.info('...runPkt sent')
+                        timer.lap('setup')
                     else:
                         # if this fails, something BAD happened!
                         logging.info('need setup = false')
                         r = yield bothPkt.send()
+                        timer.lap('trigger')
 
                     # Keep track of how long the packet waited before being
                     # able to run.
@@ -706,6 +837,7 @@ class BoardGroup(object):
 
                     yield self.readLock.acquire()  # wait for our turn to read
                     logging.info('read lock acquired')
+                    timer.lap('readLock')
                     # stage 3: collect
                     # Collect appropriate number of packets and then trigger
                     # the master context.
@@ -740,6 +872,7 @@ class BoardGroup(object):
                 # Wait for data to be collected.
                 results = yield collectAll
                 logging.info('results collected')
+                timer.lap('collect')
             finally:
                 for pageLock in pageLocks:
                     pageLock.release()
@@ -757,12 +890,21 @@ class BoardGroup(object):
             # stage 4: read
             # no timeout, so go ahead and read data
             boardOrder = [runner.dev.devName for runner in runners]
-            readAll = self.sendAll(readPkts, 'Read', boardOrder)
+            readNames = [name for name, p in zip(boardOrder, readPkts)
+                         if p is not None]
+            readAll = self.sendAll([p for p in readPkts if p is not None],
+                                   'Read', readNames)
             self.readLock.release()
-            # This line scales really badly with incrasing stats
-            # At 9600 stats the next line takes 10s out of 20s per
-            # sequence.
-            results = yield readAll  # wait for read to complete
+            # Boards with a lot of data were already read while collecting.
+            streamed = dict((runner.dev.devName, result.result())
+                            for runner, p, (success, result)
+                            in zip(runners, collectPkts, results)
+                            if isinstance(p, fpga.StreamingRead))
+            # This scales badly with increasing stats (10s out of 20s per
+            # sequence at 9600 stats), which is why large reads are streamed
+            # during the collect stage instead.
+            results = dict(zip(readNames, (yield readAll)))
+            timer.lap('read')
 
             # List the DACs that support the data readback.
             timingDataDACs = [runner.dev.devName for runner in runners
@@ -804,10 +946,13 @@ class BoardGroup(object):
                         # relevant part to the list of returned data
                         idx = boardOrder.index(boardName)
                         runner = runners[idx]
-                        result = [data for src, dest, eth, data in
-                                  results[idx]['read']]
-                        # Array of all timing results (DAC)
-                        extracted = runner.extract(result)
+                        if boardName in streamed:
+                            extracted = streamed[boardName]
+                        else:
+                            result = [data for src, dest, eth, data in
+                                      results[boardName]['read']]
+                            # Array of all timing results (DAC)
+                            extracted = runner.extract(result)
                         # Wrap the DAC timing results in a tuple for
                         # the data format consistency.
                         if type(runner) == dac.DacRunner_Build8:
@@ -826,10 +971,75 @@ class BoardGroup(object):
                     else:
                         extractedChannel = extracted
                     answers.append(extractedChannel)
+                timer.lap('extract')
+                self.stageTimes.record(timer.times)
                 returnValue(tuple(answers))
+            self.stageTimes.record(timer.times)
         finally:
             self.pipeSemaphore.release()
 
+    def filterLoadPackets(self, loadPkts, page):
+        """Leave out load data which is already resident on the boards.
+
+        loadPkts is a list of (runner, packet) from makePackets. Each runner's
+        loadHashes are compared with what we last loaded onto this page of
+        its board. Boards with everything resident are skipped entirely, and
+        boards with some parts resident get a trimmed packet from
+        runner.partialLoadPacket.
+
+        This must only be called while holding the page lock(s).
+
+        Returns (packets, contents), where contents is a list of
+        (devName, pageable, hashes) to be passed to commitUploadCache once the
+        packets have been sent.
+        """
+        packets = []
+        contents = []
+        for runner, p in loadPkts:
+            hashes = runner.loadHashes()
+            if not hashes:
+                packets.append(p)
+                continue
+            name = runner.dev.devName
+            resident = self.pageContents.get((name, page), (None, {}))[1]
+            same = set(part for part, h in hashes.items()
+                       if resident.get(part) == h)
+            if len(same) == len(hashes):
+                self.uploadCacheHits += 1
+            elif same:
+                self.uploadCacheTrims += 1
+                packets.append(runner.partialLoadPacket(page, same))
+            else:
+                self.uploadCacheMisses += 1
+                packets.append(p)
+            contents.append((name, runner.pageable(), hashes))
+        return packets, contents
+
+    def commitUploadCache(self, contents, page):
+        """Record data successfully loaded onto a page of each board."""
+        for name, pageable, hashes in contents:
+            if not pageable:
+                # Non-pageable data runs past the end of this page, so what
+                # we knew about the other pages of this board is stale.
+                self.invalidateUploadCache([name])
+            else:
+                # This page overwrites part of any non-pageable data.
+                for key, (wasPageable, _) in self.pageContents.items():
+                    if key[0] == name and not wasPageable:
+                        del self.pageContents[key]
+            self.pageContents[(name, page)] = (pageable, hashes)
+
+    def invalidateUploadCache(self, devNames=None):
+        """Forget what is loaded on the given boards (default all boards)."""
+        if devNames is None:
+            self.pageContents.clear()
+            self.setupState = set()
+            return
+        devNames = set(devNames)
+        for key in self.pageContents.keys():
+            if key[0] in devNames:
+                del self.pageContents[key]
+
     @inlineCallbacks
     def sendAll(self, packets, info, infoList=None):
         """Send a list of packets and wrap them up in a deferred list."""
@@ -854,11 +1064,11 @@ class BoardGroup(object):
 
     def extractTiming(self, packets):
         """Extract timing data coming back from a readPacket."""
-        data = ''.join(data[3:63] for data in packets)
-        return np.fromstring(data, dtype='<u2').astype('u4')
+        timings = fpga.packetRows(packets, 3, 63, '<u2')
+        return timings.astype('u4').reshape(-1)
 
     @inlineCallbacks
-    def recoverFromTimeout(self, runners, results):
+    def recoverFromTimeout(self, runners, results, budget=None):
         """Recover from a timeout error so that pipelining can proceed.
 
         The recovery proceeds as follows:
@@ -866,7 +1076,9 @@ class BoardGroup(object):
         (1) Get execution counts. For each board we clear the packet buffer and
         ping the board to see how many times it executed its SRAM sequence (or
         demod sequence for ADC boards). This count is stored in the runner
-        object for the board for later reporting to the user.
+        object for the board for later reporting to the user. All boards are
+        pinged at once and we wait at most budget seconds (default: the
+        server's recoveryBudget) for their answers.
 
         (2) Send triggers. After all boards have been pinged, we again clear
         the packet buffers for all boards and then send a trigger to the board
@@ -875,27 +1087,44 @@ class BoardGroup(object):
         collection failed.
         """
         print 'RECOVERING FROM TIMEOUT'
+        self.invalidateUploadCache()
+        if budget is None:
+            budget = self.fpgaServer.recoveryBudget
 
         # Get execution counts.
-        for runner, (success, result) in zip(runners, results):
-            yield runner.dev.clear().send()
-            try:
-                # NOTE: in the current implementation of regPing for DAC boards
-                # (build 15) the start field is set to master, which means when
-                # we ping these boards they will emit daisy chain signals.
-                p = runner.dev.regPingPacket()
-                p.timeout(U.Value(1.0, 's')).read(1)
-                resp = yield p.send()
-                regs = runner.dev.processReadback(resp.read[0][3])
-                runner.executionCount = regs.get('executionCounter', None)
-            except Exception:
-                logging.error('Exception in recoverFromTimeout', exc_info=True)
+        pings = yield defer.DeferredList(
+                [self._pingForExecutionCount(runner, budget)
+                 for runner in runners], consumeErrors=True)
+        # Runners are reused by retries, so set both fields every time.
+        for runner, (ok, result) in zip(runners, pings):
+            if ok:
+                runner.executionCount = result
+                runner.pingError = None
+            else:
+                runner.executionCount = 'unknown'
+                runner.pingError = result.getErrorMessage()
+                logging.error('Exception in recoverFromTimeout: {}: {}'.format(
+                        runner.dev.devName, runner.pingError))
 
         # Send triggers.
-        for runner, (success, result) in zip(runners, results):
-            yield runner.dev.clear().send()
-            if not success:
-                yield runner.dev.trigger(self.ctx).send()
+        yield defer.DeferredList(
+                [runner.dev.clear(None if success else self.ctx).send()
+                 for runner, (success, result) in zip(runners, results)],
+                consumeErrors=True)
+
+    @inlineCallbacks
+    def _pingForExecutionCount(self, runner, timeout):
+        """Clear a board's packet buffer, then ping it for its execution count.
+        """
+        yield runner.dev.clear().send()
+        # NOTE: in the current implementation of regPing for DAC boards
+        # (build 15) the start field is set to master, which means when
+        # we ping these boards they will emit daisy chain signals.
+        p = runner.dev.regPingPacket()
+        p.timeout(U.Value(timeout, 's')).read(1)
+        resp = yield p.send()
+        regs = runner.dev.processReadback(resp.read[0][3])
+        returnValue(regs.get('executionCounter', None))
 
     def timeoutReport(self, runners, results):
         """Create a nice error message explaining which boards timed out."""
@@ -907,6 +1136,8 @@ class BoardGroup(object):
                 expected=runner.reps,
                 actual=getattr(runner, 'executionCount', 'unknown')
             )
+            if getattr(runner, 'pingError', None) is not None:
+                line += ' (ping failed: {})'.format(runner.pingError)
             lines.append(line)
         return '\n'.join(lines)
 
@@ -916,6 +1147,9 @@ class FPGAServer(DeviceServer):
     """
     name = 'GHz FPGAs'
     retries = 5
+    recoveryBudget = TIMEOUT_RECOVERY_BUDGET
+    # Set while refreshing with Refresh New Devices.
+    detectNewOnly = False
 
     @inlineCallbacks
     def initServer(self):
@@ -1033,7 +1267,8 @@ class FPGAServer(DeviceServer):
             yield boardGroup.init()  # Gets context with direct ethernet.
             name, boards = config[server, port]
             boardGroup.configure(name, boards)
-            detections.append(boardGroup.detectBoards())  # Board detection.
+            # Board detection.
+            detections.append(boardGroup.detectBoards(self.detectNewOnly))
             groupNames.append(name)
         answer = yield defer.DeferredList(detections, consumeErrors=True)
         found = []
@@ -1157,6 +1392,27 @@ class FPGAServer(DeviceServer):
             devices = [name for name in devices if name.startswith(boardGroup)]
         return devices
 
+    @setting(13, 'Refresh New Devices', returns='*s')
+    def refresh_new_devices(self, c):
+        """Look for new boards without interrupting running sequences.
+
+        Like Refresh Devices, but boards we already have devices for are not
+        pinged again, so board groups need not be locked. Returns the names
+        of the devices added.
+        """
+        before = set(dev.name for dev in self.devices.values())
+
+        @inlineCallbacks
+        def refresh():
+            self.detectNewOnly = True
+            try:
+                yield self._doRefresh()
+            finally:
+                self.detectNewOnly = False
+        yield self._refreshLock.run(refresh)
+        after = set(dev.name for dev in self.devices.values())
+        returnValue(sorted(after - before))
+
     # Memory and SRAM upload.
 
     @setting(20, 'SRAM', data='*w: SRAM Words to be written', returns='')
@@ -1463,6 +1719,39 @@ class FPGAServer(DeviceServer):
         """
         logging.info('Run sequence')
         logging.debug('Setup packets: {}'.format(setupPkts))
+        devs, bg, timingOrder, reps = self._sequenceSetup(c, reps,
+                                                          getTimingData)
+
+        # build a list of runners which have necessary sequence information
+        # for each board
+        # print "fpga server: buildRunner reps: %s" % (reps, )
+        runners = [dev.buildRunner(reps, c.get(dev, {})) for dev in devs]
+
+        # build setup requests
+        setupReqs = _process_setup_packets(self.client, setupPkts)
+        logging.debug('Setup Reqs: {}'.format(setupReqs))
+
+        ans = yield self._runWithRetries(c, bg, runners, reps, setupReqs,
+                                         setupState, getTimingData,
+                                         timingOrder)
+        returnValue(ans)
+
+    def _sequenceSetup(self, c, reps, getTimingData):
+        """Get the boards, board group, timing order and reps for a sequence.
+
+        Returns (devs, boardGroup, timingOrder, reps), where reps has been
+        rounded up to a multiple of the DAC timing packet length if any DAC
+        is in the timing order.
+        """
+        if len(c['daisy_chain']):
+            # Run multiple boards, with first board as master.
+            devs = [self.getDevice(c, name) for name in c['daisy_chain']]
+        else:
+            # run the selected device only (must be a DAC)
+            devs = [self.selectedDAC(c)]
+
+        logging.info('You have {} devs'.format(len(devs)))
+
         # determine timing order
         if getTimingData:
             if c['timing_order'] is None:
@@ -1488,30 +1777,17 @@ class FPGAServer(DeviceServer):
                 reps -= reps % dac.DAC.TIMING_PACKET_LEN
                 break
 
-        if len(c['daisy_chain']):
-            # Run multiple boards, with first board as master.
-            devs = [self.getDevice(c, name) for name in c['daisy_chain']]
-        else:
-            # run the selected device only (must be a DAC)
-            devs = [self.selectedDAC(c)]
-
-        logging.info('You have {} devs'.format(len(devs)))
-
         # check to make sure that all boards are in the same board group
         if len(set(dev.boardGroup for dev in devs)) > 1:
             raise Exception('Can only run multiboard sequence if all boards '
                             'are in the same board group!')
         bg = devs[0].boardGroup
+        return devs, bg, timingOrder, reps
 
-        # build a list of runners which have necessary sequence information
-        # for each board
-        # print "fpga server: buildRunner reps: %s" % (reps, )
-        runners = [dev.buildRunner(reps, c.get(dev, {})) for dev in devs]
-
-        # build setup requests
-        setupReqs = _process_setup_packets(self.client, setupPkts)
-        logging.debug('Setup Reqs: {}'.format(setupReqs))
-
+    @inlineCallbacks
+    def _runWithRetries(self, c, bg, runners, reps, setupReqs, setupState,
+                        getTimingData, timingOrder):
+        """Run a sequence on a board group, retrying if boards time out."""
         # run the sequence, with possible retries if it fails
         retries = self.retries
         attempt = 1
@@ -1526,7 +1802,7 @@ class FPGAServer(DeviceServer):
                     if (getTimingData and isinstance(runner, adc.AdcRunner) and
                             runner.runMode == 'demodulate' and
                             runner.dev.devName in timingOrder):
-                        c[runner.dev]['ranges'] = runner.ranges
+                        c.setdefault(runner.dev, {})['ranges'] = runner.ranges
                 if ans is not None:
                     ans = np.asarray(ans)
                 returnValue(ans)
@@ -1548,6 +1824,107 @@ class FPGAServer(DeviceServer):
                         logfile.write('retrying...')
                         attempt += 1
 
+    @setting(51, 'Run Sequence Batch',
+             reps='w',
+             getTimingData='b',
+             stack='b',
+             returns=['*5i', '*4i', '*3i', '*2i', ''])
+    def run_sequence_batch(self, c, reps=30, getTimingData=True, stack=True):
+        """Run all points staged with "Batch Add Point", pipelined.
+
+        This is like calling Run Sequence once per point, except that all
+        points run from one request. The server keeps up to NUM_PAGES points
+        in the board group pipeline at a time, so the next point is loaded
+        while the current one runs without the client needing several
+        requests in flight. Daisy chain, timing order and master sync are
+        taken from this context and are the same for every point; each
+        point has its own board settings, setup packets and setup state.
+        The staged points are cleared.
+
+        Args:
+            reps: number of repetitions for every point, as in Run Sequence.
+            getTimingData: whether to return data, as in Run Sequence.
+            stack: if True, return the data of all points as one array with
+                the point as the first index. Each point's data has the
+                format described in Run Sequence, so all points must return
+                data of the same shape. If False, return nothing, and get
+                the data of each point with "Batch Result".
+        """
+        points = c.get('batch', [])
+        c['batch'] = []
+        c['batch_results'] = []
+        devs, bg, timingOrder, reps = self._sequenceSetup(c, reps,
+                                                          getTimingData)
+        logging.info('Run sequence batch of {} points'.format(len(points)))
+
+        results = []
+        running = []
+        try:
+            for boards, setupPkts, setupState in points:
+                if len(running) >= NUM_PAGES:
+                    # Wait for the oldest point before queueing another, so
+                    # that we don't build packets for the whole batch at once.
+                    ans = yield running.pop(0)
+                    results.append(ans)
+                runners = [dev.buildRunner(reps, boards.get(dev, {}))
+                           for dev in devs]
+                setupReqs = _process_setup_packets(self.client, setupPkts)
+                running.append(self._runWithRetries(
+                        c, bg, runners, reps, setupReqs, setupState,
+                        getTimingData, timingOrder))
+            while running:
+                ans = yield running.pop(0)
+                results.append(ans)
+        finally:
+            if running:
+                # A point failed; let the ones still in the pipeline finish
+                # before reporting the error.
+                yield defer.DeferredList(running, consumeErrors=True)
+
+        if not getTimingData or not results:
+            return
+        if not stack:
+            c['batch_results'] = results
+            return
+        shapes = set(ans.shape for ans in results)
+        if len(shapes) > 1:
+            raise Exception('Cannot stack points with data shapes {}. Use '
+                            'stack=False.'.format(sorted(shapes)))
+        returnValue(np.array(results))
+
+    @setting(56, 'Batch Add Point',
+             setupPkts='?{(((ww), s, ((s?)(s?)(s?)...))...)}',
+             setupState='*s',
+             returns='w')
+    def batch_add_point(self, c, setupPkts, setupState):
+        """Stage the current sequence as the next point of a batch.
+
+        This takes a copy of the SRAM, memory, jump table, start delay and
+        ADC settings of every board in this context, so they can be changed
+        for the next point right away. setupPkts and setupState have the
+        same meaning as in Run Sequence. Returns the number of points staged.
+        """
+        boards = dict((dev, copy.deepcopy(info)) for dev, info in c.items()
+                      if isinstance(dev, fpga.FPGA))
+        c.setdefault('batch', []).append((boards, setupPkts,
+                                          list(setupState)))
+        return len(c['batch'])
+
+    @setting(57, 'Batch Clear', returns='')
+    def batch_clear(self, c):
+        """Discard staged points and results of the last batch."""
+        c['batch'] = []
+        c['batch_results'] = []
+
+    @setting(58, 'Batch Result', index='w', returns=['*4i', '*3i', '*2i'])
+    def batch_result(self, c, index):
+        """Get the data of one point of the last unstacked batch run."""
+        results = c.get('batch_results', [])
+        if not 0 <= index < len(results):
+            raise Exception('Batch has {} results, not point {}.'.format(
+                    len(results), index))
+        return results[index]
+
     @setting(52, 'Daisy Chain', boards='*s', returns='*s')
     def sequence_boards(self, c, boards=None):
         """
@@ -1648,6 +2025,78 @@ class FPGAServer(DeviceServer):
                                          runWaitTime, readTime)))
         return ans
 
+    @setting(60, 'Upload Cache Stats', returns='*((sw)(www))')
+    def upload_cache_stats(self, c):
+        """Get counts of load packets saved by the upload cache.
+
+        For each board group this returns the number of board loads which
+        were:
+            skipped, because all data was already on the board page
+            trimmed, because some of the data was already there
+            sent in full
+
+        The cache is cleared by test mode commands, timeouts and board
+        detection.
+        """
+        ans = []
+        for (server, port), group in sorted(self.boardGroups.items()):
+            ans.append(((server, port), (group.uploadCacheHits,
+                                         group.uploadCacheTrims,
+                                         group.uploadCacheMisses)))
+        return ans
+
+    @setting(61, 'Pipeline Stage Times', csvPath='s',
+             returns='*((sw)*(swvvvv))')
+    def pipeline_stage_times(self, c, csvPath=''):
+        """Get statistics of how long each stage of recent runs took.
+
+        For each board group this returns, for every stage of the run
+        pipeline, (stage, number of runs, median, 90th percentile,
+        99th percentile, max), with times in seconds. The stages are:
+            makePackets: building packets for all boards
+            pageLock: waiting for a free page
+            load: sending SRAM and memory
+            runLock: waiting for our turn to run
+            trigger: waiting for the previous run to finish
+            setup: sending setup packets, when the setup state changed
+            readLock: waiting for the previous run to be read
+            collect: waiting for the boards to return data
+            read: reading data from the direct ethernet server
+            extract: decoding the data
+
+        Only runs which complete without error are included. If csvPath is
+        given, the times of each run since the last export are also appended
+        to that file, one line per run with the board group server and port
+        first.
+        """
+        ans = []
+        for (server, port), group in sorted(self.boardGroups.items()):
+            stats = [(stage, count, p50, p90, p99, tmax)
+                     for stage, count, (p50, p90, p99), tmax
+                     in group.stageTimes.percentiles((50, 90, 99))]
+            ans.append(((server, port), stats))
+        if csvPath:
+            newFile = not os.path.isfile(csvPath)
+            with open(csvPath, 'a') as f:
+                if newFile:
+                    f.write(','.join(('server', 'port') + PIPELINE_STAGES))
+                    f.write('\n')
+                for (server, port), group in sorted(self.boardGroups.items()):
+                    group.stageTimes.writeCSV(f, (server, port))
+        return ans
+
+    @setting(62, 'Timeout Recovery Budget', budget='v[s]', returns='v[s]')
+    def timeout_recovery_budget(self, c, budget=None):
+        """Set or get how long to wait for pings after a sequence times out.
+
+        When boards time out, all boards in the group are pinged at once to
+        get their execution counts. Boards which do not answer within this
+        time are reported as failed pings, and the retry goes ahead.
+        """
+        if budget is not None:
+            self.recoveryBudget = budget['s']
+        return U.Value(self.recoveryBudget, 's')
+
     @setting(200, 'PLL Init', returns='')
     def pll_init(self, c, data):
         """Sends the initialization sequence to the PLL. (DAC and ADC)
@@ -1724,6 +2173,7 @@ class FPGAServer(DeviceServer):
         This command just writes data into the board's SRAM buffer, that's it.
         """
         dev = self.selectedDAC(c)
+        dev.boardGroup.invalidateUploadCache([dev.devName])
         yield dev._sendSRAM(np.array(data, dtype='<u4').tostring())
 
     @setting(1082, 'Jump Table Add Entry',
@@ -2073,10 +2523,72 @@ class FPGAServer(DeviceServer):
         (string, data) with all the calibration parameters.
         """
         dev = self.selectedDAC(c)
+        ans = yield dev.testMode(self._dacBringup, dev, lvdsOptimize, lvdsSD,
+                                 signed, targetFifo)
+        returnValue(ans)
+
+    @setting(1310, 'Board Group Bringup',
+             name='s',
+             lvdsOptimize='b',
+             lvdsSD='w',
+             signed='b',
+             targetFifo='w',
+             returns='*(sbs)')
+    def board_group_bringup(self, c, name, lvdsOptimize=False, lvdsSD=None,
+                            signed=True, targetFifo=None):
+        """Runs the bringup procedure on all boards in a board group.
+
+        Each DAC goes through the same steps as DAC Bringup and each ADC the
+        same as ADC Bringup, but all boards are brought up at the same time,
+        with the board group held in test mode throughout. A board which
+        fails does not stop the others.
+
+        Returns a list of (board name, success, summary), one for each board
+        in daisy-chain order.
+        """
+        bg = self.getBoardGroup(name)
+        devs = [self.devices[devName] for devName in bg.boardOrder
+                if devName in self.devices]
+
+        def bringup(dev):
+            if isinstance(dev, dac.DAC):
+                d = self._dacBringup(dev, lvdsOptimize, lvdsSD, signed,
+                                     targetFifo)
+                return d.addCallback(_dac_bringup_summary)
+            d = dev._initPLL()
+            return d.addCallback(lambda _: (True, 'PLL initialized'))
+
+        @inlineCallbacks
+        def func():
+            results = yield defer.DeferredList([bringup(dev) for dev in devs],
+                                               consumeErrors=True)
+            report = []
+            for dev, (success, result) in zip(devs, results):
+                if success:
+                    report.append((dev.name,) + result)
+                else:
+                    msg = '{}: {}'.format(result.type.__name__,
+                                          result.getErrorMessage())
+                    logging.error('Bringup of {} failed: {}'.format(
+                        dev.name, msg))
+                    report.append((dev.name, False, 'error: ' + msg))
+            returnValue(report)
+
+        ans = yield bg.testMode(func)
+        returnValue(ans)
+
+    @inlineCallbacks
+    def _dacBringup(self, dev, lvdsOptimize, lvdsSD, signed, targetFifo):
+        """Bring up one DAC board. Must be called in test mode.
+
+        Returns the calibration results of each DAC channel as for
+        DAC Bringup.
+        """
         ans = []
-        yield dev.initPLL()
-        time.sleep(0.100)
-        yield dev.resetPLL()
+        yield dev._initPLL()
+        yield task.deferLater(dev.boardGroup.clock, PLL_RESET_DELAY,
+                              lambda: None)
+        yield dev._resetPLL()
         for dac in ['A', 'B']:
             ansDAC = [('dac', dac)]
             cmd, shift = {'A': (2, 0), 'B': (3, 14)}[dac]
@@ -2084,19 +2596,19 @@ class FPGAServer(DeviceServer):
             # See HardRegProgram.txt for byte sequence definition.
             pkt = ([0x0024, 0x0004, 0x1603, 0x0500] if signed else
                    [0x0026, 0x0006, 0x1603, 0x0500])
-            yield dev.runSerial(cmd, pkt)
-            lvdsAns = yield dev.setLVDS(cmd, lvdsSD, lvdsOptimize)
+            yield dev._runSerial(cmd, pkt)
+            lvdsAns = yield dev._setLVDS(cmd, lvdsSD, lvdsOptimize)
             lvdsKeys = ['lvdsSuccess', 'lvdsMSD', 'lvdsMHD', 'lvdsSD',
                         'lvdsTiming', 'lvdsCheck']
             for key, val in zip(lvdsKeys, lvdsAns):
                 ansDAC.append((key, val))
-            fifoAns = yield dev.setFIFO(dac, cmd, targetFifo)
+            fifoAns = yield dev._setFIFO(dac, cmd, targetFifo)
             fifoKeys = ['fifoSuccess', 'fifoClockPolarity', 'fifoPHOF',
                         'fifoTries', 'fifoCounter']
             for key, val in zip(fifoKeys, fifoAns):
                 ansDAC.append((key, val))
             bistData = [random.randint(0, 0x3FFF) for i in range(1000)]
-            bistAns = yield dev.runBIST(cmd, shift, bistData)
+            bistAns = yield dev._runBIST(cmd, shift, bistData)
             bistKeys = ['bistSuccess', 'bistTheory', 'bistLVDS', 'bistFIFO']
             for key, val in zip(bistKeys, bistAns):
                 ansDAC.append((key, val))
@@ -2221,6 +2733,24 @@ def _assert_has_jump_table(dev):
   assert dev.HAS_JUMP_TABLE, 'device is not a jump table board: {}'.format(dev)
 
 
+def _dac_bringup_summary(ans):
+    """Summarize the result of _dacBringup as (success, message)."""
+    success = True
+    msgs = []
+    for ansDAC in ans:
+        d = dict(ansDAC)
+        ok = d['lvdsSuccess'] and d['fifoSuccess'] and d['bistSuccess']
+        success = success and ok
+        msgs.append('{}: LVDS {} SD={}, FIFO {} PHOF={} tries={}, BIST {}'
+                    .format(d['dac'],
+                            'ok' if d['lvdsSuccess'] else 'FAILED',
+                            d['lvdsSD'],
+                            'ok' if d['fifoSuccess'] else 'FAILED',
+                            d['fifoPHOF'], d['fifoTries'],
+                            'ok' if d['bistSuccess'] else 'FAILED'))
+    return success, '; '.join(msgs)
+
+
 def _process_setup_packets(cxn, setupPkts):
     """
     Process packets sent in flattened form into actual labrad packets on the